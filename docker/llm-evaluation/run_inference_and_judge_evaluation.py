@@ -1,22 +1,30 @@
 import asyncio
+import json
 import os
 from argparse import Namespace
 from datetime import datetime
-from typing import Dict, List
+from typing import Any, AsyncGenerator, Dict, List
 
 from llm_evaluation import logger
 from llm_evaluation.argument_parsers import get_judge_inference_parser
 from llm_evaluation.call_inference_container.call_inference_container import (
+    AdaptiveConcurrencyController,
+    RequestMetricsCollector,
     download_dataset,
+    get_connection_options,
     get_llm_client,
+    get_result_sink,
+    get_token_lengths,
+    is_error_result,
+    read_completed_doc_ids,
     read_prompt_template,
 )
 from llm_evaluation.call_inference_container.call_inference_container import run as run_call_inference_container
-from llm_evaluation.call_inference_container.call_inference_container import (
-    save_local_results,
-)
 from llm_evaluation.data.data_classes import AggregatedJudgeResults, JudgeResult
-from llm_evaluation.judge.run_judge_evaluation import run_2step_judge_on_inferences
+from llm_evaluation.judge.run_judge_evaluation import (
+    run_2step_judge_on_inference_stream,
+    run_2step_judge_on_inferences,
+)
 from llm_evaluation.metrics.run_metrics_evaluation import read_local_inference_data
 from llm_evaluation.metrics.utils import (
     copy_results_files_to_minio,
@@ -39,7 +47,7 @@ def get_judge_score_distribution_graphs(scores: List[JudgeResult]) -> Dict[str,
         "judge_scores": [r.judge_grade for r in scores],
     }
 
-    return get_score_distribution_graphs(metrics)
+    return get_score_distribution_graphs(metrics, title_prefix="Judge")
 
 
 async def main(args: Namespace):
@@ -49,7 +57,8 @@ async def main(args: Namespace):
     This function performs the following steps:
     1. Downloads the specified evaluation dataset.
     2. Runs inference on the dataset using the evaluated model and saves the results.
-    3. Loads the generated inferences and evaluates them using a two-step judge model.
+    3. Loads the generated inferences and evaluates them using a two-step judge model. With `stream_judge`,
+       steps 2 and 3 are pipelined and each inference is judged as soon as it is available.
     4. Aggregates and computes evaluation metrics based on judge results.
     5. Saves the aggregated evaluation results to MinIO.
 
@@ -81,9 +90,21 @@ async def main(args: Namespace):
             - id_column_name (str): Name of the column containing document IDs in the dataset.
             - gold_standard_column_name (str): Name of the column containing gold standard answers in the dataset.
             - use_data_subset (int): Number of documents to use from the dataset (0 for full dataset).
+            - token_length_cache_dir (str): Directory for the token length cache. Empty to disable caching.
+            - tokenization_batch_size (int): Number of documents tokenized per tokenizer call.
+            - tokenization_num_proc (int): Number of processes used for tokenization.
+            - stream_judge (bool): Whether to judge inferences while inference is still running.
+            - judge_prefix_scheduling (bool): Whether to schedule judge requests for prefix cache reuse.
+            - resume_from (str): Local results directory of an interrupted run to resume. Empty for a new run.
+            - results_format (str): "jsonl" for sharded JSONL result files, "json" for one JSON file per document.
+            - minio_upload_workers (int): Number of concurrent uploads when copying result files to MinIO.
+            - max_connections, max_keepalive_connections, keepalive_expiry, http2, request_timeout: Connection
+              pool options of the LLM clients.
+            - max_retries (int): Number of retries of requests failing with transient errors.
+            - retry_backoff (float): Delay in seconds before the first retry, doubled after every retry.
 
     Outputs:
-            - Inference results are saved to separate files in the specified output directory.
+            - Inference and judge results are saved to the local results directory in the chosen results format.
             - Judge Evaluation results and inferences are saved to a file and copied to MinIO.
     """
 
@@ -96,9 +117,14 @@ async def main(args: Namespace):
     prompt_template = read_prompt_template(args.prompt_template_path)
     logger.info(f"Prompt template has been read in from {args.prompt_template_path}")
 
-    evaluation_dir_name = f"judge--{args.model_name}--{args.evaluation_dataset_name.replace('/', '_')}--{args.evaluation_dataset_version}--{datetime.now().isoformat()}"
+    if args.resume_from:
+        logger.info(f"Resuming evaluation from {args.resume_from}")
+        local_results_dir_path = os.path.normpath(args.resume_from)
+        evaluation_dir_name = os.path.basename(local_results_dir_path)
+    else:
+        evaluation_dir_name = f"judge--{args.model_name}--{args.evaluation_dataset_name.replace('/', '_')}--{args.evaluation_dataset_version}--{datetime.now().isoformat()}"
+        local_results_dir_path = os.path.join("/home/evaluation", evaluation_dir_name)
     minio_results_dir_path = os.path.join(args.minio_output_dir_path, evaluation_dir_name)
-    local_results_dir_path = os.path.join("/home/evaluation", evaluation_dir_name)
     if not os.path.exists(local_results_dir_path):
         logger.info(f"Creating path {local_results_dir_path}")
         os.makedirs(local_results_dir_path)
@@ -107,43 +133,84 @@ async def main(args: Namespace):
 
     parameters: dict = {}
 
-    client = get_llm_client(base_url=args.llm_base_url, port=args.llm_port, endpoint=args.llm_endpoint)
+    client = get_llm_client(
+        base_url=args.llm_base_url, port=args.llm_port, endpoint=args.llm_endpoint, **get_connection_options(args)
+    )
+    controller = AdaptiveConcurrencyController(
+        max_concurrency=args.batch_size, max_retries=args.max_retries, retry_backoff=args.retry_backoff
+    )
+    inference_request_metrics = RequestMetricsCollector(name="inference")
 
-    total_candidate_inferences = args.use_data_subset if args.use_data_subset > 0 else len(ds[args.dataset_split])
-    inferenced_docs = 0
-    async for inference_result in run_call_inference_container(
+    token_lengths = get_token_lengths(
         dataset=ds,
+        dataset_name=args.evaluation_dataset_name,
+        dataset_version=args.evaluation_dataset_version,
+        dataset_split=args.dataset_split,
         prompt_template=prompt_template,
         context_column_name=args.context_column_name,
-        id_column_name=args.id_column_name,
-        gold_standard_column_name=args.gold_standard_column_name,
-        llm_client=client,
-        model_name=args.model_name,
         model_path=args.local_model_dir_path,
-        parameters=parameters,
-        max_context_size=args.maximum_context_size,
-        batch_size=args.batch_size,
-        use_data_subset=args.use_data_subset,
-        dataset_split=args.dataset_split,
-    ):
-        save_local_results(
-            result=inference_result,
-            output_dir_path=local_results_dir_path,
-            subdir="inferences",
-        )
-        inferenced_docs += 1
-        logger.info(
-            f"Saved inference result for document {inferenced_docs}/{total_candidate_inferences} with id {inference_result['context_document_id']}"
-        )
-
-    logger.info(f"Loading file with generated inferences: {local_results_dir_path}")
-    inferences_data = read_local_inference_data(os.path.join(local_results_dir_path, "inferences"))
-    logger.info("Data loaded, running judge evaluation...")
+        cache_dir=args.token_length_cache_dir,
+        batch_size=args.tokenization_batch_size,
+        num_proc=args.tokenization_num_proc,
+    )
 
-    logger.info(inferences_data)
-    logger.info("Inference ran.")
+    completed_inference_ids = read_completed_doc_ids(output_dir_path=local_results_dir_path, subdir="inferences")
+    completed_judgment_ids = read_completed_doc_ids(output_dir_path=local_results_dir_path, subdir="judge_results")
 
-    judge_client = get_llm_client(base_url=args.judge_base_url, port=args.judge_port, endpoint=args.judge_endpoint)
+    total_candidate_inferences = args.use_data_subset if args.use_data_subset > 0 else len(ds[args.dataset_split])
+    inferenced_docs = len(completed_inference_ids)
+
+    async def inference_stream() -> AsyncGenerator[Dict[str, Any], None]:
+        # Saves each inference result locally as soon as it is available and passes it on
+        nonlocal inferenced_docs
+        if args.stream_judge and completed_inference_ids:
+            # Inferences from the interrupted run that were not judged yet
+            for inference_result in read_local_inference_data(os.path.join(local_results_dir_path, "inferences")):
+                # failed inferences are not yielded here, they are retried below
+                if str(inference_result["context_document_id"]) not in completed_judgment_ids and not is_error_result(
+                    inference_result
+                ):
+                    yield inference_result
+
+        with get_result_sink(
+            results_format=args.results_format, output_dir_path=local_results_dir_path, subdir="inferences"
+        ) as inference_sink:
+            async for inference_result in run_call_inference_container(
+                dataset=ds,
+                prompt_template=prompt_template,
+                context_column_name=args.context_column_name,
+                id_column_name=args.id_column_name,
+                gold_standard_column_name=args.gold_standard_column_name,
+                llm_client=client,
+                model_name=args.model_name,
+                model_path=args.local_model_dir_path,
+                parameters=parameters,
+                max_context_size=args.maximum_context_size,
+                batch_size=args.batch_size,
+                use_data_subset=args.use_data_subset,
+                dataset_split=args.dataset_split,
+                token_lengths=token_lengths,
+                skip_doc_ids=completed_inference_ids,
+                controller=controller,
+                request_metrics=inference_request_metrics,
+            ):
+                inference_sink.write(inference_result)
+                inferenced_docs += 1
+                logger.info(
+                    f"Saved inference result for document {inferenced_docs}/{total_candidate_inferences} with id {inference_result['context_document_id']}"
+                )
+                yield inference_result
+
+    judge_client = get_llm_client(
+        base_url=args.judge_base_url,
+        port=args.judge_port,
+        endpoint=args.judge_endpoint,
+        **get_connection_options(args),
+    )
+    judge_controller = AdaptiveConcurrencyController(
+        max_concurrency=args.judge_batch_size, max_retries=args.max_retries, retry_backoff=args.retry_backoff
+    )
+    judge_request_metrics = RequestMetricsCollector(name="judge")
 
     judge_prompt_step1_template = read_prompt_template(args.judge_prompt1_template_path)
     judge_prompt_step2_template = read_prompt_template(args.judge_prompt2_template_path)
@@ -151,7 +218,7 @@ async def main(args: Namespace):
     aggregated_judge_results = AggregatedJudgeResults(
         judge_results={},
         average_grade=0.0,
-        total_candidate_judgments=len(inferences_data),
+        total_candidate_judgments=0,
         judge_prompt_step1_template=judge_prompt_step1_template,
         judge_prompt_step2_template=judge_prompt_step2_template,
         evaluation_dataset_name=args.evaluation_dataset_name,
@@ -160,28 +227,73 @@ async def main(args: Namespace):
         judge_name=args.judge_model_name,
     )
 
-    total_inferences = len(inferences_data)
-    judged_docs = 0
-    async for judge_result in run_2step_judge_on_inferences(
-        inferences_data=inferences_data,
-        judge_model_name=args.judge_model_name,
-        judge_prompt_step1_template=judge_prompt_step1_template,
-        judge_prompt_step2_template=judge_prompt_step2_template,
-        judge_client=judge_client,
-        batch_size=args.judge_batch_size,
-        output_dir_path=local_results_dir_path,
-    ):
-        aggregated_judge_results.judge_results[judge_result.context_document_id] = judge_result
-        judged_docs += 1
-        logger.info(
-            f"Processed judge result {judged_docs}/{total_inferences} for document {judge_result.context_document_id}"
+    if completed_judgment_ids:
+        logger.info(f"Loading {len(completed_judgment_ids)} judge results from the interrupted run...")
+        for judge_result_dict in read_local_inference_data(os.path.join(local_results_dir_path, "judge_results")):
+            judge_result = JudgeResult.from_dict(judge_result_dict)  # type: ignore
+            aggregated_judge_results.judge_results[judge_result.context_document_id] = judge_result
+
+    if args.stream_judge:
+        logger.info("Running inference and judge evaluation as a stream...")
+        judge_results_stream = run_2step_judge_on_inference_stream(
+            inference_stream=inference_stream(),
+            judge_model_name=args.judge_model_name,
+            judge_prompt_step1_template=judge_prompt_step1_template,
+            judge_prompt_step2_template=judge_prompt_step2_template,
+            judge_client=judge_client,
+            max_concurrent_judgments=args.judge_batch_size,
+            controller=judge_controller,
+            session_hint=args.judge_prefix_scheduling,
+            request_metrics=judge_request_metrics,
         )
-
-        save_local_results(
-            result=judge_result.to_dict(),  # type: ignore
+        total_inferences = total_candidate_inferences
+    else:
+        async for _ in inference_stream():
+            pass
+
+        logger.info(f"Loading file with generated inferences: {local_results_dir_path}")
+        inferences_data = read_local_inference_data(os.path.join(local_results_dir_path, "inferences"))
+        logger.info("Data loaded, running judge evaluation...")
+        total_candidate_judgments = len(inferences_data)
+        inferences_data = [
+            inference_result
+            for inference_result in inferences_data
+            if str(inference_result["context_document_id"]) not in completed_judgment_ids
+        ]
+
+        logger.debug(inferences_data)
+        logger.info("Inference ran.")
+
+        judge_results_stream = run_2step_judge_on_inferences(
+            inferences_data=inferences_data,
+            judge_model_name=args.judge_model_name,
+            judge_prompt_step1_template=judge_prompt_step1_template,
+            judge_prompt_step2_template=judge_prompt_step2_template,
+            judge_client=judge_client,
+            batch_size=args.judge_batch_size,
             output_dir_path=local_results_dir_path,
-            subdir="judge_results",
+            controller=judge_controller,
+            prefix_scheduling=args.judge_prefix_scheduling,
+            request_metrics=judge_request_metrics,
         )
+        total_inferences = len(inferences_data)
+
+    judged_docs = 0
+    with get_result_sink(
+        results_format=args.results_format, output_dir_path=local_results_dir_path, subdir="judge_results"
+    ) as judge_results_sink:
+        async for judge_result in judge_results_stream:
+            aggregated_judge_results.judge_results[judge_result.context_document_id] = judge_result
+            judged_docs += 1
+            logger.info(
+                f"Processed judge result {judged_docs}/{total_inferences} for document {judge_result.context_document_id}"
+            )
+
+            judge_results_sink.write(judge_result.to_dict())  # type: ignore
+
+    aggregated_judge_results.total_candidate_judgments = (
+        inferenced_docs if args.stream_judge else total_candidate_judgments
+    )
 
     distribution_graphs = get_judge_score_distribution_graphs(
         scores=list(aggregated_judge_results.judge_results.values())
@@ -189,11 +301,18 @@ async def main(args: Namespace):
 
     aggregated_judge_results.average_grade = aggregated_judge_results.get_scores_dict()["mean_grade"]
 
+    request_metrics_summary = {**inference_request_metrics.get_summary(), **judge_request_metrics.get_summary()}
+    logger.info(f"Request metrics: {json.dumps(request_metrics_summary)}")
+
     if args.mlflow_server_uri:
         logger.info("Logging results to MLFlow...")
+        request_distribution_graphs = get_score_distribution_graphs(
+            {**inference_request_metrics.get_distributions(), **judge_request_metrics.get_distributions()},
+            title_prefix="Request",
+        )
         log_metrics_in_mlflow(
-            distribution_graphs,
-            aggregated_judge_results.get_scores_dict(),
+            {**distribution_graphs, **request_distribution_graphs},
+            {**aggregated_judge_results.get_scores_dict(), **request_metrics_summary},
             mlflow_server_uri=args.mlflow_server_uri,
             mlflow_experiment_name=args.mlflow_experiment_name,
             mlflow_run_name=args.mlflow_run_name,
@@ -216,6 +335,7 @@ async def main(args: Namespace):
         (aggregated_judge_results.judge_prompt_step1_template, os.path.join(minio_results_dir_path, "step1_template.json")),  # type: ignore
         (aggregated_judge_results.judge_prompt_step2_template, os.path.join(minio_results_dir_path, "step2_template.json")),  # type: ignore
         (vars(args), os.path.join(minio_results_dir_path, "config.json")),
+        (request_metrics_summary, os.path.join(minio_results_dir_path, "request_metrics.json")),
     ]:
         save_json_object_to_minio(json_object=json_object, destination_file=destination_file, client=minio_client)
 
@@ -225,6 +345,7 @@ async def main(args: Namespace):
         subdir="inferences",
         minio_results_dir_path=minio_results_dir_path,
         minio_client=minio_client,
+        max_workers=args.minio_upload_workers,
     )
 
     # Copying judge inference results to MinIO
@@ -233,6 +354,7 @@ async def main(args: Namespace):
         subdir="judge_results",
         minio_results_dir_path=minio_results_dir_path,
         minio_client=minio_client,
+        max_workers=args.minio_upload_workers,
     )
 
     logger.info("Evaluation complete.")
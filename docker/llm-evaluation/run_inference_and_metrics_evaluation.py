@@ -1,4 +1,5 @@
 import asyncio
+import json
 import os
 from argparse import Namespace
 from datetime import datetime
@@ -6,17 +7,31 @@ from datetime import datetime
 from llm_evaluation import logger
 from llm_evaluation.argument_parsers import get_inference_parser
 from llm_evaluation.call_inference_container.call_inference_container import (
+    AdaptiveConcurrencyController,
+    RequestMetricsCollector,
     download_dataset,
+    get_connection_options,
     get_llm_client,
+    get_result_sink,
+    get_token_lengths,
+    read_completed_doc_ids,
     read_prompt_template,
 )
 from llm_evaluation.call_inference_container.call_inference_container import run as run_call_inference_container
-from llm_evaluation.call_inference_container.call_inference_container import (
-    save_local_results,
+from llm_evaluation.metrics.metrics import set_torch_num_threads
+from llm_evaluation.metrics.run_metrics_evaluation import (
+    METRICS_FIELDS,
+    get_bert_score_distribution_graphs,
+    get_bertscore_options,
+    iter_local_inference_data,
 )
-from llm_evaluation.metrics.run_metrics_evaluation import get_bert_score_distribution_graphs, read_local_inference_data
 from llm_evaluation.metrics.run_metrics_evaluation import run as run_metrics_evaluation
-from llm_evaluation.metrics.utils import copy_results_files_to_minio, log_metrics_in_mlflow, save_json_object_to_minio
+from llm_evaluation.metrics.utils import (
+    copy_results_files_to_minio,
+    get_score_distribution_graphs,
+    log_metrics_in_mlflow,
+    save_json_object_to_minio,
+)
 from minio import Minio
 
 
@@ -42,13 +57,28 @@ async def main(args: Namespace):
             - use_data_subset (int): Number of documents to use for evaluation. If > 0, limits to this many documents.
             - dataset_split (str): The dataset split to use (e.g., "train", "test").
             - minio_output_dir_path (str): Directory path to save output files.
+            - token_length_cache_dir (str): Directory for the token length cache. Empty to disable caching.
+            - tokenization_batch_size (int): Number of documents tokenized per tokenizer call.
+            - tokenization_num_proc (int): Number of processes used for tokenization.
+            - resume_from (str): Local results directory of an interrupted run to resume. Empty for a new run.
+            - results_format (str): "jsonl" for sharded JSONL result files, "json" for one JSON file per document.
+            - minio_upload_workers (int): Number of concurrent uploads when copying result files to MinIO.
+            - max_connections, max_keepalive_connections, keepalive_expiry, http2, request_timeout: Connection
+              pool options of the LLM clients.
+            - max_retries (int): Number of retries of requests failing with transient errors.
+            - retry_backoff (float): Delay in seconds before the first retry, doubled after every retry.
+            - score_cache_path (str): Path of the on-disk BERTScore cache. Empty to disable caching.
+            - bertscore_chunk_size, bertscore_batch_size, bertscore_device: BERTScore computation options.
+            - torch_num_threads (int): Number of PyTorch threads. 0 for the PyTorch default.
+            - metric_workers (int | None): Number of worker processes for CPU-bound metrics. None for one per metric.
+            - reader_workers (int): Number of inference result files read in parallel.
 
     Workflow:
         1. Downloads the specified dataset.
         2. Reads the prompt template from the provided file path.
         3. Initializes the LLM client with the specified configuration.
         4. Runs inference using the dataset and prompt template.
-        5. Saves each inference result to a separate file as it becomes available from the async operation.
+        5. Saves each inference result to the local results sink as it becomes available from the async operation.
         6. Collects paths of individual inference result files for later evaluation.
         7. Loads the generated inferences and evaluates metrics.
         8. Saves the evaluation results to a file.
@@ -71,14 +101,38 @@ async def main(args: Namespace):
 
     parameters: dict = {}
 
-    client = get_llm_client(base_url=args.llm_base_url, port=args.llm_port, endpoint=args.llm_endpoint)
+    client = get_llm_client(
+        base_url=args.llm_base_url, port=args.llm_port, endpoint=args.llm_endpoint, **get_connection_options(args)
+    )
+    controller = AdaptiveConcurrencyController(
+        max_concurrency=args.batch_size, max_retries=args.max_retries, retry_backoff=args.retry_backoff
+    )
+    inference_request_metrics = RequestMetricsCollector(name="inference")
+
+    token_lengths = get_token_lengths(
+        dataset=ds,
+        dataset_name=args.evaluation_dataset_name,
+        dataset_version=args.evaluation_dataset_version,
+        dataset_split=args.dataset_split,
+        prompt_template=prompt_template,
+        context_column_name=args.context_column_name,
+        model_path=args.local_model_dir_path,
+        cache_dir=args.token_length_cache_dir,
+        batch_size=args.tokenization_batch_size,
+        num_proc=args.tokenization_num_proc,
+    )
 
     if args.use_data_subset > 0:
         logger.warning(f"Using a subset of the data: {args.use_data_subset} documents.")
 
-    evaluation_dir_name = f"metrics--{args.model_name}--{args.evaluation_dataset_name.replace('/', '_')}--{args.evaluation_dataset_version}--{datetime.now().isoformat()}"
+    if args.resume_from:
+        logger.info(f"Resuming evaluation from {args.resume_from}")
+        local_results_dir_path = os.path.normpath(args.resume_from)
+        evaluation_dir_name = os.path.basename(local_results_dir_path).removeprefix("inferences_")
+    else:
+        evaluation_dir_name = f"metrics--{args.model_name}--{args.evaluation_dataset_name.replace('/', '_')}--{args.evaluation_dataset_version}--{datetime.now().isoformat()}"
+        local_results_dir_path = os.path.join("/home/evaluation/results", f"inferences_{evaluation_dir_name}")
     minio_results_dir_path = os.path.join(args.minio_output_dir_path, f"metrics_{evaluation_dir_name}")
-    local_results_dir_path = os.path.join("/home/evaluation/results", f"inferences_{evaluation_dir_name}")
     if not os.path.exists(local_results_dir_path):
         logger.info(f"Creating path {local_results_dir_path}")
         os.makedirs(local_results_dir_path)
@@ -87,44 +141,65 @@ async def main(args: Namespace):
 
     total_candidate_inferences = args.use_data_subset if args.use_data_subset > 0 else len(ds[args.dataset_split])
     inferenced_docs = 0
-    async for inference_result in run_call_inference_container(
-        dataset=ds,
-        prompt_template=prompt_template,
-        context_column_name=args.context_column_name,
-        id_column_name=args.id_column_name,
-        gold_standard_column_name=args.gold_standard_column_name,
-        llm_client=client,
-        model_name=args.model_name,
-        model_path=args.local_model_dir_path,
-        parameters=parameters,
-        max_context_size=args.maximum_context_size,
-        batch_size=args.batch_size,
-        use_data_subset=args.use_data_subset,
-        dataset_split=args.dataset_split,
-    ):
-        save_local_results(result=inference_result, output_dir_path=local_results_dir_path, subdir="inferences")
-        inferenced_docs += 1
-        logger.info(
-            f"Saved inference result locally for document {inferenced_docs}/{total_candidate_inferences} with id {inference_result['context_document_id']}"
-        )
+    with get_result_sink(
+        results_format=args.results_format, output_dir_path=local_results_dir_path, subdir="inferences"
+    ) as inference_sink:
+        async for inference_result in run_call_inference_container(
+            dataset=ds,
+            prompt_template=prompt_template,
+            context_column_name=args.context_column_name,
+            id_column_name=args.id_column_name,
+            gold_standard_column_name=args.gold_standard_column_name,
+            llm_client=client,
+            model_name=args.model_name,
+            model_path=args.local_model_dir_path,
+            parameters=parameters,
+            max_context_size=args.maximum_context_size,
+            batch_size=args.batch_size,
+            use_data_subset=args.use_data_subset,
+            dataset_split=args.dataset_split,
+            token_lengths=token_lengths,
+            skip_doc_ids=read_completed_doc_ids(output_dir_path=local_results_dir_path, subdir="inferences"),
+            controller=controller,
+            request_metrics=inference_request_metrics,
+        ):
+            inference_sink.write(inference_result)
+            inferenced_docs += 1
+            logger.info(
+                f"Saved inference result locally for document {inferenced_docs}/{total_candidate_inferences} with id {inference_result['context_document_id']}"
+            )
 
     logger.info("All inferences complete. Now running metrics evaluation...")
     logger.info(f"Loading all inferences: {local_results_dir_path}")
-    data = read_local_inference_data(os.path.join(local_results_dir_path, "inferences"))
-    logger.info(f"Loaded {len(data)} inference results.")
-    logger.info("Data loaded, running metrics evaluation...")
+    data = iter_local_inference_data(
+        os.path.join(local_results_dir_path, "inferences"), fields=METRICS_FIELDS, num_workers=args.reader_workers
+    )
 
-    eval_results = run_metrics_evaluation(data)
+    set_torch_num_threads(args.torch_num_threads)
+    eval_results = run_metrics_evaluation(
+        data,
+        score_cache_path=args.score_cache_path,
+        bertscore_options=get_bertscore_options(args),
+        metric_workers=args.metric_workers,
+    )
+    logger.info(f"Evaluated {len(eval_results.generations)} inference results.")
+    logger.info(f"Metric computation times (seconds): {eval_results.metric_timings}")
 
     distribution_graphs = get_bert_score_distribution_graphs(
         scores=eval_results.scores,
     )
 
+    request_metrics_summary = inference_request_metrics.get_summary()
+    logger.info(f"Request metrics: {json.dumps(request_metrics_summary)}")
+
     if args.mlflow_server_uri:
         logger.info("Logging results to MLFlow...")
+        request_distribution_graphs = get_score_distribution_graphs(
+            inference_request_metrics.get_distributions(), title_prefix="Request"
+        )
         log_metrics_in_mlflow(
-            distribution_graphs,
-            eval_results.get_summary_scores_dict(),
+            {**distribution_graphs, **request_distribution_graphs},
+            {**eval_results.get_summary_scores_dict(), **request_metrics_summary},
             mlflow_server_uri=args.mlflow_server_uri,
             mlflow_experiment_name=args.mlflow_experiment_name,
             mlflow_run_name=args.mlflow_run_name,
@@ -147,6 +222,7 @@ async def main(args: Namespace):
         (eval_results.serializable_all_scores_dict(), os.path.join(minio_results_dir_path, "all_scores_list.json")),  # type: ignore
         (prompt_template, os.path.join(minio_results_dir_path, "prompt_template.json")),  # type: ignore
         (vars(args), os.path.join(minio_results_dir_path, "config.json")),
+        (request_metrics_summary, os.path.join(minio_results_dir_path, "request_metrics.json")),
     ]:
         save_json_object_to_minio(json_object=json_object, destination_file=destination_file, client=minio_client)
 
@@ -155,6 +231,7 @@ async def main(args: Namespace):
         subdir="inferences",
         minio_results_dir_path=minio_results_dir_path,
         minio_client=minio_client,
+        max_workers=args.minio_upload_workers,
     )
 
     logger.info("Evaluation complete.")
@@ -41,12 +41,90 @@ def get_inference_parser() -> ArgumentParser:
     parser.add_argument(
         "-o", "--minio-output-dir-path", type=str, help="Path to the directory where output files will be saved."
     )
+    parser.add_argument(
+        "--resume-from",
+        type=str,
+        default="",  # leave this argument empty to start a new evaluation run
+        help="Local results directory of an interrupted evaluation run. Documents with saved results are skipped.",
+    )
+    parser.add_argument(
+        "--results-format",
+        type=str,
+        choices=["jsonl", "json"],
+        default="jsonl",
+        help="Format of the local result files: sharded JSONL files with a manifest, or one JSON file per document.",
+    )
+    parser.add_argument(
+        "--minio-upload-workers",
+        type=int,
+        default=16,
+        help="Number of concurrent uploads when copying result files to MinIO.",
+    )
     parser.add_argument("-m", "--model-name", type=str, help="Name of the model to be used for inference.")
     parser.add_argument("-a", "--model-path", type=str, help="Path to the model.")
     parser.add_argument("--local-model-dir-path", type=str, help="Local path to the model.")
     parser.add_argument(
         "-x", "--maximum-context-size", type=int, help="Maximum size of the context to be used for inference."
     )
+    parser.add_argument(
+        "--token-length-cache-dir",
+        type=str,
+        default="",  # leave this argument empty to disable the token length cache
+        help="Directory where token lengths of the formatted prompts are cached between runs.",
+    )
+    parser.add_argument(
+        "--tokenization-batch-size",
+        type=int,
+        default=1000,
+        help="Number of documents tokenized per tokenizer call when filtering by maximum context size.",
+    )
+    parser.add_argument(
+        "--tokenization-num-proc",
+        type=int,
+        default=1,
+        help="Number of processes used for tokenizing the dataset when filtering by maximum context size.",
+    )
+    parser.add_argument(
+        "--score-cache-path",
+        type=str,
+        default="",  # leave this argument empty to disable the score cache
+        help="Path of the on-disk cache of BERTScore scores of (prediction, reference) pairs, reused between runs.",
+    )
+    parser.add_argument(
+        "--bertscore-chunk-size",
+        type=int,
+        default=1000,
+        help="Number of (prediction, reference) pairs scored per BERTScore call. 0 for a single call.",
+    )
+    parser.add_argument(
+        "--bertscore-batch-size", type=int, default=64, help="Batch size of the BERTScore model forward passes."
+    )
+    parser.add_argument(
+        "--bertscore-device",
+        type=str,
+        default="",  # leave this argument empty to use CUDA, if available
+        help="Device of the BERTScore model, e.g. cuda or cpu.",
+    )
+    parser.add_argument(
+        "--torch-num-threads",
+        type=int,
+        default=0,
+        help="Number of PyTorch threads, e.g. for BERTScore on CPU-only nodes. 0 (default) for the PyTorch default.",
+    )
+    parser.add_argument(
+        "--metric-workers",
+        type=int,
+        default=None,
+        help="Number of processes computing CPU-bound metrics, e.g. BLEU, concurrently with BERTScore. "
+        "Defaults to one per metric, 0 computes all metrics sequentially in the main process.",
+    )
+    parser.add_argument(
+        "--reader-workers",
+        type=int,
+        default=4,
+        help="Number of inference result files read in parallel for the metrics evaluation. "
+        "1 reads the files one record at a time.",
+    )
     parser.add_argument(
         "-c", "--context-column-name", type=str, help="Name of the column containing context data in the dataset."
     )
@@ -64,7 +142,34 @@ def get_inference_parser() -> ArgumentParser:
         "--batch-size",
         type=int,
         default=50,
-        help="Size of batch of documents sent by the async client to the LLM service.",
+        help="Maximum number of concurrent requests kept in flight by the async client to the LLM service.",
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=100, help="Maximum number of connections per LLM client."
+    )
+    parser.add_argument(
+        "--max-keepalive-connections",
+        type=int,
+        default=20,
+        help="Maximum number of idle connections kept alive per LLM client.",
+    )
+    parser.add_argument(
+        "--keepalive-expiry", type=float, default=30.0, help="Seconds after which idle connections are closed."
+    )
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 for the connections to the LLM services.")
+    parser.add_argument("--request-timeout", type=float, default=600.0, help="Timeout of LLM requests in seconds.")
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=3,
+        help="Number of retries of LLM requests failing with transient errors (HTTP 429/5xx, timeouts). "
+        "Overload errors also reduce the number of concurrent requests, which recovers gradually.",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=1.0,
+        help="Delay in seconds before the first retry of an LLM request, doubled after every retry.",
     )
     parser.add_argument(
         "-s",
@@ -108,6 +213,47 @@ def get_metrics_parser() -> ArgumentParser:
     parser = ArgumentParser(prog="Compute Metrics")
     parser.add_argument("-i", "--input-file-path", help="Input file path for the JSON with LLM generated text.")
     parser.add_argument("-o", "--minio-output-dir-path", help="Output directory for the results.")
+    parser.add_argument(
+        "--score-cache-path",
+        type=str,
+        default="",  # leave this argument empty to disable the score cache
+        help="Path of the on-disk cache of BERTScore scores of (prediction, reference) pairs, reused between runs.",
+    )
+    parser.add_argument(
+        "--bertscore-chunk-size",
+        type=int,
+        default=1000,
+        help="Number of (prediction, reference) pairs scored per BERTScore call. 0 for a single call.",
+    )
+    parser.add_argument(
+        "--bertscore-batch-size", type=int, default=64, help="Batch size of the BERTScore model forward passes."
+    )
+    parser.add_argument(
+        "--bertscore-device",
+        type=str,
+        default="",  # leave this argument empty to use CUDA, if available
+        help="Device of the BERTScore model, e.g. cuda or cpu.",
+    )
+    parser.add_argument(
+        "--torch-num-threads",
+        type=int,
+        default=0,
+        help="Number of PyTorch threads, e.g. for BERTScore on CPU-only nodes. 0 (default) for the PyTorch default.",
+    )
+    parser.add_argument(
+        "--metric-workers",
+        type=int,
+        default=None,
+        help="Number of processes computing CPU-bound metrics, e.g. BLEU, concurrently with BERTScore. "
+        "Defaults to one per metric, 0 computes all metrics sequentially in the main process.",
+    )
+    parser.add_argument(
+        "--reader-workers",
+        type=int,
+        default=4,
+        help="Number of inference result files read in parallel for the metrics evaluation. "
+        "1 reads the files one record at a time.",
+    )
     return parser
 
 
@@ -160,14 +306,78 @@ def get_judge_inference_parser() -> ArgumentParser:
     parser.add_argument(
         "--minio-output-dir-path", type=str, help="Path to the directory where output files will be saved."
     )
+    parser.add_argument(
+        "--resume-from",
+        type=str,
+        default="",  # leave this argument empty to start a new evaluation run
+        help="Local results directory of an interrupted evaluation run. Documents with saved results are skipped.",
+    )
+    parser.add_argument(
+        "--results-format",
+        type=str,
+        choices=["jsonl", "json"],
+        default="jsonl",
+        help="Format of the local result files: sharded JSONL files with a manifest, or one JSON file per document.",
+    )
+    parser.add_argument(
+        "--minio-upload-workers",
+        type=int,
+        default=16,
+        help="Number of concurrent uploads when copying result files to MinIO.",
+    )
     parser.add_argument(
         "--maximum-context-size", type=int, help="Maximum size of the context to be used for inference."
     )
+    parser.add_argument(
+        "--token-length-cache-dir",
+        type=str,
+        default="",  # leave this argument empty to disable the token length cache
+        help="Directory where token lengths of the formatted prompts are cached between runs.",
+    )
+    parser.add_argument(
+        "--tokenization-batch-size",
+        type=int,
+        default=1000,
+        help="Number of documents tokenized per tokenizer call when filtering by maximum context size.",
+    )
+    parser.add_argument(
+        "--tokenization-num-proc",
+        type=int,
+        default=1,
+        help="Number of processes used for tokenizing the dataset when filtering by maximum context size.",
+    )
     parser.add_argument(
         "--batch-size",
         type=int,
         default=50,
-        help="Size of batch of documents sent by the async client to the LLM service.",
+        help="Maximum number of concurrent requests kept in flight by the async client to the LLM service.",
+    )
+    parser.add_argument(
+        "--max-connections", type=int, default=100, help="Maximum number of connections per LLM client."
+    )
+    parser.add_argument(
+        "--max-keepalive-connections",
+        type=int,
+        default=20,
+        help="Maximum number of idle connections kept alive per LLM client.",
+    )
+    parser.add_argument(
+        "--keepalive-expiry", type=float, default=30.0, help="Seconds after which idle connections are closed."
+    )
+    parser.add_argument("--http2", action="store_true", help="Use HTTP/2 for the connections to the LLM services.")
+    parser.add_argument("--request-timeout", type=float, default=600.0, help="Timeout of LLM requests in seconds.")
+    parser.add_argument(
+        "--max-retries",
+        type=int,
+        default=3,
+        help="Number of retries of LLM requests failing with transient errors (HTTP 429/5xx, timeouts). "
+        "Overload errors also reduce the number of concurrent requests, which recovers gradually.",
+    )
+    parser.add_argument(
+        "--retry-backoff",
+        type=float,
+        default=1.0,
+        help="Delay in seconds before the first retry of an LLM request, doubled after every retry.",
     )
     parser.add_argument(
         "--judge-maximum-context-size",
@@ -180,6 +390,19 @@ def get_judge_inference_parser() -> ArgumentParser:
         default=50,
         help="Size of batch of documents sent by the async client to the Judge service.",
     )
+    parser.add_argument(
+        "--stream-judge",
+        action="store_true",
+        help="Judge each inference as soon as it is available, overlapping inference and judging. "
+        "--batch-size and --judge-batch-size set the concurrency limits of the LLM and Judge services.",
+    )
+    parser.add_argument(
+        "--judge-prefix-scheduling",
+        action="store_true",
+        help="Schedule judge requests for prefix cache reuse on the judge server: judge documents in order of their "
+        "prompts, so shared prefixes are sent together, and tag both steps of a judgment with an X-Session-Id header "
+        "for session-affine routing. With --stream-judge, documents are judged in order of arrival.",
+    )
     parser.add_argument(
         "--context-column-name", type=str, help="Name of the column containing context data in the dataset."
     )
@@ -1,21 +1,57 @@
 import asyncio
+import hashlib
 import json
 import os
 import time
 from argparse import Namespace
 from datetime import datetime
 from itertools import islice
-from typing import Any, AsyncGenerator, Dict, Iterable, List, Tuple
-
-from datasets import load_dataset
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+)
+
+import httpx
+import numpy as np
+from datasets import Dataset, load_dataset
 from jsonlines import Writer
 from llm_evaluation import logger
 from llm_evaluation.argument_parsers import get_inference_parser
-from openai import APIError, AsyncClient
+from llm_evaluation.data.data_classes import RequestMetrics
+from openai import (
+    APIConnectionError,
+    APIError,
+    AsyncClient,
+    DefaultAsyncHttpxClient,
+    InternalServerError,
+    RateLimitError,
+)
+from openai.types import CompletionUsage
 from openai.types.chat import ChatCompletion
 from tqdm import tqdm
 from transformers import AutoTokenizer
 
+T = TypeVar("T")
+
+COMPLETED_IDS_FILE_NAME = "completed_ids.txt"
+# Prefix of the completions recorded for failed requests
+ERROR_PREFIX = "**ERROR**"
+MANIFEST_FILE_NAME = "manifest.json"
+REQUEST_METRICS_FILE_NAME = "request_metrics.json"
+
+# Errors signalling an overloaded or unreachable LLM service (HTTP 429 and 5xx, timeouts, connection errors)
+TRANSIENT_API_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+
 
 def download_dataset(dataset: str, version: str) -> Dict:
     """
@@ -33,7 +69,17 @@ def download_dataset(dataset: str, version: str) -> Dict:
     return load_dataset(dataset, version)
 
 
-def get_llm_client(base_url: str, port: str | None, endpoint: str | None) -> AsyncClient:
+def get_llm_client(
+    base_url: str,
+    port: str | None,
+    endpoint: str | None,
+    max_connections: int = 100,
+    max_keepalive_connections: int = 20,
+    keepalive_expiry: float = 30.0,
+    http2: bool = False,
+    timeout: float = 600.0,
+    max_retries: int = 2,
+) -> AsyncClient:
     """
     Creates and returns a client for interacting with a language model (LLM) service.
 
@@ -41,6 +87,14 @@ def get_llm_client(base_url: str, port: str | None, endpoint: str | None) -> Asy
         base_url (str): The base URL of the LLM service.
         port (str | None): The port number to connect to the LLM service. If None, no port is appended.
         endpoint (str | None): The endpoint path for the LLM service. If None, no endpoint is appended.
+        max_connections (int, optional): Maximum number of connections of the connection pool. Defaults to 100.
+        max_keepalive_connections (int, optional): Maximum number of idle connections kept alive. Defaults to 20.
+        keepalive_expiry (float, optional): Seconds after which idle connections are closed. Defaults to 30.
+        http2 (bool, optional): Whether to use HTTP/2, which multiplexes requests over fewer connections. Requires
+            the `h2` package. Defaults to False.
+        timeout (float, optional): Request timeout in seconds. Defaults to 600.
+        max_retries (int, optional): Number of retries of the OpenAI client itself. Set to 0 when requests are
+            retried by an `AdaptiveConcurrencyController`. Defaults to 2.
 
     Returns:
         AsyncClient: An instance of the AsyncClient class configured to interact with the specified LLM service.
@@ -48,7 +102,168 @@ def get_llm_client(base_url: str, port: str | None, endpoint: str | None) -> Asy
 
     model_url = f"{base_url}{':'+port if port else ''}{'/'+endpoint if endpoint else ''}/"
     logger.info(f"Connecting to model at {model_url}")
-    return AsyncClient(base_url=model_url, api_key="EMPTY")
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        http2=http2,
+    )
+    return AsyncClient(
+        base_url=model_url, api_key="EMPTY", http_client=http_client, timeout=timeout, max_retries=max_retries
+    )
+
+
+def get_connection_options(args: Namespace) -> Dict[str, Any]:
+    """
+    Returns the keyword arguments of `get_llm_client` set by the command line arguments.
+
+    Retries are left to the `AdaptiveConcurrencyController`, so the OpenAI client does not retry by itself.
+
+    Args:
+        args (Namespace): Command line arguments with `max_connections`, `max_keepalive_connections`,
+            `keepalive_expiry`, `http2` and `request_timeout` attributes.
+
+    Returns:
+        Dict[str, Any]: Keyword arguments for `get_llm_client`.
+    """
+    return {
+        "max_connections": args.max_connections,
+        "max_keepalive_connections": args.max_keepalive_connections,
+        "keepalive_expiry": args.keepalive_expiry,
+        "http2": args.http2,
+        "timeout": args.request_timeout,
+        "max_retries": 0,
+    }
+
+
+class AdaptiveConcurrencyController:
+    """
+    Limits the number of concurrent requests to an LLM service and adapts the limit to the load of the service.
+
+    The limit follows additive increase/multiplicative decrease: it grows by about one request per window of
+    successful requests, up to `max_concurrency`, and is multiplied by `decrease_factor` when the service reports
+    overload (see `TRANSIENT_API_ERRORS`), at most once per `cooldown` seconds. Requests failing with such transient
+    errors are retried with exponential backoff, so overload slows a run down instead of losing samples.
+
+    Args:
+        max_concurrency (int): Maximum number of concurrent requests.
+        min_concurrency (int, optional): Lower bound of the concurrency limit. Defaults to 1.
+        decrease_factor (float, optional): Factor applied to the limit on overload. Defaults to 0.5.
+        cooldown (float, optional): Minimum number of seconds between two decreases of the limit, so a burst of
+            errors from requests sent at the same time only counts once. Defaults to 1.
+        max_retries (int, optional): Number of retries of requests failing with transient errors. Defaults to 3.
+        retry_backoff (float, optional): Delay in seconds before the first retry, doubled after every retry.
+            Defaults to 1.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        min_concurrency: int = 1,
+        decrease_factor: float = 0.5,
+        cooldown: float = 1.0,
+        max_retries: int = 3,
+        retry_backoff: float = 1.0,
+    ):
+        if not 1 <= min_concurrency <= max_concurrency:
+            raise ValueError("Concurrency limits must satisfy 1 <= min_concurrency <= max_concurrency")
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.retries = 0
+        self.overloads = 0
+        self.last_decrease_time = float("-inf")
+        self.priority_waiting = 0
+        self.condition = asyncio.Condition()
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(int(self.limit), self.min_concurrency)
+
+    def record_success(self):
+        self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+
+    def record_overload(self):
+        self.overloads += 1
+        now = time.monotonic()
+        if now - self.last_decrease_time >= self.cooldown:
+            self.limit = max(self.limit * self.decrease_factor, self.min_concurrency)
+            self.last_decrease_time = now
+            logger.warning(f"LLM service overloaded, concurrency limit reduced to {self.concurrency_limit}")
+
+    async def acquire(self, priority: bool = False):
+        """
+        Waits for a free concurrency slot and takes it. Requests without priority wait while a priority request is
+        waiting, so follow-up requests, e.g. the second turn of a conversation, are not queued behind new ones.
+        """
+        async with self.condition:
+            if priority:
+                self.priority_waiting += 1
+                try:
+                    await self.condition.wait_for(lambda: self.in_flight < self.concurrency_limit)
+                finally:
+                    self.priority_waiting -= 1
+                    self.condition.notify_all()
+            else:
+                await self.condition.wait_for(
+                    lambda: self.in_flight < self.concurrency_limit and not self.priority_waiting
+                )
+            self.in_flight += 1
+
+    async def release(self):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def call(self, request: Callable[[], Awaitable[T]], priority: bool = False) -> T:
+        """
+        Sends a request once a concurrency slot is free, retrying it on transient errors.
+
+        Args:
+            request (Callable[[], Awaitable[T]]): Function creating the request coroutine. It is called again for
+                every retry.
+            priority (bool, optional): Whether the request takes the next free slot before the requests without
+                priority. Defaults to False.
+
+        Returns:
+            T: The result of the request.
+
+        Raises:
+            APIError: The last transient error, if all retries failed, or any other API error.
+        """
+        attempt = 0
+        while True:
+            await self.acquire(priority)
+            try:
+                result = await request()
+            except TRANSIENT_API_ERRORS as e:
+                self.record_overload()
+                if attempt == self.max_retries:
+                    raise
+                delay = self.retry_backoff * 2**attempt
+                logger.warning(f"Transient error from LLM service: {e}. Retrying in {delay:.1f} seconds...")
+                attempt += 1
+                self.retries += 1
+            else:
+                self.record_success()
+                return result
+            finally:
+                await self.release()
+            await asyncio.sleep(delay)
+
+    def __str__(self):
+        return (
+            f"Concurrency limit {self.concurrency_limit}/{self.max_concurrency}, "
+            f"{self.overloads} overload errors, {self.retries} retries"
+        )
 
 
 def handle_llm_inference_result(doc_id: str, result: ChatCompletion) -> str | None:
@@ -63,14 +278,28 @@ def handle_llm_inference_result(doc_id: str, result: ChatCompletion) -> str | No
         str: The extracted content from the LLM inference result.
     """
 
-    logger.info(f"Handling LLM inference result for document {doc_id}...")
-    logger.info(f"Result: {result}")
+    logger.debug(f"Handling LLM inference result for document {doc_id}...")
+    logger.debug(f"Result: {result}")
 
     inference_result = result.choices[0].message.content
 
     return inference_result
 
 
+def is_error_result(result: Dict[str, Any]) -> bool:
+    """
+    Checks whether a saved result records a failed inference request. Such results are kept out of the completion
+    index, so the request is retried when the run is resumed.
+
+    Args:
+        result (Dict[str, Any]): An inference or judge result.
+
+    Returns:
+        bool: True if the inference of the result is an error completion.
+    """
+    return str(result.get("llm_inference") or "").startswith(ERROR_PREFIX)
+
+
 def save_local_results(result: Dict[str, Any], output_dir_path: str, subdir: str):
     """
     Saves a single inference result to a JSON file in the specified output directory.
@@ -96,6 +325,241 @@ def save_local_results(result: Dict[str, Any], output_dir_path: str, subdir: str
     with open(inferences_filepath, "w") as fp:
         fp.write(json.dumps(result))
 
+    # Record the document in the completion index only after its result has been written
+    if not is_error_result(result):
+        with open(os.path.join(output_dir_path, subdir, COMPLETED_IDS_FILE_NAME), "a") as fp:
+            fp.write(f"{result['context_document_id']}\n")
+
+
+def read_completed_doc_ids(output_dir_path: str, subdir: str) -> Set[str]:
+    """
+    Reads the IDs of the documents whose results have already been saved with `save_local_results`.
+
+    The completion index written alongside the results is used if it exists. Otherwise, e.g. for results written
+    before the index was introduced, the IDs are taken from the result files. Results of failed requests (see
+    `is_error_result`) do not count as completed. IDs are strings, compare them with `str(doc_id)`.
+
+    Args:
+        output_dir_path (str): The directory path where the results were saved.
+        subdir (str): The subdirectory of the results, e.g. "inferences" or "judge_results".
+
+    Returns:
+        Set[str]: The IDs of the documents with saved results. Empty if the directory does not exist.
+    """
+    results_dir_path = os.path.join(output_dir_path, subdir)
+    index_file_path = os.path.join(results_dir_path, COMPLETED_IDS_FILE_NAME)
+
+    if os.path.exists(index_file_path):
+        with open(index_file_path, "r") as fp:
+            completed_doc_ids = {line.rstrip("\n") for line in fp if line.strip()}
+    elif os.path.isdir(results_dir_path):
+        completed_doc_ids = set()
+        for file_name in os.listdir(results_dir_path):
+            if not file_name.endswith(".json") or file_name == MANIFEST_FILE_NAME:
+                continue
+            try:
+                with open(os.path.join(results_dir_path, file_name), "r") as fp:
+                    result = json.load(fp)
+            except ValueError:
+                logger.warning(f"Invalid result file {file_name}, the document will be processed again.")
+                continue
+            if not is_error_result(result):
+                completed_doc_ids.add(file_name.removesuffix(".json"))
+    else:
+        completed_doc_ids = set()
+
+    logger.info(f"Found {len(completed_doc_ids)} completed documents in {results_dir_path}")
+    return completed_doc_ids
+
+
+class ResultSink:
+    """
+    Base class for writers of results to a subdirectory of a local results directory.
+
+    Results written to a sink are recorded in the completion index (see `read_completed_doc_ids`) once they are
+    on disk. Sinks are context managers, and buffered results are written when the sink is closed.
+    """
+
+    def __init__(self, output_dir_path: str, subdir: str):
+        self.results_dir_path = os.path.join(output_dir_path, subdir)
+        os.makedirs(self.results_dir_path, exist_ok=True)
+
+    def write(self, result: Dict[str, Any]):
+        raise NotImplementedError
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JsonFilesResultSink(ResultSink):
+    """
+    Writes every result to a separate `<context_document_id>.json` file, using `save_local_results`.
+    """
+
+    def __init__(self, output_dir_path: str, subdir: str):
+        super().__init__(output_dir_path=output_dir_path, subdir=subdir)
+        self.output_dir_path = output_dir_path
+        self.subdir = subdir
+
+    def write(self, result: Dict[str, Any]):
+        save_local_results(result=result, output_dir_path=self.output_dir_path, subdir=self.subdir)
+
+
+class JsonlResultSink(ResultSink):
+    """
+    Buffers results in memory and appends them to sharded JSONL files, described by a manifest file.
+
+    The buffer is flushed every `flush_every` results or `flush_interval` seconds, whichever comes first, so
+    results are written with a few large sequential writes instead of one file per document. A new shard is started
+    when the current one holds `max_records_per_shard` results, and when an existing results directory is resumed.
+    After every write to a shard, the manifest is replaced atomically and then the written document IDs are appended
+    to the completion index, so the manifest lists every completed document. When the directory is resumed, records a
+    crash left in a shard beyond the manifest are removed and the completion index is rebuilt from the records the
+    manifest lists, and new shards never reuse the name of a file on disk.
+    """
+
+    def __init__(
+        self,
+        output_dir_path: str,
+        subdir: str,
+        flush_every: int = 100,
+        flush_interval: float = 30.0,
+        max_records_per_shard: int = 10000,
+    ):
+        super().__init__(output_dir_path=output_dir_path, subdir=subdir)
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.max_records_per_shard = max_records_per_shard
+
+        self.buffer: List[Dict[str, Any]] = []
+        self.last_flush_time = time.time()
+
+        self.manifest = read_manifest(self.results_dir_path) or {"format": "jsonl", "num_records": 0, "shards": []}
+        if self.manifest["shards"]:
+            # a crash between the manifest update and the index update leaves listed records out of the index
+            completed_doc_ids = [
+                str(record["context_document_id"])
+                for shard in self.manifest["shards"]
+                for record in self._read_shard(shard)
+                if not is_error_result(record)
+            ]
+            self._write_completed_ids(completed_doc_ids)
+        # Start a new shard, so shards from an interrupted run are never appended to
+        self.shard: Dict[str, Any] | None = None
+
+    def _read_shard(self, shard: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # returns the records listed in the manifest, and drops the records written after the last manifest update,
+        # e.g. by a run that crashed in between
+        shard_file_path = os.path.join(self.results_dir_path, shard["file_name"])
+        if not os.path.exists(shard_file_path):
+            return []
+        with open(shard_file_path, "r") as fp:
+            lines = fp.readlines()
+        if len(lines) > shard["num_records"]:
+            logger.warning(f"Removing {len(lines) - shard['num_records']} unlisted records from {shard_file_path}")
+            with open(f"{shard_file_path}.tmp", "w") as fp:
+                fp.writelines(lines[: shard["num_records"]])
+            os.replace(f"{shard_file_path}.tmp", shard_file_path)
+        return [json.loads(line) for line in lines[: shard["num_records"]]]
+
+    def _write_completed_ids(self, completed_doc_ids: List[str]):
+        index_file_path = os.path.join(self.results_dir_path, COMPLETED_IDS_FILE_NAME)
+        with open(f"{index_file_path}.tmp", "w") as fp:
+            fp.write("".join(f"{doc_id}\n" for doc_id in dict.fromkeys(completed_doc_ids)))
+        os.replace(f"{index_file_path}.tmp", index_file_path)
+
+    def _new_shard(self) -> Dict[str, Any]:
+        shard_idx = len(self.manifest["shards"])
+        # skip the names of shards a crashed run wrote before listing them in the manifest
+        while os.path.exists(os.path.join(self.results_dir_path, f"shard-{shard_idx:05d}.jsonl")):
+            shard_idx += 1
+        return {"file_name": f"shard-{shard_idx:05d}.jsonl", "num_records": 0}
+
+    def _write_manifest(self):
+        manifest_file_path = os.path.join(self.results_dir_path, MANIFEST_FILE_NAME)
+        with open(f"{manifest_file_path}.tmp", "w") as fp:
+            json.dump(self.manifest, fp)
+        os.replace(f"{manifest_file_path}.tmp", manifest_file_path)
+
+    def write(self, result: Dict[str, Any]):
+        self.buffer.append(result)
+        if len(self.buffer) >= self.flush_every or time.time() - self.last_flush_time >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush_time = time.time()
+        if not self.buffer:
+            return
+
+        while self.buffer:
+            if self.shard is None or self.shard["num_records"] >= self.max_records_per_shard:
+                self.shard = self._new_shard()
+                self.manifest["shards"].append(self.shard)
+
+            records = self.buffer[: self.max_records_per_shard - self.shard["num_records"]]
+            self.buffer = self.buffer[len(records) :]
+
+            shard_file_path = os.path.join(self.results_dir_path, self.shard["file_name"])
+            with open(shard_file_path, "a") as fp:
+                fp.write("".join(json.dumps(record) + "\n" for record in records))
+            self.shard["num_records"] += len(records)
+            self.manifest["num_records"] += len(records)
+            self._write_manifest()
+            with open(os.path.join(self.results_dir_path, COMPLETED_IDS_FILE_NAME), "a") as fp:
+                fp.write(
+                    "".join(f"{record['context_document_id']}\n" for record in records if not is_error_result(record))
+                )
+            logger.info(f"Wrote {len(records)} results to {shard_file_path}")
+
+
+def get_result_sink(results_format: str, output_dir_path: str, subdir: str) -> ResultSink:
+    """
+    Returns a result sink for the given results format.
+
+    Args:
+        results_format (str): Either "jsonl" for sharded JSONL files, or "json" for one JSON file per document.
+        output_dir_path (str): The directory path where the results are saved.
+        subdir (str): The subdirectory of the results, e.g. "inferences" or "judge_results".
+
+    Returns:
+        ResultSink: The result sink.
+
+    Raises:
+        ValueError: If the results format is not supported.
+    """
+    if results_format == "jsonl":
+        return JsonlResultSink(output_dir_path=output_dir_path, subdir=subdir)
+    if results_format == "json":
+        return JsonFilesResultSink(output_dir_path=output_dir_path, subdir=subdir)
+    raise ValueError(f"Unsupported results format: {results_format}")
+
+
+def read_manifest(results_dir_path: str) -> Dict[str, Any] | None:
+    """
+    Reads the manifest of the sharded JSONL results in a directory.
+
+    Args:
+        results_dir_path (str): The directory containing the results.
+
+    Returns:
+        Dict[str, Any] | None: The manifest, with the total number of records and the file name and number of
+            records of each shard. None if the directory has no manifest.
+    """
+    manifest_file_path = os.path.join(results_dir_path, MANIFEST_FILE_NAME)
+    if not os.path.exists(manifest_file_path):
+        return None
+    with open(manifest_file_path, "r") as fp:
+        return json.load(fp)
+
 
 def save_judge_inferences(
     results: list,
@@ -201,8 +665,280 @@ async def batched_async(iterable, batch_size: int):
         yield batch
 
 
+def iter_token_lengths(
+    documents: Iterable[Dict[str, Any]],
+    prompt_template: str,
+    context_column_name: str,
+    tokenizer: Any,
+    batch_size: int = 1000,
+) -> Iterator[int]:
+    """
+    Lazily computes the token length of the formatted prompt of each document.
+
+    Documents are tokenized in batches with a single call to the (fast) tokenizer per batch, which is much faster
+    than tokenizing documents one at a time. Only as many batches as are consumed are tokenized.
+
+    Args:
+        documents (Iterable[Dict[str, Any]]): The dataset rows.
+        prompt_template (str): The template used to format the prompt for the language model.
+        context_column_name (str): The column name in the dataset containing the context documents.
+        tokenizer (Any): The tokenizer used for token counting.
+        batch_size (int, optional): Number of documents tokenized per tokenizer call. Defaults to 1000.
+
+    Yields:
+        int: The number of tokens in the formatted prompt of each document, in dataset order.
+    """
+    for batch in batched(documents, batch_size):
+        messages = [prompt_template.format(context=datum[context_column_name]) for datum in batch]
+        yield from (len(input_ids) for input_ids in tokenizer(messages)["input_ids"])
+
+
+def get_token_length_cache_path(
+    cache_dir: str,
+    dataset_name: str,
+    dataset_version: str,
+    dataset_split: str,
+    prompt_template: str,
+    context_column_name: str,
+    model_path: str,
+) -> str:
+    """
+    Returns the path of the token length cache file for a dataset split, prompt template and tokenizer.
+
+    Args:
+        cache_dir (str): The directory where token length cache files are stored.
+        dataset_name (str): The name of the evaluation dataset.
+        dataset_version (str): The version of the evaluation dataset.
+        dataset_split (str): The split of the dataset.
+        prompt_template (str): The template used to format the prompt for the language model.
+        context_column_name (str): The column name in the dataset containing the context documents.
+        model_path (str): The path to the model tokenizer.
+
+    Returns:
+        str: The path of the cache file.
+    """
+    cache_key = hashlib.sha256(
+        json.dumps(
+            [dataset_name, dataset_version, dataset_split, prompt_template, context_column_name, model_path]
+        ).encode()
+    ).hexdigest()
+    return os.path.join(
+        cache_dir,
+        f"token_lengths--{dataset_name.replace('/', '_')}--{dataset_version}--{dataset_split}--{cache_key[:16]}.npy",
+    )
+
+
+def get_token_lengths(
+    dataset: Dict,
+    dataset_name: str,
+    dataset_version: str,
+    dataset_split: str,
+    prompt_template: str,
+    context_column_name: str,
+    model_path: str,
+    cache_dir: str | None = None,
+    batch_size: int = 1000,
+    num_proc: int = 1,
+) -> np.ndarray:
+    """
+    Computes the token length of the formatted prompt of every document in a dataset split, using an on-disk cache.
+
+    The token lengths are cached in `cache_dir`, keyed by dataset, version, split, prompt template, context column
+    and tokenizer, so reruns skip tokenization (and loading the tokenizer) entirely.
+
+    Args:
+        dataset (Dict): The dataset containing the input data for inference.
+        dataset_name (str): The name of the evaluation dataset.
+        dataset_version (str): The version of the evaluation dataset.
+        dataset_split (str): The split of the dataset to use (e.g., "train", "test", "validation").
+        prompt_template (str): The template used to format the prompt for the language model.
+        context_column_name (str): The column name in the dataset containing the context documents.
+        model_path (str): The path to the model tokenizer for token counting.
+        cache_dir (str | None, optional): Directory for the token length cache. If None or empty, no cache is used.
+        batch_size (int, optional): Number of documents tokenized per tokenizer call. Defaults to 1000.
+        num_proc (int, optional): Number of processes used to tokenize with `datasets.Dataset.map`. Defaults to 1.
+
+    Returns:
+        np.ndarray: The token length of each document, in dataset order.
+    """
+    split_data = dataset[dataset_split]
+
+    cache_path = None
+    if cache_dir:
+        cache_path = get_token_length_cache_path(
+            cache_dir=cache_dir,
+            dataset_name=dataset_name,
+            dataset_version=dataset_version,
+            dataset_split=dataset_split,
+            prompt_template=prompt_template,
+            context_column_name=context_column_name,
+            model_path=model_path,
+        )
+        if os.path.exists(cache_path):
+            token_lengths = np.load(cache_path)
+            if len(token_lengths) == len(split_data):
+                logger.info(f"Loaded token lengths from cache {cache_path}")
+                return token_lengths
+            logger.warning(f"Token length cache {cache_path} does not match the dataset size. Recomputing...")
+
+    logger.info(f"Loading tokenizer from model path: {model_path}")
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+
+    tokenization_start_time = time.time()
+    if num_proc > 1 and isinstance(split_data, Dataset):
+        token_lengths = np.array(
+            split_data.map(
+                lambda batch: {
+                    "token_length": [
+                        len(input_ids)
+                        for input_ids in tokenizer(
+                            [prompt_template.format(context=context) for context in batch[context_column_name]]
+                        )["input_ids"]
+                    ]
+                },
+                batched=True,
+                batch_size=batch_size,
+                num_proc=num_proc,
+                remove_columns=split_data.column_names,
+            )["token_length"],
+            dtype=np.int64,
+        )
+    else:
+        token_lengths = np.fromiter(
+            iter_token_lengths(
+                documents=split_data,
+                prompt_template=prompt_template,
+                context_column_name=context_column_name,
+                tokenizer=tokenizer,
+                batch_size=batch_size,
+            ),
+            dtype=np.int64,
+            count=len(split_data),
+        )
+    logger.info(f"Tokenized {len(token_lengths)} documents in {time.time() - tokenization_start_time:.2f} seconds.")
+
+    if cache_path is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        np.save(cache_path, token_lengths)
+        logger.info(f"Saved token lengths to cache {cache_path}")
+
+    return token_lengths
+
+
+async def bounded_as_completed(awaitables: Iterable[Awaitable[T]], max_in_flight: int) -> AsyncGenerator[T, None]:
+    """
+    Runs awaitables concurrently while keeping at most `max_in_flight` of them outstanding at any time.
+
+    Unlike processing fixed batches, a new awaitable is started as soon as any running one completes, so a single
+    slow request does not leave the remaining slots idle. The input iterable is consumed lazily, which means a
+    generator of coroutines is only advanced when a slot becomes free.
+
+    Args:
+        awaitables (Iterable[Awaitable[T]]): The awaitables (typically coroutines) to run.
+        max_in_flight (int): The maximum number of awaitables running concurrently. Must be at least 1.
+
+    Yields:
+        T: The results of the awaitables, in order of completion.
+
+    Raises:
+        ValueError: If `max_in_flight` is less than 1.
+    """
+
+    if max_in_flight < 1:
+        raise ValueError("max_in_flight must be at least one")
+
+    iterator = iter(awaitables)
+    pending: Set[asyncio.Future] = set()
+    exhausted = False
+    try:
+        while True:
+            while not exhausted and len(pending) < max_in_flight:
+                try:
+                    pending.add(asyncio.ensure_future(next(iterator)))
+                except StopIteration:
+                    exhausted = True
+
+            if not pending:
+                return
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                yield task.result()
+    finally:
+        # Cancel outstanding requests if the consumer stops early or an error is raised
+        for task in pending:
+            task.cancel()
+
+
+class RequestMetricsCollector:
+    """
+    Collects the metrics of the requests to an LLM service (see `RequestMetrics`) and aggregates them.
+
+    Args:
+        name (str): Name of the service, e.g. "inference" or "judge", used as prefix of the aggregated metrics.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.requests: List[RequestMetrics] = []
+        self.start_time: float | None = None
+        self.end_time: float | None = None
+
+    def record(self, request_metrics: RequestMetrics, end_time: float):
+        self.requests.append(request_metrics)
+        request_start_time = end_time - request_metrics.response_time - request_metrics.queue_wait
+        self.start_time = request_start_time if self.start_time is None else min(self.start_time, request_start_time)
+        self.end_time = end_time if self.end_time is None else max(self.end_time, end_time)
+
+    def get_distributions(self) -> Dict[str, List[float]]:
+        """
+        Returns the queue waits, response times and generation speeds (completion tokens per second) of the
+        successful requests, e.g. for `get_score_distribution_graphs`.
+        """
+        successful_requests = [request for request in self.requests if request.error is None]
+        if not successful_requests:
+            return {}
+        return {
+            f"{self.name}_queue_wait": [request.queue_wait for request in successful_requests],
+            f"{self.name}_response_time": [request.response_time for request in successful_requests],
+            f"{self.name}_tokens_per_second": [request.tokens_per_second for request in successful_requests],
+        }
+
+    def get_summary(self) -> Dict[str, float]:
+        """
+        Returns the number of requests and errors (also per error class), token counts, overall throughput, and the
+        mean and percentiles of the distributions of `get_distributions`.
+        """
+        completion_tokens = sum(request.completion_tokens for request in self.requests)
+        elapsed_time = (self.end_time - self.start_time) if self.requests else 0.0  # type: ignore
+        summary: Dict[str, float] = {
+            f"{self.name}_requests": len(self.requests),
+            f"{self.name}_errors": sum(1 for request in self.requests if request.error is not None),
+            f"{self.name}_prompt_tokens": sum(request.prompt_tokens for request in self.requests),
+            f"{self.name}_completion_tokens": completion_tokens,
+            f"{self.name}_throughput_tokens_per_second": completion_tokens / elapsed_time if elapsed_time > 0 else 0.0,
+        }
+        for request in self.requests:
+            if request.error is not None:
+                summary[f"{self.name}_errors_{request.error}"] = (
+                    summary.get(f"{self.name}_errors_{request.error}", 0) + 1
+                )
+        for name, values in self.get_distributions().items():
+            summary[f"{name}_mean"] = float(np.mean(values))
+            for percentile in (50, 90, 99):
+                summary[f"{name}_p{percentile}"] = float(np.percentile(values, percentile))
+        return summary
+
+
 async def get_inference_result(
-    llm_client: AsyncClient, messages: List[Dict[str, str]], model_name: str, parameters: Dict[str, Any], doc_id: str
+    llm_client: AsyncClient,
+    messages: List[Dict[str, str]],
+    model_name: str,
+    parameters: Dict[str, Any],
+    doc_id: str,
+    controller: AdaptiveConcurrencyController | None = None,
+    request_metrics: RequestMetricsCollector | None = None,
+    priority: bool = False,
 ) -> Tuple[str, ChatCompletion]:
     """
     Sends a message to an LLM client to get an inference result and handles potential API errors.
@@ -213,18 +949,33 @@ async def get_inference_result(
         model_name (str): The name of the model to be used for inference.
         parameters (Dict[str, Any]): Additional parameters to configure the LLM request.
         doc_id (str): A unique identifier for the document for this inference request.
+        controller (AdaptiveConcurrencyController | None, optional): Controller limiting the concurrent requests to
+            the LLM service and retrying transient errors. If None, the request is sent right away.
+        request_metrics (RequestMetricsCollector | None, optional): Collector of the metrics of the request.
+        priority (bool, optional): Whether the request goes before the requests without priority waiting for a
+            slot of the controller. Defaults to False.
 
     Returns:
-        Tuple[str, ChatCompletion]: A tuple containing the document ID and the response from the LLM.
+        Tuple[str, ChatCompletion]: A tuple containing the document ID and the response from the LLM. API errors,
+            including transient errors that persist after all retries, are returned as an "**ERROR**" completion.
     """
 
-    try:
-        response = await llm_client.chat.completions.create(
+    issue_time = send_time = time.monotonic()
+
+    async def request() -> ChatCompletion:
+        nonlocal send_time
+        send_time = time.monotonic()
+        return await llm_client.chat.completions.create(
             messages=messages,
             model=model_name,
             **parameters,
         )
+
+    error = None
+    try:
+        response = await (controller.call(request, priority=priority) if controller is not None else request())
     except APIError as e:
+        error = type(e).__name__
         response = ChatCompletion(
             id=doc_id,
             object="chat.completion",
@@ -233,11 +984,27 @@ async def get_inference_result(
             choices=[
                 {
                     "index": 0,
-                    "message": {"role": "assistant", "content": f"**ERROR**: {str(e)}"},
+                    "message": {"role": "assistant", "content": f"{ERROR_PREFIX}: {str(e)}"},
                     "finish_reason": "length",
                 }
             ],
         )
+
+    if request_metrics is not None:
+        end_time = time.monotonic()
+        usage = getattr(response, "usage", None)
+        request_metrics.record(
+            RequestMetrics(
+                doc_id=doc_id,
+                queue_wait=send_time - issue_time,
+                response_time=end_time - send_time,
+                prompt_tokens=usage.prompt_tokens if isinstance(usage, CompletionUsage) else 0,
+                completion_tokens=usage.completion_tokens if isinstance(usage, CompletionUsage) else 0,
+                error=error,
+            ),
+            end_time=end_time,
+        )
+
     return doc_id, response
 
 
@@ -258,11 +1025,11 @@ def get_inference_result_as_dict(
         Dict[str, Any]: A dictionary containing the processed inference result, gold standard answer,
                         document ID, original document text, and prompt template.
     """
-    logger.info(f"Processing inference result for ID {doc_id}...")
+    logger.debug(f"Processing inference result for ID {doc_id}...")
 
     processed_result = handle_llm_inference_result(doc_id=doc_id, result=inference_result)
 
-    logger.info(f"Processed inference result: {processed_result}")
+    logger.debug(f"Processed inference result: {processed_result}")
 
     result = {
         "llm_inference": processed_result,
@@ -289,6 +1056,10 @@ async def run(
     batch_size: int,
     use_data_subset: int,
     dataset_split: str,
+    token_lengths: Sequence[int] | None = None,
+    skip_doc_ids: Set[str] | None = None,
+    controller: AdaptiveConcurrencyController | None = None,
+    request_metrics: RequestMetricsCollector | None = None,
 ) -> AsyncGenerator[Dict[str, Any], None]:
     """
     Executes inference on a dataset using a specified language model and yields results as they become available.
@@ -304,112 +1075,121 @@ async def run(
         model_path (str): The path to the model tokenizer for token counting.
         parameters (Dict[str, Any]): Additional parameters to configure the language model.
         max_context_size (int): The maximum number of tokens allowed in the context document.
-        batch_size (int): The size of the batches for async LLM inference.
+        batch_size (int): The maximum number of concurrent requests kept in flight to the LLM service.
         use_data_subset (int): Number of documents to use for evaluation. If > 0, limits to this many documents.
         dataset_split (str): The split of the dataset to use (e.g., "train", "test", "validation").
+        token_lengths (Sequence[int] | None, optional): Precomputed token lengths of the formatted prompts, in
+            dataset order (see `get_token_lengths`). If None, documents are tokenized in batches as they are read.
+        skip_doc_ids (Set[str] | None, optional): IDs of documents that already have results, e.g. from an
+            interrupted run (see `read_completed_doc_ids`). These documents are not sent to the LLM, but still
+            count towards `use_data_subset`.
+        controller (AdaptiveConcurrencyController | None, optional): Controller adapting the number of concurrent
+            requests to the load of the LLM service, within `batch_size`, and retrying transient errors.
+        request_metrics (RequestMetricsCollector | None, optional): Collector of the metrics of the LLM requests.
 
     Yields:
         Dict[str, Any]: A dictionary containing the inference result, gold standard answer,
                         document ID, input document, and prompt for each processed document.
 
     Notes:
-        - The function processes one batch of documents at a time, creating parallel tasks for each document in the batch.
-        - Results within a batch are yielded as soon as they become available through async processing.
-        - The next batch is not processed until all tasks in the current batch have completed or yielded results.
+        - Requests are dispatched through a sliding window: `batch_size` requests are kept outstanding at all
+          times, and a new document is sent as soon as any in-flight request completes.
+        - Results are yielded in order of completion, not in dataset order.
     """
 
-    logger.info(f"Loading tokenizer from model path: {model_path}")
-    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    if token_lengths is None:
+        logger.info(f"Loading tokenizer from model path: {model_path}")
+        tokenizer = AutoTokenizer.from_pretrained(model_path)
+        token_lengths = iter_token_lengths(  # type: ignore
+            documents=dataset[dataset_split],
+            prompt_template=prompt_template,
+            context_column_name=context_column_name,
+            tokenizer=tokenizer,
+        )
+
+    skip_doc_ids = skip_doc_ids or set()
 
     counter = 0  # Used as data sample index if there is no id_column_name, and for running a subset of the dataset
     length_exclusion_counter = 0
+    skipped_documents_counter = 0
     inference_errors_counter = 0
     processed_documents_counter = 0
 
-    # Store document and gold standard info temporarily for each batch
-    documents_map = {}
-    correct_answers_map = {}
-
     inference_start_time = time.time()
 
-    num_batches = (
-        use_data_subset // batch_size + 1 if use_data_subset > 0 else len(dataset[dataset_split]) // batch_size + 1
-    )
-    logger.info(f"Starting inference on {num_batches} batches with batch size {batch_size}...")
-    for batch_number, batch in tqdm(enumerate(batched(dataset[dataset_split], batch_size)), total=num_batches):
-        inference_tasks = []
-        batch_doc_ids = []
-
-        logger.info(f"Processing inference batch {batch_number}/{num_batches}...")
+    total_documents = use_data_subset if use_data_subset > 0 else len(dataset[dataset_split])
+
+    async def inference_request(doc_id: str, message: str, datum: Dict[str, Any]) -> Tuple[str, ChatCompletion, Dict]:
+        doc_id, inference_result = await get_inference_result(
+            llm_client=llm_client,
+            messages=[{"role": "user", "content": message}],
+            model_name=model_name,
+            parameters=parameters,
+            doc_id=doc_id,
+            controller=controller,
+            request_metrics=request_metrics,
+        )
+        return doc_id, inference_result, datum
 
-        batch_start_time = time.time()
+    def inference_requests():
+        nonlocal counter, length_exclusion_counter, skipped_documents_counter
 
-        for datum in batch:
+        for datum, token_length in zip(dataset[dataset_split], token_lengths):  # type: ignore
             if id_column_name is None or id_column_name == "":
                 doc_id = str(counter)
             else:
                 doc_id = datum[id_column_name]
-            correct_answers_map[doc_id] = datum[gold_standard_column_name]
-            documents_map[doc_id] = datum[context_column_name]
-
-            logger.info(f"Running async inference. Batch {batch_number}/{num_batches}. Document: {doc_id}")
-            batch_doc_ids.append(doc_id)
 
             # Format the prompt with the context document
-            message = prompt_template.format(context=documents_map[doc_id])
+            message = prompt_template.format(context=datum[context_column_name])
 
             # Exclude messages that are longer than the context length
-            tokens = tokenizer(message)["input_ids"]
-            if len(tokens) > max_context_size:
+            if token_length > max_context_size:
                 logger.warning(f"Message exceeds max context size of {max_context_size} tokens. Skipping...")
-                logger.warning(f"Token length: {len(tokens)}, Character length: {len(message)}")
+                logger.warning(f"Token length: {token_length}, Character length: {len(message)}")
                 length_exclusion_counter += 1
                 continue
 
-            inference_tasks.append(
-                get_inference_result(
-                    llm_client=llm_client,
-                    messages=[{"role": "user", "content": message}],
-                    model_name=model_name,
-                    parameters=parameters,
-                    doc_id=doc_id,
-                )
-            )
+            # the completion index holds string IDs, while dataset IDs may be e.g. integers
+            if str(doc_id) in skip_doc_ids:
+                logger.debug(f"Skipping document {doc_id} with existing result.")
+                skipped_documents_counter += 1
+            else:
+                logger.debug(f"Running async inference. Document: {doc_id}")
+                yield inference_request(doc_id=doc_id, message=message, datum=datum)
 
             counter += 1
             if use_data_subset > 0 and counter >= use_data_subset:
-
+                logger.info(f"Running inference for a subset of data: {use_data_subset} documents.")
                 break
 
-        # Process results as they become available
-        if inference_tasks:
-            for completed_inference_task in asyncio.as_completed(inference_tasks):
-                doc_id, inference_result = await completed_inference_task
-
-                try:
-                    result_dict = get_inference_result_as_dict(
-                        doc_id=doc_id,
-                        inference_result=inference_result,
-                        correct_answer=correct_answers_map[doc_id],
-                        document=documents_map[doc_id],
-                        prompt_template=prompt_template,
-                    )
-                    processed_documents_counter += 1
-                    yield result_dict
-                except Exception as e:
-                    logger.error(f"Error processing inference result for document {doc_id}: {str(e)}")
-                    inference_errors_counter += 1
-
-        logger.info(f"Batch {batch_number} processed in {time.time() - batch_start_time:.2f} seconds.")
-
-        if use_data_subset > 0 and counter >= use_data_subset:
-            logger.info(f"Ran inference for a subset of data: {use_data_subset} documents.")
-            break
+    logger.info(f"Starting inference on {total_documents} documents with {batch_size} concurrent requests...")
+    with tqdm(total=max(total_documents - len(skip_doc_ids), 0)) as progress_bar:
+        async for doc_id, inference_result, datum in bounded_as_completed(
+            inference_requests(), max_in_flight=batch_size
+        ):
+            progress_bar.update(1)
+            try:
+                result_dict = get_inference_result_as_dict(
+                    doc_id=doc_id,
+                    inference_result=inference_result,
+                    correct_answer=datum[gold_standard_column_name],
+                    document=datum[context_column_name],
+                    prompt_template=prompt_template,
+                )
+                processed_documents_counter += 1
+                yield result_dict
+            except Exception as e:
+                logger.error(f"Error processing inference result for document {doc_id}: {str(e)}")
+                inference_errors_counter += 1
 
     logger.info(f"Total documents in dataset: {len(dataset[dataset_split])}")
     logger.info(f"Total documents processed for evaluation: {processed_documents_counter}")
     logger.info(f"\tDocuments excluded due to length: {length_exclusion_counter}")
+    logger.info(f"\tDocuments skipped with existing results: {skipped_documents_counter}")
     logger.info(f"\tInference errors encountered: {inference_errors_counter}")
+    if controller is not None:
+        logger.info(f"\tLLM service requests: {controller}")
     logger.info(f"Total inference time: {time.time() - inference_start_time:.2f} seconds.")
 
 
@@ -434,6 +1214,15 @@ async def main(args: Namespace) -> str:
             - use_data_subset (int): Number of documents to use for evaluation. If > 0, limits to this many documents.
             - dataset_split (str): The dataset split to use (e.g., "train", "test").
             - output_dir_path (str): Directory path to save output files.
+            - token_length_cache_dir (str): Directory for the token length cache. Empty to disable caching.
+            - tokenization_batch_size (int): Number of documents tokenized per tokenizer call.
+            - tokenization_num_proc (int): Number of processes used for tokenization.
+            - resume_from (str): Results directory of an interrupted run to resume. Empty to start a new run.
+            - results_format (str): "jsonl" for sharded JSONL result files, "json" for one JSON file per document.
+            - max_connections, max_keepalive_connections, keepalive_expiry, http2, request_timeout: Connection
+              pool options of the LLM client.
+            - max_retries (int): Number of retries of requests failing with transient errors.
+            - retry_backoff (float): Delay in seconds before the first retry, doubled after every retry.
 
     Returns:
         str: The file path of the saved inference results.
@@ -451,17 +1240,44 @@ async def main(args: Namespace) -> str:
 
     parameters: dict = {}
 
-    client = get_llm_client(base_url=args.llm_base_url, port=args.llm_port, endpoint=args.llm_endpoint)
+    client = get_llm_client(
+        base_url=args.llm_base_url, port=args.llm_port, endpoint=args.llm_endpoint, **get_connection_options(args)
+    )
+    controller = AdaptiveConcurrencyController(
+        max_concurrency=args.batch_size, max_retries=args.max_retries, retry_backoff=args.retry_backoff
+    )
+    request_metrics = RequestMetricsCollector(name="inference")
 
-    results_dir_path = os.path.join(
-        args.output_dir_path,
-        f"inferences_{args.model_name}--{args.evaluation_dataset_name.replace('/', '_')}--{args.evaluation_dataset_version}--{datetime.now().isoformat()}",
+    token_lengths = get_token_lengths(
+        dataset=ds,
+        dataset_name=args.evaluation_dataset_name,
+        dataset_version=args.evaluation_dataset_version,
+        dataset_split=args.dataset_split,
+        prompt_template=prompt_template,
+        context_column_name=args.context_column_name,
+        model_path=args.model_path,
+        cache_dir=args.token_length_cache_dir,
+        batch_size=args.tokenization_batch_size,
+        num_proc=args.tokenization_num_proc,
     )
 
+    if args.resume_from:
+        results_dir_path = args.resume_from
+        logger.info(f"Resuming inference from {results_dir_path}")
+    else:
+        results_dir_path = os.path.join(
+            args.output_dir_path,
+            f"inferences_{args.model_name}--{args.evaluation_dataset_name.replace('/', '_')}--{args.evaluation_dataset_version}--{datetime.now().isoformat()}",
+        )
+
     if not os.path.exists(results_dir_path):
         os.makedirs(results_dir_path)
     logger.info(f"Results directory created at {results_dir_path}")
 
+    inference_sink = get_result_sink(
+        results_format=args.results_format, output_dir_path=results_dir_path, subdir="inferences"
+    )
+
     async for inference_result in run(
         dataset=ds,
         prompt_template=prompt_template,
@@ -476,15 +1292,26 @@ async def main(args: Namespace) -> str:
         batch_size=args.batch_size,
         use_data_subset=args.use_data_subset,
         dataset_split=args.dataset_split,
+        token_lengths=token_lengths,
+        skip_doc_ids=read_completed_doc_ids(output_dir_path=results_dir_path, subdir="inferences"),
+        controller=controller,
+        request_metrics=request_metrics,
     ):
         logger.info(f"Got inference result for document {inference_result['context_document_id']}")
-        logger.info(f"Inference result: {inference_result}")
+        logger.debug(f"Inference result: {inference_result}")
 
-        # Save the inference result to a file
-        save_local_results(result=inference_result, output_dir_path=results_dir_path, subdir="inferences")
+        # Save the inference result to the results sink
+        inference_sink.write(inference_result)
 
         logger.info(f"Saved inference result for document {inference_result['context_document_id']}")
 
+    inference_sink.close()
+
+    request_metrics_summary = request_metrics.get_summary()
+    logger.info(f"Request metrics: {json.dumps(request_metrics_summary)}")
+    with open(os.path.join(results_dir_path, REQUEST_METRICS_FILE_NAME), "w") as f:
+        json.dump(request_metrics_summary, f, indent=4)
+
     return results_dir_path
 
 
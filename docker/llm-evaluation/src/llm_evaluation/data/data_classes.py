@@ -1,7 +1,7 @@
 import json
 import os
-from dataclasses import dataclass
-from typing import Dict, List
+from dataclasses import dataclass, field
+from typing import Any, Dict, List
 
 import numpy as np
 from dataclasses_json import dataclass_json
@@ -19,14 +19,15 @@ class EvaluationScores:
     f1_list_bert: List[float]
     bleu_score: float
     accuracy: float
+    additional_scores: Dict[str, Any] = field(default_factory=dict)
 
 
 @dataclass_json
 @dataclass
 class EvaluationResults:
-    full_prompts: List[str]
     generations: List[str]
     scores: EvaluationScores
+    metric_timings: Dict[str, float] = field(default_factory=dict)
 
     def get_summary_scores_dict(self) -> Dict[str, float]:
         return {
@@ -35,6 +36,11 @@ class EvaluationResults:
             "mean_f1": self.scores.f1_avg_bert,
             "bleu_score": self.scores.bleu_score,
             "accuracy": self.scores.accuracy,
+            **{
+                name: score
+                for name, score in self.scores.additional_scores.items()
+                if isinstance(score, (int, float, np.number))
+            },
         }
 
     def serializable_all_scores_dict(self) -> Dict[str, List[float]]:
@@ -45,6 +51,41 @@ class EvaluationResults:
         }
 
 
+@dataclass_json
+@dataclass
+class UploadStats:
+    uploaded_files: int = 0
+    failed_files: int = 0
+    retries: int = 0
+    uploaded_bytes: int = 0
+    upload_time: float = 0.0
+
+    @property
+    def throughput_mb_per_second(self) -> float:
+        return self.uploaded_bytes / 1e6 / self.upload_time if self.upload_time > 0 else 0.0
+
+    def __str__(self):
+        return (
+            f"Uploaded {self.uploaded_files} files ({self.uploaded_bytes / 1e6:.2f} MB) in {self.upload_time:.2f} "
+            f"seconds ({self.throughput_mb_per_second:.2f} MB/s), {self.failed_files} failed, {self.retries} retries"
+        )
+
+
+@dataclass_json
+@dataclass
+class RequestMetrics:
+    doc_id: str
+    queue_wait: float  # seconds from the request being issued to its (last) attempt being sent
+    response_time: float  # seconds from the (last) attempt being sent to its response
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    error: str | None = None  # class name of the error, if the request failed
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.completion_tokens / self.response_time if self.response_time > 0 else 0.0
+
+
 @dataclass_json
 @dataclass
 class JudgeResult:
@@ -1,10 +1,12 @@
 import asyncio
 import re
 import time
-from typing import Any, AsyncGenerator, Dict, List, Optional
+from typing import Any, AsyncGenerator, AsyncIterable, Dict, List, Optional
 
 from llm_evaluation import logger
 from llm_evaluation.call_inference_container.call_inference_container import (
+    AdaptiveConcurrencyController,
+    RequestMetricsCollector,
     batched_async,
     get_inference_result,
     handle_llm_inference_result,
@@ -12,6 +14,34 @@ from llm_evaluation.call_inference_container.call_inference_container import (
 from llm_evaluation.data.data_classes import JudgeResult
 from openai import AsyncClient
 
+GRADE_REGEX = "Grade: \\[\\[([1-9]|10)\\]\\]"  # We may want to parameterize this
+
+# Request header naming the document a judge request belongs to. Routers in front of several judge replicas can be
+# configured to route on it, so both steps of a judgment land on the replica that holds the step-1 prefix in its cache
+SESSION_HEADER = "X-Session-Id"
+
+
+def order_inferences_by_prompt_prefix(
+    inferences_data: List[Dict[str, Any]], judge_prompt_step1_template: str
+) -> List[Dict[str, Any]]:
+    """
+    Orders inference results by their step-1 judge prompt, so that judge requests sharing a prompt prefix, e.g.
+    answers to the same context document, are sent together and reuse the prefix cache of the judge server.
+
+    Args:
+        inferences_data (List[Dict[str, Any]]): The inference results to be judged.
+        judge_prompt_step1_template (str): Template for the first step of the judge prompt.
+
+    Returns:
+        List[Dict[str, Any]]: The inference results, sorted by step-1 judge prompt.
+    """
+    return sorted(
+        inferences_data,
+        key=lambda inference_result: judge_prompt_step1_template.format(
+            context=inference_result["context_document"], answer=inference_result["llm_inference"]
+        ),
+    )
+
 
 async def run_2step_judge(
     inference_result: Dict[str, Any],
@@ -20,6 +50,9 @@ async def run_2step_judge(
     grade_regex: str,
     judge_client: AsyncClient,
     judge_model_name: str,
+    controller: AdaptiveConcurrencyController | None = None,
+    session_hint: bool = False,
+    request_metrics: RequestMetricsCollector | None = None,
 ) -> Optional[JudgeResult]:
     """
     Executes a two-step judging process on a single inference result.
@@ -31,6 +64,10 @@ async def run_2step_judge(
         grade_regex (str): Regular expression to extract the grade from the judge's response.
         judge_client (Any): The client used to interact with the judge model.
         judge_model_name (str): The name of the judge model.
+        controller (AdaptiveConcurrencyController | None, optional): Controller limiting the concurrent requests to
+            the judge service and retrying transient errors.
+        session_hint (bool, optional): Whether to tag both requests with the document ID (see `SESSION_HEADER`).
+        request_metrics (RequestMetricsCollector | None, optional): Collector of the metrics of both requests.
 
     Returns:
         Optional[JudgeResult]: A JudgeResult object containing the evaluation results, or None if an error occurred.
@@ -40,7 +77,10 @@ async def run_2step_judge(
         context=inference_result["context_document"], answer=inference_result["llm_inference"]
     )
     explanation_messages = [{"role": "user", "content": explanation_message}]
-    parameters: Dict[str, Any] = {}
+    request_parameters: Dict[str, Any] = {}
+    if session_hint:
+        request_parameters["extra_headers"] = {SESSION_HEADER: str(inference_result["context_document_id"])}
+    parameters: Dict[str, Any] = {**request_parameters}
 
     doc_id, judge_explanation_response = await get_inference_result(
         llm_client=judge_client,
@@ -48,25 +88,32 @@ async def run_2step_judge(
         model_name=judge_model_name,
         parameters=parameters,
         doc_id=inference_result["context_document_id"],
+        controller=controller,
+        request_metrics=request_metrics,
     )
     judge_explanation = handle_llm_inference_result(doc_id=doc_id, result=judge_explanation_response)
     if judge_explanation is None or judge_explanation.startswith("**ERROR**"):
         logger.error(f"Error in judge explanation inference: {judge_explanation}")
         return None
 
-    # JUDGE STEP 2: grade request
+    # JUDGE STEP 2: grade request, sent right after step 1 and extending its conversation, so the judge server can
+    # reuse the cached prefix of the step-1 prompt and explanation. It takes the next free slot of the controller
+    # before the step-1 requests of other documents, which would otherwise evict that prefix
     grade_messages = explanation_messages + [
         {"role": "assistant", "content": judge_explanation},
         {"role": "user", "content": judge_prompt_step2_template},
     ]
     # Set guided_regex to regular expression
-    parameters = {"extra_body": {"guided_regex": grade_regex}}
+    parameters = {**request_parameters, "extra_body": {"guided_regex": grade_regex}}
     doc_id, judge_grade_inference_response = await get_inference_result(
         llm_client=judge_client,
         messages=grade_messages,
         model_name=judge_model_name,
         parameters=parameters,
         doc_id=inference_result["context_document_id"],
+        controller=controller,
+        request_metrics=request_metrics,
+        priority=True,
     )
     judge_grade_inference = handle_llm_inference_result(doc_id=doc_id, result=judge_grade_inference_response)
     if judge_grade_inference is None or judge_grade_inference.startswith("**ERROR**"):
@@ -98,6 +145,9 @@ async def run_2step_judge_on_inferences(
     judge_client: AsyncClient,
     batch_size: int,
     output_dir_path: str,
+    controller: AdaptiveConcurrencyController | None = None,
+    prefix_scheduling: bool = False,
+    request_metrics: RequestMetricsCollector | None = None,
 ) -> AsyncGenerator[JudgeResult, None]:
     """
     Asynchronously evaluates a set of inferences using a two-step judging process.
@@ -110,12 +160,21 @@ async def run_2step_judge_on_inferences(
         judge_client (AsyncClient): An instance of the judge client to interact with the model.
         batch_size (int): The number of inferences to process in each batch.
         output_dir_path (str): Directory path where the evaluation results will be saved.
+        controller (AdaptiveConcurrencyController | None, optional): Controller limiting the concurrent requests to
+            the judge service and retrying transient errors.
+        prefix_scheduling (bool, optional): Whether to schedule judge requests for prefix cache reuse: inferences
+            are judged in order of their step-1 prompt (see `order_inferences_by_prompt_prefix`), and the requests
+            of each document carry a session hint (see `SESSION_HEADER`). Defaults to False.
+        request_metrics (RequestMetricsCollector | None, optional): Collector of the metrics of the judge requests.
 
     Yields:
         JudgeResult: The result of the evaluation for each inference.
     """
 
-    grade_regex = "Grade: \\[\\[([1-9]|10)\\]\\]"  # We may want to parameterize this
+    grade_regex = GRADE_REGEX
+
+    if prefix_scheduling:
+        inferences_data = order_inferences_by_prompt_prefix(inferences_data, judge_prompt_step1_template)
 
     judged_documents_counter = 0
     judge_start_time = time.time()
@@ -131,7 +190,7 @@ async def run_2step_judge_on_inferences(
         batch_start_time = time.time()
         for i, inference_result in enumerate(inferences_batch):
 
-            logger.info(f"Judging inference {i}: {inference_result['llm_inference']}")
+            logger.debug(f"Judging inference {i}: {inference_result['llm_inference']}")
             judge_tasks.append(
                 run_2step_judge(
                     inference_result=inference_result,
@@ -140,6 +199,9 @@ async def run_2step_judge_on_inferences(
                     grade_regex=grade_regex,
                     judge_client=judge_client,
                     judge_model_name=judge_model_name,
+                    controller=controller,
+                    session_hint=prefix_scheduling,
+                    request_metrics=request_metrics,
                 )
             )
 
@@ -157,4 +219,117 @@ async def run_2step_judge_on_inferences(
     logger.info(f"Total documents to judge: {len(inferences_data)}")
     logger.info(f"Total documents judged {judged_documents_counter}")
     logger.info(f"Total judge errors: {judge_errors_counter}")
+    if controller is not None:
+        logger.info(f"Judge service requests: {controller}")
     logger.info(f"Total judge time: {time.time() - judge_start_time:.2f} seconds.")
+
+
+async def run_2step_judge_on_inference_stream(
+    inference_stream: AsyncIterable[Dict[str, Any]],
+    judge_model_name: str,
+    judge_prompt_step1_template: str,
+    judge_prompt_step2_template: str,
+    judge_client: AsyncClient,
+    max_concurrent_judgments: int,
+    controller: AdaptiveConcurrencyController | None = None,
+    session_hint: bool = False,
+    request_metrics: RequestMetricsCollector | None = None,
+) -> AsyncGenerator[JudgeResult, None]:
+    """
+    Judges inference results as soon as they arrive from an asynchronous stream of inferences.
+
+    The inference stream is consumed by a feeder task that places every inference result on a queue, so the
+    candidate LLM is never throttled by the judge. A fixed pool of `max_concurrent_judgments` workers takes
+    inferences from the queue and runs the two-step judging process on them, so inference and judging overlap
+    and each model is kept busy with its own concurrency limit.
+
+    Args:
+        inference_stream (AsyncIterable[Dict[str, Any]]): Asynchronous stream of inference result dictionaries,
+            e.g. the output of `call_inference_container.run`.
+        judge_model_name (str): The name of the judge model to be used for evaluation.
+        judge_prompt_step1_template (str): Template for the first step of the judge prompt (explanation request).
+        judge_prompt_step2_template (str): Template for the second step of the judge prompt (grade request).
+        judge_client (AsyncClient): An instance of the judge client to interact with the model.
+        max_concurrent_judgments (int): The maximum number of documents judged concurrently.
+        controller (AdaptiveConcurrencyController | None, optional): Controller adapting the number of concurrent
+            requests to the load of the judge service and retrying transient errors.
+        session_hint (bool, optional): Whether to tag the requests of each document with its ID (see
+            `SESSION_HEADER`). Inferences are judged in order of arrival, so they cannot be ordered by prompt prefix.
+        request_metrics (RequestMetricsCollector | None, optional): Collector of the metrics of the judge requests.
+
+    Yields:
+        JudgeResult: The result of the evaluation for each inference, in order of completion.
+    """
+
+    if max_concurrent_judgments < 1:
+        raise ValueError("max_concurrent_judgments must be at least one")
+
+    inference_queue: asyncio.Queue = asyncio.Queue()
+    judge_results_queue: asyncio.Queue = asyncio.Queue()
+    worker_done = object()
+
+    received_inferences_counter = 0
+    judged_documents_counter = 0
+    judge_errors_counter = 0
+    judge_start_time = time.time()
+
+    async def feed_inferences():
+        nonlocal received_inferences_counter
+        try:
+            async for inference_result in inference_stream:
+                received_inferences_counter += 1
+                await inference_queue.put(inference_result)
+        finally:
+            # One stop signal per worker, also when the inference stream fails
+            for _ in range(max_concurrent_judgments):
+                await inference_queue.put(None)
+
+    async def judge_worker():
+        try:
+            while (inference_result := await inference_queue.get()) is not None:
+                judge_result = await run_2step_judge(
+                    inference_result=inference_result,
+                    judge_prompt_step1_template=judge_prompt_step1_template,
+                    judge_prompt_step2_template=judge_prompt_step2_template,
+                    grade_regex=GRADE_REGEX,
+                    judge_client=judge_client,
+                    judge_model_name=judge_model_name,
+                    controller=controller,
+                    session_hint=session_hint,
+                    request_metrics=request_metrics,
+                )
+                await judge_results_queue.put(judge_result)
+        finally:
+            await judge_results_queue.put(worker_done)
+
+    feeder_task = asyncio.create_task(feed_inferences())
+    worker_tasks = [asyncio.create_task(judge_worker()) for _ in range(max_concurrent_judgments)]
+
+    try:
+        running_workers = max_concurrent_judgments
+        while running_workers > 0:
+            judge_result = await judge_results_queue.get()
+            if judge_result is worker_done:
+                running_workers -= 1
+            elif judge_result is None:
+                judge_errors_counter += 1
+            else:
+                judged_documents_counter += 1
+                yield judge_result
+
+        # Propagate errors raised by the judge workers first: with no worker left, the feeder would keep waiting for
+        # the inference stream, and it is cancelled below instead
+        for worker_task in worker_tasks:
+            await worker_task
+        # Propagate errors raised by the inference stream
+        await feeder_task
+    finally:
+        for task in [feeder_task, *worker_tasks]:
+            task.cancel()
+
+    logger.info(f"Total documents to judge: {received_inferences_counter}")
+    logger.info(f"Total documents judged {judged_documents_counter}")
+    logger.info(f"Total judge errors: {judge_errors_counter}")
+    if controller is not None:
+        logger.info(f"Judge service requests: {controller}")
+    logger.info(f"Total inference and judge time: {time.time() - judge_start_time:.2f} seconds.")
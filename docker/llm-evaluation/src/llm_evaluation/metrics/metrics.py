@@ -1,12 +1,140 @@
-from typing import List, Tuple
+import hashlib
+import os
+import sqlite3
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Sequence, Tuple
 
 import numpy as np
-from evaluate import load
+from evaluate import EvaluationModule, load
+from llm_evaluation import logger
 from llm_evaluation.metrics.utils import convert_negatives_to_zero
 
 
+@dataclass
+class Metric:
+    """
+    A metric computed by `run_metrics_evaluation.compute_scores`.
+
+    Attributes:
+        name (str): The name of the metric.
+        compute (Callable[..., Any]): Function called with `predictions` and `references` keyword arguments.
+            CPU-bound metrics are computed in worker processes, so their compute function must be picklable, i.e.
+            defined at module level.
+        cpu_bound (bool): Whether the metric is pure-CPU. CPU-bound metrics are computed in a process pool, while
+            the other metrics, e.g. BERTScore with its model pass, are computed in the main process.
+    """
+
+    name: str
+    compute: Callable[..., Any]
+    cpu_bound: bool = True
+
+
+METRIC_REGISTRY: Dict[str, Metric] = {}
+
+
+def register_metric(name: str, cpu_bound: bool = True) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
+    """
+    Decorator registering a metric function, so that it is computed together with the other registered metrics.
+
+    Args:
+        name (str): The name of the metric.
+        cpu_bound (bool, optional): Whether the metric is pure-CPU and can be computed in a worker process.
+            Defaults to True.
+
+    Returns:
+        Callable[[Callable[..., Any]], Callable[..., Any]]: A decorator returning the metric function unchanged.
+    """
+
+    def decorator(compute: Callable[..., Any]) -> Callable[..., Any]:
+        METRIC_REGISTRY[name] = Metric(name=name, compute=compute, cpu_bound=cpu_bound)
+        return compute
+
+    return decorator
+
+
+@lru_cache(maxsize=None)
+def load_metric(name: str) -> EvaluationModule:
+    """
+    Loads an evaluation metric once per process.
+
+    Metrics are kept loaded between calls, so the BERTScore scorer model, which `evaluate` caches on the metric
+    instance, is only instantiated on the first computation.
+
+    Args:
+        name (str): The name of the metric, e.g. "bertscore", "bleu" or "exact_match".
+
+    Returns:
+        EvaluationModule: The loaded metric.
+    """
+    logger.info(f"Loading metric {name}")
+    return load(name)
+
+
+def set_torch_num_threads(num_threads: int):
+    """
+    Sets the number of threads used by PyTorch for intra-op parallelism, e.g. for BERTScore on CPU-only nodes.
+
+    Args:
+        num_threads (int): The number of threads. 0 keeps the PyTorch default.
+    """
+    if num_threads > 0:
+        import torch
+
+        logger.info(f"Setting the number of PyTorch threads to {num_threads}")
+        torch.set_num_threads(num_threads)
+
+
+class ScoreCache:
+    """
+    On-disk cache of per-sample scores, keyed by a hash of the metric configuration, prediction and reference.
+
+    Scores are stored in a SQLite database, so re-running a metric over mostly unchanged generations only computes
+    the scores of new (prediction, reference) pairs.
+    """
+
+    def __init__(self, cache_path: str):
+        if os.path.dirname(cache_path):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS scores (key TEXT PRIMARY KEY, scores TEXT NOT NULL)")
+
+    @staticmethod
+    def get_key(metric_config: str, prediction: str, reference: str) -> str:
+        return hashlib.sha256("\0".join([metric_config, prediction, reference]).encode("utf-8")).hexdigest()
+
+    def get(self, keys: Sequence[str]) -> Dict[str, Tuple[float, ...]]:
+        cached_scores = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i : i + 500]
+            rows = self.connection.execute(
+                f"SELECT key, scores FROM scores WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            )
+            for key, scores in rows:
+                cached_scores[key] = tuple(float(score) for score in scores.split(","))
+        return cached_scores
+
+    def set(self, scores: Dict[str, Tuple[float, ...]]):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO scores (key, scores) VALUES (?, ?)",
+                [(key, ",".join(repr(score) for score in values)) for key, values in scores.items()],
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+@register_metric("bertscore", cpu_bound=False)
 def compute_bertscore(
-    predictions: List[str], references: List[str], language: str = "en"
+    predictions: List[str],
+    references: List[str],
+    language: str = "en",
+    score_cache_path: str | None = None,
+    chunk_size: int = 0,
+    batch_size: int = 64,
+    device: str | None = None,
 ) -> Tuple[List[float], List[float], List[float]]:
     """
     Computes the BERTScore for a set of predictions and references.
@@ -15,6 +143,14 @@ def compute_bertscore(
         predictions (List[str]): A list of predicted text strings.
         references (List[str]): A list of reference text strings.
         language (str, optional): The language of the text. Defaults to "en".
+        score_cache_path (str | None, optional): Path of an on-disk score cache. Scores of (prediction, reference)
+            pairs found in the cache are not recomputed. If None or empty, no cache is used.
+        chunk_size (int, optional): Number of pairs scored per call to the scorer. Scores are written into
+            preallocated arrays (and the score cache) after every chunk, which bounds memory use and reports
+            progress. 0 (default) scores all pairs in a single call.
+        batch_size (int, optional): Batch size of the BERTScore model forward passes. Defaults to 64.
+        device (str | None, optional): Device of the BERTScore model, e.g. "cuda" or "cpu". Defaults to CUDA, if
+            available.
 
     Returns:
         Tuple[float, float, float, List[float]]: A tuple containing:
@@ -23,18 +159,58 @@ def compute_bertscore(
             - f1_bert (float): The average F1 score.
             - f1_list (List[float]): A list of F1 scores for each prediction-reference pair.
     """
-    bertscore = load("bertscore")
-    results = bertscore.compute(
-        predictions=predictions, references=references, lang=language, rescale_with_baseline=True
-    )  # Defaults to CUDA, if available
+    bertscore = load_metric("bertscore")
+
+    score_cache = ScoreCache(score_cache_path) if score_cache_path else None
+    keys = [
+        ScoreCache.get_key(f"bertscore:{language}:rescale_with_baseline", prediction, reference)
+        for prediction, reference in zip(predictions, references)
+    ]
+
+    scores = np.empty((len(keys), 3), dtype=float)
+    cached_scores = score_cache.get(keys) if score_cache is not None else {}
+    missing_indices = []
+    for i, key in enumerate(keys):
+        if key in cached_scores:
+            scores[i] = cached_scores[key]
+        else:
+            missing_indices.append(i)
+    del cached_scores
+    logger.info(f"BERTScore: {len(keys) - len(missing_indices)} cached scores, computing {len(missing_indices)}")
+
+    scored_pairs_counter = 0
+    chunk_size = chunk_size or max(len(missing_indices), 1)
+    for start in range(0, len(missing_indices), chunk_size):
+        chunk_indices = missing_indices[start : start + chunk_size]
+        results = bertscore.compute(
+            predictions=[predictions[i] for i in chunk_indices],
+            references=[references[i] for i in chunk_indices],
+            lang=language,
+            rescale_with_baseline=True,
+            batch_size=batch_size,
+            device=device,
+        )  # Defaults to CUDA, if available
+        chunk_scores = np.column_stack([results["precision"], results["recall"], results["f1"]])
+        scores[list(chunk_indices)] = chunk_scores
+        if score_cache is not None:
+            score_cache.set(
+                {keys[i]: tuple(pair_scores) for i, pair_scores in zip(chunk_indices, chunk_scores.tolist())}
+            )
+
+        scored_pairs_counter += len(chunk_indices)
+        logger.info(f"BERTScore: scored {scored_pairs_counter}/{len(missing_indices)} pairs")
+
+    if score_cache is not None:
+        score_cache.close()
 
-    precision_list = convert_negatives_to_zero(array=np.array(results["precision"]))
-    recall_list = convert_negatives_to_zero(array=np.array(results["recall"]))
-    f1_list = convert_negatives_to_zero(array=np.array(results["f1"]))
+    precision_list = convert_negatives_to_zero(array=scores[:, 0])
+    recall_list = convert_negatives_to_zero(array=scores[:, 1])
+    f1_list = convert_negatives_to_zero(array=scores[:, 2])
 
     return precision_list, recall_list, f1_list
 
 
+@register_metric("exact_match")
 def compute_exact_match(
     predictions: List[str], references: List[str], ignore_case: bool = True, ignore_punctuation: bool = True
 ) -> float:
@@ -50,7 +226,7 @@ def compute_exact_match(
     Returns:
         float: The exact match accuracy as a percentage (0.0 to 100.0).
     """
-    exact_match_metric = load("exact_match")
+    exact_match_metric = load_metric("exact_match")
     results = exact_match_metric.compute(
         predictions=predictions, references=references, ignore_case=ignore_case, ignore_punctuation=ignore_punctuation
     )
@@ -59,6 +235,7 @@ def compute_exact_match(
     return accuracy
 
 
+@register_metric("bleu")
 def compute_bleu_score(predictions: List[str], references: List[str]) -> float:
     """
     Computes the BLEU (Bilingual Evaluation Understudy) score for a set of predictions
@@ -73,7 +250,7 @@ def compute_bleu_score(predictions: List[str], references: List[str]) -> float:
                closer matches between predictions and references.
     """
 
-    bleu = load("bleu")
+    bleu = load_metric("bleu")
     results = bleu.compute(predictions=predictions, references=references)
     bleu_score = results["bleu"]
 
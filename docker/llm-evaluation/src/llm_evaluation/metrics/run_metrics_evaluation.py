@@ -1,66 +1,187 @@
 import glob
-import json
+import itertools
 import os
 import time
 from argparse import Namespace
-from typing import Any, Dict, List
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Sequence, Tuple
 
-import jsonlines
 import numpy as np
 from llm_evaluation import logger
 from llm_evaluation.argument_parsers import get_metrics_parser
-from llm_evaluation.call_inference_container.call_inference_container import save_local_results
+from llm_evaluation.call_inference_container.call_inference_container import (
+    MANIFEST_FILE_NAME,
+    is_error_result,
+    read_manifest,
+)
 from llm_evaluation.data.data_classes import EvaluationResults, EvaluationScores
-from llm_evaluation.metrics.metrics import compute_bertscore, compute_bleu_score, compute_exact_match
-from llm_evaluation.metrics.utils import get_score_distribution_graphs
+from llm_evaluation.metrics.metrics import METRIC_REGISTRY, set_torch_num_threads
+from llm_evaluation.metrics.utils import get_score_distribution_graphs, iter_jsonl_data, json_loads, project_fields
 
+# Fields of inference results used by the metrics evaluation, e.g. without the context documents
+METRICS_FIELDS = ("context_document_id", "llm_inference", "gold_standard_result")
 
-def compute_scores(predictions: List[str], references: List[str]) -> EvaluationScores:
+
+def get_bertscore_options(args: Namespace) -> Dict[str, Any]:
     """
-    Computes evaluation metrics (BERTScore, BLEU score, and Exact Match) for the given predictions and references.
+    Returns the keyword arguments of `compute_bertscore` set by the command line arguments.
 
     Args:
-        predictions (List[str]): A list of predicted strings.
-        references (List[str]): A list of reference strings.
+        args (Namespace): Command line arguments with `bertscore_chunk_size`, `bertscore_batch_size` and
+            `bertscore_device` attributes.
 
     Returns:
-        EvaluationScores: An object containing the computed scores for precision, recall, F1 (BERTScore),
-                          BLEU score, and Exact Match accuracy.
+        Dict[str, Any]: Keyword arguments for `compute_bertscore`.
     """
+    return {
+        "chunk_size": args.bertscore_chunk_size,
+        "batch_size": args.bertscore_batch_size,
+        "device": args.bertscore_device or None,
+    }
 
-    bert_score_start_time = time.time()
 
-    precision_list_bert, recall_list_bert, f1_list_bert = compute_bertscore(
-        predictions=predictions, references=references
-    )
+def timed_call(compute: Callable[..., Any], **kwargs) -> Tuple[Any, float]:
+    """
+    Calls a metric function and measures its duration, also when called in a worker process.
 
-    precision_avg_bert = round(np.average(precision_list_bert), 4)
-    recall_avg_bert = round(np.average(recall_list_bert), 4)
-    f1_avg_bert = round(np.average(f1_list_bert), 4)
+    Args:
+        compute (Callable[..., Any]): The metric function.
+        **kwargs: Keyword arguments of the metric function.
 
-    logger.info(f"BERT-score computation took {time.time() - bert_score_start_time:.2f} seconds")
+    Returns:
+        Tuple[Any, float]: The result of the metric function and its duration in seconds.
+    """
+    start_time = time.time()
+    result = compute(**kwargs)
+    return result, time.time() - start_time
+
+
+def run_metrics(
+    predictions: List[str],
+    references: List[str],
+    metric_names: List[str] | None = None,
+    metric_options: Dict[str, Dict[str, Any]] | None = None,
+    metric_workers: int | None = None,
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """
+    Computes registered metrics concurrently.
 
-    bleu_score_start_time = time.time()
+    CPU-bound metrics are submitted to a process pool first, so they run while the other metrics, e.g. the BERTScore
+    model pass, are computed in the main process.
 
-    bleu_score = compute_bleu_score(predictions=predictions, references=references)
+    Args:
+        predictions (List[str]): A list of predicted strings.
+        references (List[str]): A list of reference strings.
+        metric_names (List[str] | None, optional): Names of the metrics in `METRIC_REGISTRY` to compute. If None, all
+            registered metrics are computed.
+        metric_options (Dict[str, Dict[str, Any]] | None, optional): Additional keyword arguments of the metric
+            functions, by metric name.
+        metric_workers (int | None, optional): Number of worker processes for CPU-bound metrics. If None, one per
+            CPU-bound metric. 0 computes all metrics sequentially in the main process.
+
+    Returns:
+        Tuple[Dict[str, Any], Dict[str, float]]: The results and the durations in seconds, by metric name.
+    """
+    metrics = [METRIC_REGISTRY[name] for name in (metric_names if metric_names is not None else METRIC_REGISTRY)]
+    metric_options = metric_options or {}
+    cpu_metrics = [metric for metric in metrics if metric.cpu_bound]
+    if metric_workers is None:
+        metric_workers = len(cpu_metrics)
 
-    logger.info(f"BLEU score computation took {time.time() - bleu_score_start_time:.2f} seconds")
+    results: Dict[str, Any] = {}
+    timings: Dict[str, float] = {}
 
-    exact_match_start_time = time.time()
+    def record(name: str, result: Any, duration: float):
+        results[name] = result
+        timings[name] = duration
+        logger.info(f"{name} computation took {duration:.2f} seconds")
 
-    accuracy = compute_exact_match(predictions=predictions, references=references)
+    executor = ProcessPoolExecutor(max_workers=metric_workers) if cpu_metrics and metric_workers > 0 else None
+    try:
+        futures: Dict[str, Future] = {}
+        if executor is not None:
+            for metric in cpu_metrics:
+                futures[metric.name] = executor.submit(
+                    timed_call,
+                    metric.compute,
+                    predictions=predictions,
+                    references=references,
+                    **metric_options.get(metric.name, {}),
+                )
+
+        for metric in metrics:
+            if metric.name not in futures:
+                record(
+                    metric.name,
+                    *timed_call(
+                        metric.compute,
+                        predictions=predictions,
+                        references=references,
+                        **metric_options.get(metric.name, {}),
+                    ),
+                )
+
+        for name, future in futures.items():
+            record(name, *future.result())
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    return {name: results[name] for name in (metric.name for metric in metrics)}, timings
+
+
+def compute_scores(
+    predictions: List[str],
+    references: List[str],
+    score_cache_path: str | None = None,
+    bertscore_options: Dict[str, Any] | None = None,
+    metric_workers: int | None = None,
+) -> Tuple[EvaluationScores, Dict[str, float]]:
+    """
+    Computes evaluation metrics (BERTScore, BLEU score, Exact Match, and any other metric in `METRIC_REGISTRY`) for
+    the given predictions and references.
 
-    logger.info(f"Exact match computation took {time.time() - exact_match_start_time:.2f} seconds")
+    Args:
+        predictions (List[str]): A list of predicted strings.
+        references (List[str]): A list of reference strings.
+        score_cache_path (str | None, optional): Path of the on-disk BERTScore cache. If None or empty, no cache is used.
+        bertscore_options (Dict[str, Any] | None, optional): Chunk size, batch size and device passed on to
+            `compute_bertscore` (see `get_bertscore_options`).
+        metric_workers (int | None, optional): Number of worker processes for CPU-bound metrics (see `run_metrics`).
 
-    return EvaluationScores(
-        precision_avg_bert=precision_avg_bert,
-        recall_avg_bert=recall_avg_bert,
-        f1_avg_bert=f1_avg_bert,
-        precision_list_bert=precision_list_bert,
-        recall_list_bert=recall_list_bert,
-        f1_list_bert=f1_list_bert,
-        bleu_score=bleu_score,
-        accuracy=accuracy,
+    Returns:
+        Tuple[EvaluationScores, Dict[str, float]]: An object containing the computed scores for precision, recall,
+            F1 (BERTScore), BLEU score, Exact Match accuracy and the other registered metrics, and the duration of
+            each metric computation in seconds.
+    """
+
+    results, timings = run_metrics(
+        predictions=predictions,
+        references=references,
+        metric_options={"bertscore": {"score_cache_path": score_cache_path, **(bertscore_options or {})}},
+        metric_workers=metric_workers,
+    )
+
+    precision_list_bert, recall_list_bert, f1_list_bert = results.pop("bertscore")
+
+    precision_avg_bert = round(np.average(precision_list_bert), 4)
+    recall_avg_bert = round(np.average(recall_list_bert), 4)
+    f1_avg_bert = round(np.average(f1_list_bert), 4)
+
+    return (
+        EvaluationScores(
+            precision_avg_bert=precision_avg_bert,
+            recall_avg_bert=recall_avg_bert,
+            f1_avg_bert=f1_avg_bert,
+            precision_list_bert=precision_list_bert,
+            recall_list_bert=recall_list_bert,
+            f1_list_bert=f1_list_bert,
+            bleu_score=results.pop("bleu"),
+            accuracy=results.pop("exact_match"),
+            additional_scores=results,
+        ),
+        timings,
     )
 
 
@@ -86,18 +207,105 @@ def get_bert_score_distribution_graphs(scores: EvaluationScores) -> Dict[str, st
     return get_score_distribution_graphs(metrics)
 
 
-def read_local_inference_data(input_path: str) -> List[Dict[str, Any]]:
+def get_inference_data_files(input_dir_path: str) -> List[str]:
     """
-    Reads inference data from a file or directory containing JSON/JSONL files.
+    Lists the JSON/JSONL files of a directory of inference data.
+
+    Directories written by `JsonlResultSink` are listed through their manifest: the shards listed in it come in
+    order, after any JSON files of documents saved one file per document.
 
     Args:
-        input_path (str): Path to either a JSONL file or a directory containing JSON/JSONL files.
+        input_dir_path (str): Path of the directory.
 
     Returns:
-        List[Dict[str, Any]]: A list of dictionaries, where each dictionary represents a data point.
+        List[str]: Paths of the JSON/JSONL files.
+    """
+    json_files = [
+        file_path
+        for file_path in glob.glob(os.path.join(input_dir_path, "*.json"))
+        if os.path.basename(file_path) != MANIFEST_FILE_NAME
+    ]
+    manifest = read_manifest(input_dir_path)
+    if manifest is not None:
+        jsonl_files = [os.path.join(input_dir_path, shard["file_name"]) for shard in manifest["shards"]]
+    else:
+        jsonl_files = glob.glob(os.path.join(input_dir_path, "*.jsonl"))
+    return json_files + jsonl_files
+
+
+def iter_inference_data_file(file_path: str, fields: Sequence[str] | None = None) -> Iterator[Dict[str, Any]]:
+    """
+    Reads the records of a JSON or JSONL file. Invalid JSON files are logged and skipped, as are invalid lines of
+    JSONL files.
+
+    Args:
+        file_path (str): Path of the file.
+        fields (Sequence[str] | None, optional): The fields to keep of each record. If None, all fields are kept.
+
+    Yields:
+        Dict[str, Any]: The records of the file.
+    """
+    if file_path.endswith(".json"):
+        try:
+            with open(file_path, "rb") as f:
+                data = json_loads(f.read())
+        except ValueError:
+            logger.error(f"Invalid JSON file: {file_path}")
+            return
+        for record in data if isinstance(data, list) else [data]:
+            yield project_fields(record, fields)
+    elif file_path.endswith(".jsonl"):
+        yield from iter_jsonl_data(file_path, fields=fields)
+
+
+def drop_superseded_errors(records: Iterable[Dict[str, Any]]) -> Iterator[Dict[str, Any]]:
+    """
+    Drops the results of failed requests (see `is_error_result`) of documents that have a later result, e.g. from
+    retrying the request when the run was resumed.
+
+    Error results are held back until the end of the records, so memory use only grows with the number of errors.
+
+    Args:
+        records (Iterable[Dict[str, Any]]): The records, with their "context_document_id" and "llm_inference".
+
+    Yields:
+        Dict[str, Any]: The records, with the error results that were not superseded last.
+    """
+    errors: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        doc_id = record.get("context_document_id")
+        if doc_id is None:
+            yield record
+        elif is_error_result(record):
+            errors[str(doc_id)] = record
+        else:
+            errors.pop(str(doc_id), None)
+            yield record
+    yield from errors.values()
+
+
+def iter_local_inference_data(
+    input_path: str, fields: Sequence[str] | None = None, num_workers: int = 1
+) -> Iterator[Dict[str, Any]]:
+    """
+    Streams inference data from a file or directory containing JSON/JSONL files.
+
+    With a single worker, JSONL files are read line by line, so memory use does not grow with the size of the data.
+    With more workers, up to `num_workers` files are read ahead in background threads, overlapping file I/O with the
+    consumer; memory use is then bounded by that many (projected) files, e.g. JSONL shards.
+
+    Args:
+        input_path (str): Path to either a JSON/JSONL file or a directory containing JSON/JSONL files.
+        fields (Sequence[str] | None, optional): The fields to keep of each record, e.g. `METRICS_FIELDS`. If None,
+            all fields are kept.
+        num_workers (int, optional): Number of files read in parallel. Defaults to 1.
+
+    Returns:
+        Iterator[Dict[str, Any]]: The records, file by file in the order of `get_inference_data_files`. Results of
+            failed requests that were retried later are dropped (see `drop_superseded_errors`) if `fields` includes
+            "context_document_id" and "llm_inference".
 
     Raises:
-        jsonlines.InvalidLineError: If a line in a file is invalid and cannot be parsed as a dictionary.
         FileNotFoundError: If the specified file or directory doesn't exist.
     """
 
@@ -106,101 +314,135 @@ def read_local_inference_data(input_path: str) -> List[Dict[str, Any]]:
     if not os.path.exists(input_path):
         raise FileNotFoundError(f"Input path does not exist: {input_path}")
 
-    generations = list[Dict[str, Any]]()
     if os.path.isdir(input_path):
-        # If input_dir_path is a directory, glob all .json and .jsonl files
-        json_files = glob.glob(os.path.join(input_path, "*.json"))
-        jsonl_files = glob.glob(os.path.join(input_path, "*.jsonl"))
-        all_files = json_files + jsonl_files
-
-        if not all_files:
+        file_paths = get_inference_data_files(input_path)
+        if not file_paths:
             logger.warning(f"No JSON or JSONL files found in {input_path}")
-            return generations
-
-        # Consider adding specific handling for .json vs .jsonl files
-        for file_path in all_files:
-            try:
-                if file_path.endswith(".json"):
-                    # Handle regular JSON files
-                    with open(file_path, "r") as f:
-                        data = json.load(f)
-                        if isinstance(data, list):
-                            generations.extend(data)
-                        else:
-                            generations.append(data)
-                elif file_path.endswith(".jsonl"):
-                    # Handle JSONL files
-                    with jsonlines.open(file_path) as reader:
-                        for line in reader.iter(type=dict, skip_invalid=True):
-                            generations.append(line)
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON file: {file_path}")
-
-        logger.info(f"Read {len(generations)} generations from {len(all_files)} files.")
-
-        return generations
-
-    # If input_dir_path is a file, proceed with existing logic
-    try:
-        if input_path.endswith(".json"):
-            # Handle regular JSON files
-            with open(input_path, "r") as f:
-                data = json.load(f)
-                if isinstance(data, list):
-                    generations.extend(data)
-                else:
-                    generations.append(data)
-        elif input_path.endswith(".jsonl"):
-            # Handle JSONL files
-            with jsonlines.open(input_path) as reader:
-                for line in reader.iter(type=dict, skip_invalid=True):
-                    generations.append(line)
-    except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON file: {input_path}")
+    else:
+        file_paths = [input_path]
+
+    if num_workers <= 1:
+        records = (record for file_path in file_paths for record in iter_inference_data_file(file_path, fields))
+    else:
+        records = iter_inference_data_files_in_parallel(file_paths, fields, num_workers)
+    if fields is None or {"context_document_id", "llm_inference"}.issubset(fields):
+        return drop_superseded_errors(records)
+    return records
+
+
+def iter_inference_data_files_in_parallel(
+    file_paths: List[str], fields: Sequence[str] | None, num_workers: int
+) -> Iterator[Dict[str, Any]]:
+    """
+    Reads files in background threads, at most `num_workers` files ahead of the consumer, and yields their records in
+    file order.
+
+    Args:
+        file_paths (List[str]): Paths of the JSON/JSONL files.
+        fields (Sequence[str] | None): The fields to keep of each record. If None, all fields are kept.
+        num_workers (int): Number of files read in parallel.
+
+    Yields:
+        Dict[str, Any]: The records of the files.
+    """
+
+    def read_file(file_path: str) -> List[Dict[str, Any]]:
+        return list(iter_inference_data_file(file_path, fields))
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures: Deque[Future] = deque()
+        file_paths_iterator = iter(file_paths)
+        try:
+            for file_path in itertools.islice(file_paths_iterator, num_workers):
+                futures.append(executor.submit(read_file, file_path))
+            while futures:
+                records = futures.popleft().result()
+                for file_path in itertools.islice(file_paths_iterator, 1):
+                    futures.append(executor.submit(read_file, file_path))
+                yield from records
+                del records
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+def read_local_inference_data(input_path: str) -> List[Dict[str, Any]]:
+    """
+    Reads inference data from a file or directory containing JSON/JSONL files.
+
+    Directories written by `JsonlResultSink` are read through their manifest: the shards listed in it are read in
+    order, together with any JSON files of documents saved one file per document. See `iter_local_inference_data`
+    to stream large inference dumps instead.
+
+    Args:
+        input_path (str): Path to either a JSONL file or a directory containing JSON/JSONL files.
+
+    Returns:
+        List[Dict[str, Any]]: A list of dictionaries, where each dictionary represents a data point.
+
+    Raises:
+        FileNotFoundError: If the specified file or directory doesn't exist.
+    """
+
+    generations = list(iter_local_inference_data(input_path))
+
+    logger.info(f"Read {len(generations)} generations from {input_path}.")
 
     return generations
 
 
-def run(generations: List[Dict[str, Any]]) -> EvaluationResults:
+def run(
+    generations: Iterable[Dict[str, Any]],
+    score_cache_path: str | None = None,
+    bertscore_options: Dict[str, Any] | None = None,
+    metric_workers: int | None = None,
+) -> EvaluationResults:
     """
     Evaluates the performance of a model by comparing its predictions to the gold standard results.
 
     Args:
-        generations (List[Dict[str, Any]]): A list of dictionaries where each dictionary represents a data point.
-            Each dictionary must contain the following keys:
+        generations (Iterable[Dict[str, Any]]): Dictionaries, each representing a data point, e.g. streamed by
+            `iter_local_inference_data`. They are iterated once. Each dictionary must contain the following keys:
             - "gold_standard_result" (List[Any]): A list containing the correct answers. Only single-answer lists are supported.
             - "llm_inference" (Any): The model's prediction for the given data point.
-            - "prompt" (Any): The input prompt used to generate the prediction.
+        score_cache_path (str | None, optional): Path of the on-disk BERTScore cache. If None or empty, no cache is used.
+        bertscore_options (Dict[str, Any] | None, optional): Chunk size, batch size and device passed on to
+            `compute_bertscore` (see `get_bertscore_options`).
+        metric_workers (int | None, optional): Number of worker processes for CPU-bound metrics (see `run_metrics`).
 
     Returns:
-        EvaluationResults: An object containing the computed evaluation scores and the prompts used.
+        EvaluationResults: An object containing the generations, the computed evaluation scores and the duration
+            of each metric computation.
 
     Raises:
         NotImplementedError: If any data point contains multiple correct answers in "gold_standard_result".
     """
 
     references = []
+    predictions = []
 
     for datapoint in generations:
         if len(datapoint["gold_standard_result"]) == 1:
             references.append(datapoint["gold_standard_result"][0])
         else:
             raise NotImplementedError("Multiple correct answers")
-    predictions = [datapoint["llm_inference"] for datapoint in generations]
+        predictions.append(datapoint["llm_inference"])
 
     logger.info("Computing evaluation scores...")
 
     start_score_computation = time.time()
 
-    scores = compute_scores(predictions=predictions, references=references)
+    scores, metric_timings = compute_scores(
+        predictions=predictions,
+        references=references,
+        score_cache_path=score_cache_path,
+        bertscore_options=bertscore_options,
+        metric_workers=metric_workers,
+    )
 
     logger.info(f"Score computation took {time.time() - start_score_computation:.2f} seconds")
 
-    full_prompts = [
-        datapoint["prompt_template"].format(context=datapoint["context_document"]) for datapoint in generations
-    ]
-
-    return EvaluationResults(scores=scores, full_prompts=full_prompts, generations=predictions)
+    return EvaluationResults(scores=scores, generations=predictions, metric_timings=metric_timings)
 
 
 def main(args: Namespace):
@@ -212,17 +454,31 @@ def main(args: Namespace):
             - input_file_path (str): Path to a JSONL file or directory containing JSON/JSONL files
               with model generations.
             - minio_output_dir_path (str): Directory path to save the evaluation results.
+            - score_cache_path (str): Path of the on-disk BERTScore cache. Empty to disable caching.
+            - bertscore_chunk_size, bertscore_batch_size, bertscore_device: BERTScore computation options.
+            - torch_num_threads (int): Number of PyTorch threads. 0 for the PyTorch default.
+            - metric_workers (int | None): Number of worker processes for CPU-bound metrics. None for one per metric.
+            - reader_workers (int): Number of inference data files read in parallel.
 
     Workflow:
-        1. Reads inference data from the input file or directory.
+        1. Streams the fields of the inference data used by the metrics from the input file or directory.
         2. Computes evaluation metrics for the generations.
         3. Saves the evaluation results to the specified output directory.
     """
 
-    generations = read_local_inference_data(input_path=args.input_file_path)
+    set_torch_num_threads(args.torch_num_threads)
+
+    generations = iter_local_inference_data(
+        input_path=args.input_file_path, fields=METRICS_FIELDS, num_workers=args.reader_workers
+    )
 
     logger.info("Running metrics evaluation...")
-    results = run(generations=generations)
+    results = run(
+        generations=generations,
+        score_cache_path=args.score_cache_path,
+        bertscore_options=get_bertscore_options(args),
+        metric_workers=args.metric_workers,
+    )
 
     results_dir_path = os.path.join(args.output_dir_path, "evaluation_results")
 
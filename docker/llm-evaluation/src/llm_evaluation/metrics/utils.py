@@ -1,17 +1,29 @@
 import glob
+import io
 import json
 import os
-import tempfile
+import time
 from argparse import Namespace
-from typing import Any, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Sequence, Tuple
 
-import jsonlines
 import mlflow
 import numpy as np
 from llm_evaluation import logger
-from llm_evaluation.data.data_classes import AggregatedJudgeResults, EvaluationResults
+from llm_evaluation.data.data_classes import AggregatedJudgeResults, EvaluationResults, UploadStats
 from matplotlib import pyplot as plt
 from minio import Minio, S3Error
+from urllib3.exceptions import HTTPError
+
+try:
+    import orjson
+except ImportError:  # orjson is an optional, faster drop-in for json.loads
+    orjson = None
+
+MINIO_UPLOAD_WORKERS = 16
+MINIO_UPLOAD_MAX_RETRIES = 3
+MINIO_UPLOAD_RETRY_BACKOFF = 1.0  # seconds, doubled after every retry
+MINIO_UPLOAD_PART_SIZE = 64 * 1024 * 1024  # bytes, for multipart uploads of large files
 
 
 def convert_negatives_to_zero(array: np.ndarray) -> np.ndarray:
@@ -29,25 +41,138 @@ def convert_negatives_to_zero(array: np.ndarray) -> np.ndarray:
 
 
 def copy_results_files_to_minio(
-    local_results_dir_path: str, subdir: str, minio_results_dir_path: str, minio_client: Minio
-):
-    json_files = glob.glob(os.path.join(os.path.join(local_results_dir_path, subdir), "**", "*.json"), recursive=True)
+    local_results_dir_path: str,
+    subdir: str,
+    minio_results_dir_path: str,
+    minio_client: Minio,
+    max_workers: int = MINIO_UPLOAD_WORKERS,
+) -> UploadStats:
+    """
+    Uploads all JSON/JSONL result files in a subdirectory of the local results directory to MinIO, concurrently.
 
-    logger.info(f"Found {len(json_files)} JSON files in {os.path.join(local_results_dir_path, subdir)}")
+    Args:
+        local_results_dir_path (str): The local results directory.
+        subdir (str): The subdirectory of the results to upload, e.g. "inferences" or "judge_results".
+        minio_results_dir_path (str): The results directory in the MinIO bucket.
+        minio_client (Minio): The Minio client instance used to interact with the Minio server.
+        max_workers (int, optional): The number of concurrent uploads. Defaults to MINIO_UPLOAD_WORKERS.
 
-    for json_file in json_files:
+    Returns:
+        UploadStats: Statistics of the upload.
+    """
+    json_files = [
+        file_path
+        for extension in ["json", "jsonl"]
+        for file_path in glob.glob(
+            os.path.join(os.path.join(local_results_dir_path, subdir), "**", f"*.{extension}"), recursive=True
+        )
+    ]
 
-        destination_file = os.path.join(minio_results_dir_path, subdir, os.path.basename(json_file))
+    logger.info(f"Found {len(json_files)} JSON/JSONL files in {os.path.join(local_results_dir_path, subdir)}")
 
-        # Copy the file to MinIO
-        copy_to_minio_storage(
-            client=minio_client,
-            source_file=json_file,
-            destination_file=os.path.join(minio_results_dir_path, subdir, os.path.basename(json_file)),
-            bucket_name=os.environ["BUCKET_STORAGE_BUCKET"],
-        )
+    return upload_files_to_minio(
+        files=[
+            (json_file, os.path.join(minio_results_dir_path, subdir, os.path.basename(json_file)))
+            for json_file in json_files
+        ],
+        client=minio_client,
+        bucket_name=os.environ["BUCKET_STORAGE_BUCKET"],
+        max_workers=max_workers,
+    )
+
+
+def call_with_retries(
+    upload: Callable[[], Any],
+    description: str,
+    max_retries: int = MINIO_UPLOAD_MAX_RETRIES,
+    retry_backoff: float = MINIO_UPLOAD_RETRY_BACKOFF,
+) -> int:
+    """
+    Calls an upload function, retrying with exponential backoff if it fails with a MinIO or connection error.
 
-        logger.info(f"Copied {json_file} to MinIO as {destination_file}")
+    Args:
+        upload (Callable[[], Any]): The function performing the upload.
+        description (str): Description of the upload for logging.
+        max_retries (int, optional): The maximum number of retries. Defaults to MINIO_UPLOAD_MAX_RETRIES.
+        retry_backoff (float, optional): Seconds to wait before the first retry. Defaults to MINIO_UPLOAD_RETRY_BACKOFF.
+
+    Returns:
+        int: The number of retries that were needed.
+
+    Raises:
+        S3Error | HTTPError: The error of the last attempt, if all retries fail.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            upload()
+            return attempt
+        except (S3Error, HTTPError) as e:
+            if attempt == max_retries:
+                raise
+            wait_time = retry_backoff * 2**attempt
+            logger.warning(f"Upload of {description} failed ({e}). Retrying in {wait_time:.1f} seconds...")
+            time.sleep(wait_time)
+    return max_retries
+
+
+def upload_files_to_minio(
+    files: List[Tuple[str, str]],
+    client: Minio,
+    bucket_name: str,
+    max_workers: int = MINIO_UPLOAD_WORKERS,
+    max_retries: int = MINIO_UPLOAD_MAX_RETRIES,
+    part_size: int = MINIO_UPLOAD_PART_SIZE,
+) -> UploadStats:
+    """
+    Uploads files to a MinIO bucket concurrently using a thread pool.
+
+    Each file is uploaded with `fput_object`, which switches to multipart upload with parts of `part_size` bytes
+    for large files. Failed uploads are retried with exponential backoff.
+
+    Args:
+        files (List[Tuple[str, str]]): Pairs of local source file path and destination object name.
+        client (Minio): The Minio client instance used to interact with the Minio server.
+        bucket_name (str): The name of the bucket where the files will be uploaded.
+        max_workers (int, optional): The number of concurrent uploads. Defaults to MINIO_UPLOAD_WORKERS.
+        max_retries (int, optional): The maximum number of retries per file. Defaults to MINIO_UPLOAD_MAX_RETRIES.
+        part_size (int, optional): The part size in bytes of multipart uploads. Defaults to MINIO_UPLOAD_PART_SIZE.
+
+    Returns:
+        UploadStats: Statistics of the upload. Failed uploads are logged and counted, but do not raise.
+    """
+    stats = UploadStats()
+    upload_start_time = time.time()
+
+    def upload_file(source_file: str, destination_file: str) -> Tuple[str, int, int | None]:
+        try:
+            retries = call_with_retries(
+                upload=lambda: client.fput_object(
+                    bucket_name=bucket_name,
+                    object_name=destination_file,
+                    file_path=source_file,
+                    part_size=part_size,
+                ),
+                description=source_file,
+                max_retries=max_retries,
+            )
+            return source_file, retries, os.path.getsize(source_file)
+        except (S3Error, HTTPError) as e:
+            logger.error("Error occurred in Minio upload of %s: %s", source_file, e)
+            return source_file, max_retries, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for source_file, retries, file_size in executor.map(lambda file: upload_file(*file), files):
+            stats.retries += retries
+            if file_size is None:
+                stats.failed_files += 1
+            else:
+                stats.uploaded_files += 1
+                stats.uploaded_bytes += file_size
+                logger.debug(f"Uploaded {source_file} to bucket {bucket_name}")
+
+    stats.upload_time = time.time() - upload_start_time
+    logger.info(str(stats))
+    return stats
 
 
 def copy_to_minio_storage(client: Minio, source_file: str, destination_file: str, bucket_name: str):
@@ -66,10 +191,13 @@ def copy_to_minio_storage(client: Minio, source_file: str, destination_file: str
     """
 
     try:
-        client.fput_object(
-            bucket_name=bucket_name,
-            object_name=destination_file,
-            file_path=source_file,
+        call_with_retries(
+            upload=lambda: client.fput_object(
+                bucket_name=bucket_name,
+                object_name=destination_file,
+                file_path=source_file,
+            ),
+            description=source_file,
         )
         logger.info(
             "%s successfully uploaded as object %s to bucket %s",
@@ -77,25 +205,95 @@ def copy_to_minio_storage(client: Minio, source_file: str, destination_file: str
             destination_file,
             bucket_name,
         )
-    except S3Error as e:
+    except (S3Error, HTTPError) as e:
         logger.error("Error occurred in Minio upload: %s", e)
 
 
 def save_json_object_to_minio(json_object: object, destination_file: str, client: Minio):
+    """
+    Uploads a JSON-serializable object to MinIO directly from memory.
+    Args:
+        json_object (object): The object to be serialized to JSON and uploaded.
+        destination_file (str): The destination object name in the Minio bucket.
+        client (Minio): The Minio client instance used to interact with the Minio server.
+    """
 
-    # Create a temporary file for copying to Minio
-    with tempfile.NamedTemporaryFile(mode="w+", suffix=".json", delete=False) as tmp_file:
-        tmp_file.write(json.dumps(json_object))
-        tmp_file_path = tmp_file.name
+    data = json.dumps(json_object).encode("utf-8")
+    bucket_name = os.environ["BUCKET_STORAGE_BUCKET"]
 
     logger.info("Copying to MinIO...")
-    copy_to_minio_storage(
-        client=client,
-        source_file=tmp_file_path,
-        destination_file=destination_file,
-        bucket_name=os.environ["BUCKET_STORAGE_BUCKET"],
-    )
-    logger.info(f"Saved to MinIO: {destination_file}")
+    try:
+        call_with_retries(
+            upload=lambda: client.put_object(
+                bucket_name=bucket_name,
+                object_name=destination_file,
+                data=io.BytesIO(data),
+                length=len(data),
+                content_type="application/json",
+            ),
+            description=destination_file,
+        )
+        logger.info(f"Saved to MinIO: {destination_file}")
+    except (S3Error, HTTPError) as e:
+        logger.error("Error occurred in Minio upload: %s", e)
+
+
+def json_loads(data: str | bytes) -> Any:
+    """
+    Parses a JSON document, with orjson if it is installed and with the standard library otherwise.
+
+    Args:
+        data (str | bytes): The JSON document.
+
+    Returns:
+        Any: The parsed JSON value.
+
+    Raises:
+        ValueError: If the document is not valid JSON.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def project_fields(record: Dict[str, Any], fields: Sequence[str] | None) -> Dict[str, Any]:
+    """
+    Keeps only the given fields of a record, e.g. to drop the context documents of inference results.
+
+    Args:
+        record (Dict[str, Any]): The record.
+        fields (Sequence[str] | None): The fields to keep. Fields missing from the record are skipped. If None, the
+            record is returned unchanged.
+
+    Returns:
+        Dict[str, Any]: The projected record.
+    """
+    if fields is None:
+        return record
+    return {field: record[field] for field in fields if field in record}
+
+
+def iter_jsonl_data(input_file_path: str, fields: Sequence[str] | None = None) -> Iterator[Dict[str, Any]]:
+    """
+    Reads a JSONL (JSON Lines) file line by line, skipping invalid lines and lines that are not JSON objects.
+
+    Args:
+        input_file_path (str): The file path to the JSONL file.
+        fields (Sequence[str] | None, optional): The fields to keep of each record. If None, all fields are kept.
+
+    Yields:
+        Dict[str, Any]: The records of the file.
+    """
+    with open(input_file_path, "rb") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                record = json_loads(line)
+            except ValueError:
+                continue
+            if isinstance(record, dict):
+                yield project_fields(record, fields)
 
 
 def read_jsonl_data(input_file_path: str) -> List[Dict[str, Any]]:
@@ -104,23 +302,18 @@ def read_jsonl_data(input_file_path: str) -> List[Dict[str, Any]]:
     Args:
         input_file_path (str): The file path to the JSONL file.
     Returns:
-        List[Dict[str, Any]]: A list of dictionaries, where each dictionary represents a line in the JSONL file.
-    Raises:
-        jsonlines.InvalidLineError: If a line in the file is invalid and cannot be parsed as a dictionary.
+        List[Dict[str, Any]]: A list of dictionaries, where each dictionary represents a valid line in the JSONL file.
     """
 
-    generations = list()
-    with jsonlines.open(input_file_path) as reader:
-        for line in reader.iter(type=dict, skip_invalid=True):
-            generations.append(line)
-    return generations
+    return list(iter_jsonl_data(input_file_path))
 
 
-def get_score_distribution_graphs(metrics: Dict[str, List[float]]) -> Dict[str, str]:
+def get_score_distribution_graphs(metrics: Dict[str, List[float]], title_prefix: str = "BERTScore") -> Dict[str, str]:
     """
     Generates distribution graphs for the given metrics.
     Args:
         metrics (Dict[str, List[float]]): A dictionary where keys are metric names and values are lists of scores.
+        title_prefix (str, optional): Prefix of the graph titles. Defaults to "BERTScore".
     Returns:
         Dict[str, str]: A dictionary where keys are metric names and values are paths to the saved distribution graphs.
     """
@@ -131,7 +324,7 @@ def get_score_distribution_graphs(metrics: Dict[str, List[float]]) -> Dict[str,
         mean_val = np.mean(values)
         ax.hist(values, bins=20, alpha=0.7, color="skyblue", edgecolor="black")
         ax.axvline(mean_val, color="red", linestyle="dashed", linewidth=2, label=f"Mean: {mean_val:.4f}")
-        ax.set_title(f"BERTScore {name.capitalize()} Distribution")
+        ax.set_title(f"{title_prefix} {name.capitalize()} Distribution")
         ax.set_xlabel(name.capitalize())
         ax.set_ylabel("Frequency")
         ax.legend()
@@ -6,18 +6,27 @@ from argparse import Namespace
 from unittest.mock import Mock
 
 import httpx
+import pytest
 from llm_evaluation.call_inference_container.call_inference_container import (
+    AdaptiveConcurrencyController,
+    JsonlResultSink,
+    RequestMetricsCollector,
     batched,
+    bounded_as_completed,
     get_inference_result,
     get_llm_client,
+    get_token_lengths,
     handle_llm_inference_result,
+    iter_token_lengths,
 )
 from llm_evaluation.call_inference_container.call_inference_container import main as call_inference_container_main
 from llm_evaluation.call_inference_container.call_inference_container import (
+    read_completed_doc_ids,
     read_prompt_template,
     run,
+    save_local_results,
 )
-from openai import APIError
+from openai import APIError, RateLimitError
 from openai.types.chat import ChatCompletion
 
 
@@ -70,6 +79,129 @@ def test_get_inference_result(mocker):
     assert result.model == "test-model"
 
 
+def get_rate_limit_error():
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    return RateLimitError("Too many requests", response=httpx.Response(429, request=request), body=None)
+
+
+def test_get_inference_result_retries(mocker):
+    mock_client = mocker.AsyncMock()
+    mock_response = mocker.Mock()
+    mock_client.chat.completions.create.side_effect = [get_rate_limit_error(), mock_response]
+    controller = AdaptiveConcurrencyController(max_concurrency=8, max_retries=2, retry_backoff=0.0)
+
+    doc_id, result = asyncio.run(
+        get_inference_result(
+            llm_client=mock_client,
+            messages=[{"role": "user", "content": "Test message"}],
+            model_name="test-model",
+            parameters={},
+            doc_id="test_doc_id",
+            controller=controller,
+        )
+    )
+
+    assert result == mock_response
+    assert mock_client.chat.completions.create.call_count == 2
+    assert controller.retries == 1
+    # The overload halved the concurrency limit
+    assert controller.concurrency_limit == 4
+
+    # Transient errors that persist after all retries are returned as errors
+    mock_client.chat.completions.create.reset_mock()
+    mock_client.chat.completions.create.side_effect = get_rate_limit_error()
+
+    doc_id, result = asyncio.run(
+        get_inference_result(
+            llm_client=mock_client,
+            messages=[{"role": "user", "content": "Test message"}],
+            model_name="test-model",
+            parameters={},
+            doc_id="test_doc_id",
+            controller=AdaptiveConcurrencyController(max_concurrency=8, max_retries=2, retry_backoff=0.0),
+        )
+    )
+
+    assert result.choices[0].message.content.startswith("**ERROR**")
+    assert mock_client.chat.completions.create.call_count == 3
+
+
+def test_get_inference_result_request_metrics(mocker):
+    mock_client = mocker.AsyncMock()
+    mock_response = ChatCompletion(
+        id="test_doc_id",
+        object="chat.completion",
+        created=42,
+        model="test-model",
+        choices=[{"index": 0, "message": {"role": "assistant", "content": "Test response"}, "finish_reason": "stop"}],
+        usage={"prompt_tokens": 12, "completion_tokens": 4, "total_tokens": 16},
+    )
+    mock_client.chat.completions.create.side_effect = [mock_response, get_rate_limit_error()]
+    request_metrics = RequestMetricsCollector(name="judge")
+
+    for doc_id in ["doc_0", "doc_1"]:
+        asyncio.run(
+            get_inference_result(
+                llm_client=mock_client,
+                messages=[{"role": "user", "content": "Test message"}],
+                model_name="test-model",
+                parameters={},
+                doc_id=doc_id,
+                request_metrics=request_metrics,
+            )
+        )
+
+    successful_request, failed_request = request_metrics.requests
+    assert (successful_request.doc_id, successful_request.prompt_tokens, successful_request.completion_tokens) == (
+        "doc_0",
+        12,
+        4,
+    )
+    assert successful_request.error is None
+    assert failed_request.error == "RateLimitError"
+
+    summary = request_metrics.get_summary()
+    assert summary["judge_requests"] == 2
+    assert summary["judge_errors"] == 1
+    assert summary["judge_errors_RateLimitError"] == 1
+    assert summary["judge_prompt_tokens"] == 12
+    assert summary["judge_completion_tokens"] == 4
+    assert {"judge_response_time_p50", "judge_queue_wait_p99", "judge_tokens_per_second_mean"} <= set(summary)
+    assert set(request_metrics.get_distributions()) == {
+        "judge_queue_wait",
+        "judge_response_time",
+        "judge_tokens_per_second",
+    }
+
+
+def test_adaptive_concurrency_controller():
+    controller = AdaptiveConcurrencyController(max_concurrency=4, cooldown=60.0)
+    in_flight = 0
+    max_observed_in_flight = 0
+
+    async def request():
+        nonlocal in_flight, max_observed_in_flight
+        in_flight += 1
+        max_observed_in_flight = max(max_observed_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return True
+
+    async def run_requests():
+        return await asyncio.gather(*[controller.call(request) for _ in range(20)])
+
+    assert all(asyncio.run(run_requests()))
+    assert max_observed_in_flight == 4
+
+    # Overload errors within the cooldown only decrease the limit once, successes increase it again
+    controller.record_overload()
+    controller.record_overload()
+    assert controller.concurrency_limit == 2
+    for _ in range(10):
+        controller.record_success()
+    assert controller.concurrency_limit == 4
+
+
 def test_batched():
     # Test with a complete batch
     data = list(range(10))
@@ -98,6 +230,39 @@ def test_batched():
         assert str(e) == "n must be at least one"
 
 
+def test_bounded_as_completed():
+    in_flight = 0
+    max_observed_in_flight = 0
+    started = []
+
+    async def request(i):
+        nonlocal in_flight, max_observed_in_flight
+        started.append(i)
+        in_flight += 1
+        max_observed_in_flight = max(max_observed_in_flight, in_flight)
+        # Request 0 is slow, the others are fast
+        await asyncio.sleep(0.2 if i == 0 else 0.01)
+        in_flight -= 1
+        return i
+
+    async def collect_results():
+        return [result async for result in bounded_as_completed((request(i) for i in range(10)), max_in_flight=3)]
+
+    results = asyncio.run(collect_results())
+
+    assert sorted(results) == list(range(10))
+    assert max_observed_in_flight == 3
+    # The slow request does not stall the window: all other requests complete before it
+    assert results[-1] == 0
+    assert started == list(range(10))
+
+    # Test with invalid max_in_flight
+    try:
+        asyncio.run(anext(bounded_as_completed([], max_in_flight=0)))
+    except ValueError as e:
+        assert str(e) == "max_in_flight must be at least one"
+
+
 def test_get_llm_client():
     base_url = "https://localhost"
     port = "8080"
@@ -107,6 +272,11 @@ def test_get_llm_client():
 
     assert client.base_url == "https://localhost:8080/v1/"
 
+    client = get_llm_client(base_url=base_url, port=port, endpoint=endpoint, timeout=30.0, max_retries=0)
+
+    assert client.timeout == 30.0
+    assert client.max_retries == 0
+
     base_url = "https://localhost"
     port = ""
     endpoint = "v1"
@@ -172,7 +342,7 @@ def test_run(mocker):
         "llm_evaluation.call_inference_container.call_inference_container.AutoTokenizer.from_pretrained"
     )
     mock_tokenizer_instance = mock_tokenizer.return_value
-    mock_tokenizer_instance.return_value = {"input_ids": [1, 2, 3, 4, 5]}
+    mock_tokenizer_instance.side_effect = lambda messages: {"input_ids": [[1, 2, 3, 4, 5] for _ in messages]}
 
     dataset = {
         "test": [{"article": "This is a test article.", "highlights": "This is a test answer.", "id": "test_doc"}]
@@ -210,6 +380,217 @@ def test_run(mocker):
     assert "prompt_template" in results[0]
 
 
+def test_iter_token_lengths(mocker):
+    mock_tokenizer = mocker.Mock(side_effect=lambda messages: {"input_ids": [message.split() for message in messages]})
+    documents = [{"article": "one"}, {"article": "one two"}, {"article": "one two three"}]
+
+    token_lengths = list(
+        iter_token_lengths(
+            documents=documents,
+            prompt_template="Summarise: {context}",
+            context_column_name="article",
+            tokenizer=mock_tokenizer,
+            batch_size=2,
+        )
+    )
+
+    assert token_lengths == [2, 3, 4]
+    # Documents are tokenized in batches
+    assert mock_tokenizer.call_count == 2
+    mock_tokenizer.assert_any_call(["Summarise: one", "Summarise: one two"])
+
+
+def test_get_token_lengths_cache(mocker, tmpdir):
+    mock_from_pretrained = mocker.patch(
+        "llm_evaluation.call_inference_container.call_inference_container.AutoTokenizer.from_pretrained"
+    )
+    mock_from_pretrained.return_value.side_effect = lambda messages: {
+        "input_ids": [message.split() for message in messages]
+    }
+    dataset = {"test": [{"article": "one"}, {"article": "one two"}]}
+    kwargs = dict(
+        dataset=dataset,
+        dataset_name="abisee/cnn_dailymail",
+        dataset_version="3.0.0",
+        dataset_split="test",
+        prompt_template="Summarise: {context}",
+        context_column_name="article",
+        model_path="meta-llama/Llama-3.1-8B-Instruct",
+        cache_dir=str(tmpdir),
+    )
+
+    token_lengths = get_token_lengths(**kwargs)
+    assert token_lengths.tolist() == [2, 3]
+    assert mock_from_pretrained.call_count == 1
+
+    # A rerun reads the cache and does not load the tokenizer
+    token_lengths = get_token_lengths(**kwargs)
+    assert token_lengths.tolist() == [2, 3]
+    assert mock_from_pretrained.call_count == 1
+
+    # A different prompt template does not hit the cache
+    token_lengths = get_token_lengths(**{**kwargs, "prompt_template": "Summarise this text: {context}"})
+    assert token_lengths.tolist() == [4, 5]
+    assert mock_from_pretrained.call_count == 2
+
+
+@pytest.mark.parametrize("doc_ids", [["doc_0", "doc_1", "doc_2", "doc_3"], [0, 1, 2, 3]])
+def test_run_skip_doc_ids(mocker, doc_ids):
+    mock_client = mocker.Mock()
+    mock_response = mocker.Mock()
+    mock_response.choices = [mocker.Mock(message=mocker.Mock(content="This is a summary."))]
+    mock_client.chat.completions.create = mocker.AsyncMock(return_value=mock_response)
+
+    dataset = {
+        "test": [
+            {"article": f"This is test article {i}.", "highlights": "This is a test answer.", "id": doc_id}
+            for i, doc_id in enumerate(doc_ids)
+        ]
+    }
+
+    async def collect_results():
+        return [
+            result
+            async for result in run(
+                dataset=dataset,
+                prompt_template="Summarise the following text:\n{context}",
+                context_column_name="article",
+                gold_standard_column_name="highlights",
+                id_column_name="id",
+                llm_client=mock_client,
+                model_name="test-model",
+                model_path="meta-llama/Llama-3.1-8B-Instruct",
+                parameters={},
+                max_context_size=100,
+                batch_size=2,
+                use_data_subset=3,
+                dataset_split="test",
+                token_lengths=[5, 5, 5, 5],
+                # the completion index holds string IDs, also for integer dataset IDs
+                skip_doc_ids={str(doc_ids[0]), str(doc_ids[2])},
+            )
+        ]
+
+    results = asyncio.run(collect_results())
+
+    # Completed documents are skipped but still count towards the data subset
+    assert [result["context_document_id"] for result in results] == [doc_ids[1]]
+    assert mock_client.chat.completions.create.call_count == 1
+
+
+def test_read_completed_doc_ids(tmpdir):
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == set()
+
+    for doc_id in ["doc_0", "doc_1"]:
+        save_local_results(
+            result={"context_document_id": doc_id, "llm_inference": "Inference."},
+            output_dir_path=tmpdir,
+            subdir="inferences",
+        )
+
+    # Failed requests are not completed, so they are retried on resume
+    save_local_results(
+        result={"context_document_id": "doc_2", "llm_inference": "**ERROR**: RateLimitError"},
+        output_dir_path=tmpdir,
+        subdir="inferences",
+    )
+
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {"doc_0", "doc_1"}
+
+    # Without a completion index, the IDs are read from the result files
+    os.remove(os.path.join(tmpdir, "inferences", "completed_ids.txt"))
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {"doc_0", "doc_1"}
+
+
+def test_jsonl_result_sink(tmpdir):
+    results = [{"context_document_id": f"doc_{i}", "llm_inference": f"Inference {i}."} for i in range(7)]
+
+    with JsonlResultSink(
+        output_dir_path=tmpdir, subdir="inferences", flush_every=2, max_records_per_shard=3
+    ) as result_sink:
+        for result in results[:5]:
+            result_sink.write(result)
+        # Results are buffered until flush_every results have been written
+        assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {
+            "doc_0",
+            "doc_1",
+            "doc_2",
+            "doc_3",
+        }
+
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {f"doc_{i}" for i in range(5)}
+
+    # Resuming appends new shards and keeps the existing ones in the manifest
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences", max_records_per_shard=3) as result_sink:
+        for result in results[5:]:
+            result_sink.write(result)
+
+    with open(os.path.join(tmpdir, "inferences", "manifest.json"), "r") as fp:
+        manifest = json.load(fp)
+    assert manifest["num_records"] == 7
+    assert [shard["file_name"] for shard in manifest["shards"]] == [
+        "shard-00000.jsonl",
+        "shard-00001.jsonl",
+        "shard-00002.jsonl",
+    ]
+    assert [shard["num_records"] for shard in manifest["shards"]] == [3, 2, 2]
+
+    written_results = []
+    for shard in manifest["shards"]:
+        with open(os.path.join(tmpdir, "inferences", shard["file_name"]), "r") as fp:
+            written_results.extend(json.loads(line) for line in fp)
+    assert written_results == results
+
+
+def test_jsonl_result_sink_resume_after_crash(tmpdir):
+    results_dir_path = os.path.join(tmpdir, "inferences")
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences") as result_sink:
+        for i in range(2):
+            result_sink.write({"context_document_id": f"doc_{i}", "llm_inference": f"Inference {i}."})
+
+    # A crash after writing to the shards, before updating the manifest
+    with open(os.path.join(results_dir_path, "shard-00000.jsonl"), "a") as fp:
+        fp.write(json.dumps({"context_document_id": "doc_2", "llm_inference": "Inference 2."}) + "\n")
+    with open(os.path.join(results_dir_path, "shard-00001.jsonl"), "w") as fp:
+        fp.write(json.dumps({"context_document_id": "doc_3", "llm_inference": "Inference 3."}) + "\n")
+
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences") as result_sink:
+        result_sink.write({"context_document_id": "doc_4", "llm_inference": "Inference 4."})
+
+    with open(os.path.join(results_dir_path, "manifest.json"), "r") as fp:
+        manifest = json.load(fp)
+    # The unlisted records are removed and the orphan shard is not reused
+    assert manifest["shards"] == [
+        {"file_name": "shard-00000.jsonl", "num_records": 2},
+        {"file_name": "shard-00002.jsonl", "num_records": 1},
+    ]
+    for shard in manifest["shards"]:
+        with open(os.path.join(results_dir_path, shard["file_name"]), "r") as fp:
+            assert len(fp.readlines()) == shard["num_records"]
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {"doc_0", "doc_1", "doc_4"}
+
+
+def test_jsonl_result_sink_resume_after_crash_before_index_update(tmpdir):
+    results_dir_path = os.path.join(tmpdir, "inferences")
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences") as result_sink:
+        result_sink.write({"context_document_id": "doc_0", "llm_inference": "Inference 0."})
+        result_sink.write({"context_document_id": "doc_1", "llm_inference": "**ERROR**: RateLimitError"})
+
+    # A crash after updating the manifest, before appending the written IDs to the completion index
+    with open(os.path.join(results_dir_path, "shard-00000.jsonl"), "a") as fp:
+        fp.write(json.dumps({"context_document_id": "doc_2", "llm_inference": "Inference 2."}) + "\n")
+    manifest = {"format": "jsonl", "num_records": 3, "shards": [{"file_name": "shard-00000.jsonl", "num_records": 3}]}
+    with open(os.path.join(results_dir_path, "manifest.json"), "w") as fp:
+        json.dump(manifest, fp)
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {"doc_0"}
+
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences"):
+        pass
+
+    # The listed record is completed, so it is not inferred and written a second time
+    assert read_completed_doc_ids(output_dir_path=tmpdir, subdir="inferences") == {"doc_0", "doc_2"}
+
+
 def test_read_prompt_template(tmpdir):
     tmplt = """Summarise the following text:
     {context}"""
@@ -241,6 +622,18 @@ def test_main(mocker, tmpdir):
         gold_standard_column_name="highlights",
         id_column_name="id",  # Add the id_column_name attribute
         batch_size=50,  # Add the batch_size attribute
+        token_length_cache_dir="",
+        tokenization_batch_size=1000,
+        tokenization_num_proc=1,
+        resume_from="",
+        results_format="json",
+        max_connections=100,
+        max_keepalive_connections=20,
+        keepalive_expiry=30.0,
+        http2=False,
+        request_timeout=600.0,
+        max_retries=3,
+        retry_backoff=1.0,
     )
 
     dataset = {
@@ -284,6 +677,7 @@ def test_main(mocker, tmpdir):
 
     # This is redundant code - removed duplicate mocking and call
     mocker.patch("llm_evaluation.call_inference_container.call_inference_container.AutoTokenizer.from_pretrained")
+    mocker.patch("llm_evaluation.call_inference_container.call_inference_container.get_token_lengths", return_value=[5])
 
     inferences_filepath = asyncio.run(call_inference_container_main(mock_args))
 
@@ -0,0 +1,233 @@
+import asyncio
+
+import httpx
+from llm_evaluation.call_inference_container.call_inference_container import AdaptiveConcurrencyController
+from llm_evaluation.data.data_classes import JudgeResult
+from llm_evaluation.judge.run_judge_evaluation import (
+    GRADE_REGEX,
+    SESSION_HEADER,
+    order_inferences_by_prompt_prefix,
+    run_2step_judge,
+    run_2step_judge_on_inference_stream,
+)
+from openai import RateLimitError
+
+
+def get_inference_result(doc_id):
+    return {
+        "context_document": f"Document {doc_id}.",
+        "context_document_id": doc_id,
+        "gold_standard_result": [f"Summary {doc_id}."],
+        "llm_inference": f"Inference {doc_id}.",
+        "prompt_template": "Summarise the following text:\n{context}",
+    }
+
+
+def test_run_2step_judge_on_inference_stream(mocker):
+    in_flight = 0
+    max_observed_in_flight = 0
+    inferences_sent = 0
+    judged_before_last_inference = 0
+
+    async def mock_run_2step_judge(inference_result, **kwargs):
+        nonlocal in_flight, max_observed_in_flight
+        in_flight += 1
+        max_observed_in_flight = max(max_observed_in_flight, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if inference_result["context_document_id"] == "doc_3":
+            return None  # Judge error
+        return JudgeResult(
+            context_document=inference_result["context_document"],
+            context_document_id=inference_result["context_document_id"],
+            gold_standard_result=inference_result["gold_standard_result"],
+            llm_inference=inference_result["llm_inference"],
+            judge_explanation="Explanation.",
+            judge_grade=7,
+        )
+
+    mocker.patch("llm_evaluation.judge.run_judge_evaluation.run_2step_judge", side_effect=mock_run_2step_judge)
+
+    async def inference_stream():
+        nonlocal inferences_sent
+        for i in range(10):
+            await asyncio.sleep(0.02)
+            inferences_sent += 1
+            yield get_inference_result(f"doc_{i}")
+
+    async def collect_results():
+        nonlocal judged_before_last_inference
+        results = []
+        async for judge_result in run_2step_judge_on_inference_stream(
+            inference_stream=inference_stream(),
+            judge_model_name="judge-model",
+            judge_prompt_step1_template="{context} {answer}",
+            judge_prompt_step2_template="Grade:",
+            judge_client=mocker.AsyncMock(),
+            max_concurrent_judgments=2,
+        ):
+            if inferences_sent < 10:
+                judged_before_last_inference += 1
+            results.append(judge_result)
+        return results
+
+    results = asyncio.run(collect_results())
+
+    assert sorted(result.context_document_id for result in results) == [f"doc_{i}" for i in range(10) if i != 3]
+    assert max_observed_in_flight <= 2
+    # Judging overlaps with inference instead of waiting for all inferences
+    assert judged_before_last_inference > 0
+
+
+def test_run_2step_judge_on_inference_stream_propagates_inference_errors(mocker):
+    mocker.patch("llm_evaluation.judge.run_judge_evaluation.run_2step_judge", return_value=None)
+
+    async def failing_inference_stream():
+        yield get_inference_result("doc_0")
+        raise RuntimeError("Inference failed")
+
+    async def collect_results():
+        return [
+            judge_result
+            async for judge_result in run_2step_judge_on_inference_stream(
+                inference_stream=failing_inference_stream(),
+                judge_model_name="judge-model",
+                judge_prompt_step1_template="{context} {answer}",
+                judge_prompt_step2_template="Grade:",
+                judge_client=mocker.AsyncMock(),
+                max_concurrent_judgments=2,
+            )
+        ]
+
+    try:
+        asyncio.run(collect_results())
+    except RuntimeError as e:
+        assert str(e) == "Inference failed"
+    else:
+        assert False, "Expected RuntimeError"
+
+
+def test_run_2step_judge_on_inference_stream_propagates_judge_errors(mocker):
+    mocker.patch("llm_evaluation.judge.run_judge_evaluation.run_2step_judge", side_effect=RuntimeError("Judge failed"))
+
+    async def endless_inference_stream():
+        for i in range(2):
+            yield get_inference_result(f"doc_{i}")
+        await asyncio.Event().wait()
+
+    async def collect_results():
+        return [
+            judge_result
+            async for judge_result in run_2step_judge_on_inference_stream(
+                inference_stream=endless_inference_stream(),
+                judge_model_name="judge-model",
+                judge_prompt_step1_template="{context} {answer}",
+                judge_prompt_step2_template="Grade:",
+                judge_client=mocker.AsyncMock(),
+                max_concurrent_judgments=2,
+            )
+        ]
+
+    try:
+        # The inference stream never ends, so this times out if the judge waits for it with no worker left
+        asyncio.run(asyncio.wait_for(collect_results(), timeout=5))
+    except RuntimeError as e:
+        assert str(e) == "Judge failed"
+    else:
+        assert False, "Expected RuntimeError"
+
+
+def test_run_2step_judge_session_hint(mocker):
+    def create_completion(messages, **kwargs):
+        content = "Grade: [[8]]" if len(messages) > 1 else "Explanation."
+        return mocker.Mock(choices=[mocker.Mock(message=mocker.Mock(content=content))])
+
+    mock_client = mocker.AsyncMock()
+    mock_client.chat.completions.create.side_effect = create_completion
+
+    judge_result = asyncio.run(
+        run_2step_judge(
+            inference_result=get_inference_result("doc_0"),
+            judge_prompt_step1_template="{context} {answer}",
+            judge_prompt_step2_template="Grade:",
+            grade_regex=GRADE_REGEX,
+            judge_client=mock_client,
+            judge_model_name="judge-model",
+            session_hint=True,
+        )
+    )
+
+    assert judge_result.judge_grade == 8
+    step1_call, step2_call = mock_client.chat.completions.create.call_args_list
+    assert step1_call.kwargs["extra_headers"] == {SESSION_HEADER: "doc_0"}
+    assert step2_call.kwargs["extra_headers"] == {SESSION_HEADER: "doc_0"}
+    assert step2_call.kwargs["extra_body"] == {"guided_regex": GRADE_REGEX}
+    # Step 2 extends the step-1 conversation, so its prompt starts with the step-1 prefix
+    assert step2_call.kwargs["messages"][0] == step1_call.kwargs["messages"][0]
+
+
+def test_run_2step_judge_step2_before_next_step1(mocker):
+    request = httpx.Request("POST", "http://localhost/v1/chat/completions")
+    overloaded = RateLimitError("Too many requests", response=httpx.Response(429, request=request), body=None)
+    step1_requests = []
+    awaiting_grade = set()
+
+    async def create_completion(messages, **kwargs):
+        document = messages[0]["content"]
+        if len(messages) > 1:
+            awaiting_grade.discard(document)
+            await asyncio.sleep(0.01)
+            return mocker.Mock(choices=[mocker.Mock(message=mocker.Mock(content="Grade: [[8]]"))])
+        # No document whose explanation is done waits for its grade while the step 1 of another one is sent
+        assert not awaiting_grade
+        step1_requests.append(document)
+        if document.startswith("Document doc_0.") and step1_requests.count(document) == 1:
+            await asyncio.sleep(0.005)
+            raise overloaded
+        await asyncio.sleep(0.01)
+        awaiting_grade.add(document)
+        return mocker.Mock(choices=[mocker.Mock(message=mocker.Mock(content="Explanation."))])
+
+    mock_client = mocker.AsyncMock()
+    mock_client.chat.completions.create.side_effect = create_completion
+
+    async def judge_documents():
+        # The overload error halves the limit while all slots are taken, so step-2 requests have to wait for a slot
+        controller = AdaptiveConcurrencyController(max_concurrency=4, retry_backoff=0.0)
+        return await asyncio.gather(
+            *[
+                run_2step_judge(
+                    inference_result=get_inference_result(f"doc_{i}"),
+                    judge_prompt_step1_template="{context} {answer}",
+                    judge_prompt_step2_template="Grade:",
+                    grade_regex=GRADE_REGEX,
+                    judge_client=mock_client,
+                    judge_model_name="judge-model",
+                    controller=controller,
+                )
+                for i in range(8)
+            ]
+        )
+
+    judge_results = asyncio.run(judge_documents())
+
+    assert [judge_result.judge_grade for judge_result in judge_results] == [8] * 8
+    assert len(step1_requests) == 9
+
+
+def test_order_inferences_by_prompt_prefix():
+    inferences_data = [
+        {**get_inference_result("doc_0"), "context_document": "Document B.", "llm_inference": "Answer 1."},
+        {**get_inference_result("doc_1"), "context_document": "Document A.", "llm_inference": "Answer 2."},
+        {**get_inference_result("doc_2"), "context_document": "Document B.", "llm_inference": "Answer 0."},
+        {**get_inference_result("doc_3"), "context_document": "Document A.", "llm_inference": "Answer 1."},
+    ]
+
+    ordered = order_inferences_by_prompt_prefix(inferences_data, judge_prompt_step1_template="{context} {answer}")
+
+    assert [inference_result["context_document_id"] for inference_result in ordered] == [
+        "doc_3",
+        "doc_1",
+        "doc_2",
+        "doc_0",
+    ]
@@ -1,8 +1,11 @@
+import os
+
 import pytest
 from llm_evaluation.metrics.metrics import (
     compute_bertscore,
     compute_bleu_score,
     compute_exact_match,
+    load_metric,
 )
 
 
@@ -45,3 +48,77 @@ def test_compute_bleu_score():
     bleu_score = compute_bleu_score(predictions, references)
 
     assert bleu_score < 1.0
+
+
+def test_load_metric_once(mocker):
+    mock_load = mocker.patch("llm_evaluation.metrics.metrics.load")
+    load_metric.cache_clear()
+
+    assert load_metric("bleu") is load_metric("bleu")
+    load_metric("exact_match")
+
+    assert mock_load.call_count == 2
+    load_metric.cache_clear()
+
+
+def test_compute_bertscore_cache(mocker, tmpdir):
+    mock_bertscore = mocker.Mock()
+    mock_bertscore.compute.side_effect = lambda predictions, references, **kwargs: {
+        "precision": [len(prediction) / 100 for prediction in predictions],
+        "recall": [len(reference) / 100 for reference in references],
+        "f1": [-0.5 for _ in predictions],
+    }
+    mocker.patch("llm_evaluation.metrics.metrics.load_metric", return_value=mock_bertscore)
+    score_cache_path = os.path.join(tmpdir, "scores.sqlite")
+
+    precision_list, recall_list, f1_list = compute_bertscore(
+        ["prediction a", "prediction bb"], ["reference a", "reference bb"], score_cache_path=score_cache_path
+    )
+    assert precision_list.tolist() == [0.12, 0.13]
+    assert recall_list.tolist() == [0.11, 0.12]
+    assert f1_list.tolist() == [0.0, 0.0]
+
+    # Only the new pair is scored, cached scores keep their order
+    precision_list, recall_list, f1_list = compute_bertscore(
+        ["prediction bb", "prediction ccc", "prediction a"],
+        ["reference bb", "reference ccc", "reference a"],
+        score_cache_path=score_cache_path,
+    )
+    assert mock_bertscore.compute.call_args.kwargs["predictions"] == ["prediction ccc"]
+    assert precision_list.tolist() == [0.13, 0.14, 0.12]
+    assert recall_list.tolist() == [0.12, 0.13, 0.11]
+
+    # Fully cached runs do not compute any scores
+    mock_bertscore.compute.reset_mock()
+    compute_bertscore(["prediction a"], ["reference a"], score_cache_path=score_cache_path)
+    mock_bertscore.compute.assert_not_called()
+
+
+def test_compute_bertscore_chunks(mocker):
+    mock_bertscore = mocker.Mock()
+    mock_bertscore.compute.side_effect = lambda predictions, references, **kwargs: {
+        "precision": [len(prediction) / 100 for prediction in predictions],
+        "recall": [len(reference) / 100 for reference in references],
+        "f1": [0.5 for _ in predictions],
+    }
+    mocker.patch("llm_evaluation.metrics.metrics.load_metric", return_value=mock_bertscore)
+    predictions = ["a" * length for length in range(1, 6)]
+    references = ["b" * length for length in range(5, 0, -1)]
+
+    precision_list, recall_list, f1_list = compute_bertscore(
+        predictions, references, chunk_size=2, batch_size=8, device="cpu"
+    )
+
+    assert mock_bertscore.compute.call_count == 3
+    assert [call.kwargs["predictions"] for call in mock_bertscore.compute.call_args_list] == [
+        predictions[0:2],
+        predictions[2:4],
+        predictions[4:5],
+    ]
+    assert all(
+        call.kwargs["batch_size"] == 8 and call.kwargs["device"] == "cpu"
+        for call in mock_bertscore.compute.call_args_list
+    )
+    assert precision_list.tolist() == [0.01, 0.02, 0.03, 0.04, 0.05]
+    assert recall_list.tolist() == [0.05, 0.04, 0.03, 0.02, 0.01]
+    assert len(f1_list) == 5
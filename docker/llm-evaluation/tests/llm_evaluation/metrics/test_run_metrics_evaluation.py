@@ -5,7 +5,16 @@ from argparse import Namespace
 
 import jsonlines
 import pytest
-from llm_evaluation.metrics.run_metrics_evaluation import main, read_local_inference_data, run
+from llm_evaluation.call_inference_container.call_inference_container import JsonlResultSink, save_local_results
+from llm_evaluation.metrics.metrics import Metric
+from llm_evaluation.metrics.run_metrics_evaluation import (
+    METRICS_FIELDS,
+    iter_local_inference_data,
+    main,
+    read_local_inference_data,
+    run,
+    run_metrics,
+)
 
 
 def test_read_inference_data_nonexistent_path():
@@ -59,6 +68,72 @@ def test_read_inference_data_invalid_jsonl_file():
     os.unlink(temp_path)
 
 
+def test_read_inference_data_sharded_jsonl_directory(tmpdir):
+    """Test reading inference data from a directory written by the JSONL result sink."""
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences", max_records_per_shard=2) as result_sink:
+        for i in range(3):
+            result_sink.write({"context_document_id": f"doc_{i}", "llm_inference": f"Inference {i}."})
+    # Results saved one file per document are read as well
+    save_local_results(
+        result={"context_document_id": "doc_3", "llm_inference": "Inference 3."},
+        output_dir_path=tmpdir,
+        subdir="inferences",
+    )
+
+    results = read_local_inference_data(os.path.join(tmpdir, "inferences"))
+
+    assert sorted(result["context_document_id"] for result in results) == ["doc_0", "doc_1", "doc_2", "doc_3"]
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_iter_local_inference_data(tmpdir, num_workers):
+    """Test streaming the fields used by the metrics from a sharded JSONL directory."""
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences", max_records_per_shard=2) as result_sink:
+        for i in range(7):
+            result_sink.write(
+                {
+                    "context_document_id": f"doc_{i}",
+                    "context_document": f"Context {i}.",
+                    "llm_inference": f"Inference {i}.",
+                    "gold_standard_result": [f"Gold standard {i}."],
+                }
+            )
+
+    records = iter_local_inference_data(
+        os.path.join(tmpdir, "inferences"), fields=METRICS_FIELDS, num_workers=num_workers
+    )
+
+    assert not isinstance(records, list)
+    assert list(records) == [
+        {
+            "context_document_id": f"doc_{i}",
+            "llm_inference": f"Inference {i}.",
+            "gold_standard_result": [f"Gold standard {i}."],
+        }
+        for i in range(7)
+    ]
+
+
+def test_iter_local_inference_data_drops_superseded_errors(tmpdir):
+    """Test that results of failed requests are replaced by the results of retrying them on resume."""
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences") as result_sink:
+        result_sink.write({"context_document_id": 0, "llm_inference": "Inference 0."})
+        result_sink.write({"context_document_id": 1, "llm_inference": "**ERROR**: RateLimitError"})
+        result_sink.write({"context_document_id": 2, "llm_inference": "**ERROR**: RateLimitError"})
+    # the resumed run retries the failed requests, one of them fails again
+    with JsonlResultSink(output_dir_path=tmpdir, subdir="inferences") as result_sink:
+        result_sink.write({"context_document_id": 1, "llm_inference": "Inference 1."})
+        result_sink.write({"context_document_id": 2, "llm_inference": "**ERROR**: APIConnectionError"})
+
+    records = list(iter_local_inference_data(os.path.join(tmpdir, "inferences"), fields=METRICS_FIELDS))
+
+    assert records == [
+        {"context_document_id": 0, "llm_inference": "Inference 0."},
+        {"context_document_id": 1, "llm_inference": "Inference 1."},
+        {"context_document_id": 2, "llm_inference": "**ERROR**: APIConnectionError"},
+    ]
+
+
 #  The test below is skipped for now, until the results from metrics
 #  and judge evaluation are unified (refactor with dataclasses with common functionality).
 @pytest.mark.skip
@@ -125,8 +200,7 @@ def test_run_evaluation_single_correct_answer():
         }
     ]
     results = run(generations=data)
-    assert len(results.full_prompts) == 1
-    assert "Generate text." in results.full_prompts
+    assert results.generations == ["This is generated text."]
     assert len(results.scores.f1_list_bert) == 1
     assert results.scores.accuracy == 1.0
     assert results.scores.bleu_score == 1.0
@@ -145,8 +219,7 @@ def test_run_evaluation_incorrect_answer():
         }
     ]
     results = run(generations=data)
-    assert len(results.full_prompts) == 1
-    assert "Generate text." in results.full_prompts
+    assert results.generations == ["This is incorrect text."]
     assert len(results.scores.f1_list_bert) == 1
     assert results.scores.accuracy == 0.0
     assert results.scores.bleu_score < 1.0
@@ -171,9 +244,7 @@ def test_run_evaluation_multiple_data_points():
         },
     ]
     results = run(generations=data)
-    assert len(results.full_prompts) == 2
-    assert "Generate text." in results.full_prompts
-    assert "Generate another text." in results.full_prompts
+    assert len(results.generations) == 2
     assert len(results.scores.f1_list_bert) == 2
     assert results.scores.accuracy == 1.0
     assert results.scores.bleu_score == 1.0
@@ -196,3 +267,54 @@ def test_run_evaluation_multiple_correct_answers():
         assert str(e) == "Multiple correct answers"
     else:
         assert False, "Expected NotImplementedError"
+
+
+def count_equal(predictions, references):
+    return sum(prediction == reference for prediction, reference in zip(predictions, references))
+
+
+def count_not_equal(predictions, references):
+    return sum(prediction != reference for prediction, reference in zip(predictions, references))
+
+
+@pytest.mark.parametrize("metric_workers", [None, 0])
+def test_run_metrics(mocker, metric_workers):
+    model_metric = mocker.Mock(return_value=0.5)
+    mocker.patch.dict(
+        "llm_evaluation.metrics.metrics.METRIC_REGISTRY",
+        {
+            "model": Metric(name="model", compute=model_metric, cpu_bound=False),
+            "equal": Metric(name="equal", compute=count_equal),
+            "not_equal": Metric(name="not_equal", compute=count_not_equal),
+        },
+        clear=True,
+    )
+
+    results, timings = run_metrics(
+        predictions=["a", "b"],
+        references=["a", "c"],
+        metric_options={"model": {"device": "cpu"}},
+        metric_workers=metric_workers,
+    )
+
+    assert results == {"model": 0.5, "equal": 1, "not_equal": 1}
+    assert list(results) == ["model", "equal", "not_equal"]
+    assert set(timings) == {"model", "equal", "not_equal"}
+    assert all(timing >= 0 for timing in timings.values())
+    model_metric.assert_called_once_with(predictions=["a", "b"], references=["a", "c"], device="cpu")
+
+
+def test_run_metrics_selected_metrics(mocker):
+    mocker.patch.dict(
+        "llm_evaluation.metrics.metrics.METRIC_REGISTRY",
+        {
+            "equal": Metric(name="equal", compute=count_equal),
+            "not_equal": Metric(name="not_equal", compute=count_not_equal),
+        },
+        clear=True,
+    )
+
+    results, timings = run_metrics(predictions=["a"], references=["b"], metric_names=["not_equal"], metric_workers=0)
+
+    assert results == {"not_equal": 1}
+    assert list(timings) == ["not_equal"]
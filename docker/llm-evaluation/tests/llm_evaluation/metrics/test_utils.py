@@ -1,6 +1,10 @@
+import json
+import os
+
 import numpy as np
 import pytest
-from llm_evaluation.metrics.utils import convert_negatives_to_zero
+from llm_evaluation.metrics.utils import convert_negatives_to_zero, save_json_object_to_minio, upload_files_to_minio
+from minio import S3Error
 
 
 def test_convert_negatives_to_zero_all_positive():
@@ -43,3 +47,49 @@ def test_convert_negatives_to_zero_large_array():
     result = convert_negatives_to_zero(array)
     expected = np.where(array < 0, 0, array)
     np.testing.assert_array_equal(result, expected)
+
+
+def test_upload_files_to_minio(mocker, tmpdir):
+    mocker.patch("llm_evaluation.metrics.utils.time.sleep")
+    files = []
+    for i in range(5):
+        file_path = os.path.join(tmpdir, f"doc_{i}.json")
+        with open(file_path, "w") as f:
+            f.write("{}")
+        files.append((file_path, f"results/doc_{i}.json"))
+
+    failed_once = set()
+
+    def fput_object(bucket_name, object_name, file_path, part_size):
+        # The first upload attempt of doc_1 fails, doc_4 always fails
+        if object_name == "results/doc_4.json" or (object_name == "results/doc_1.json" and not failed_once):
+            failed_once.add(object_name)
+            raise S3Error("InternalError", "Upload failed", object_name, "request_id", "host_id", None)
+
+    mock_client = mocker.Mock()
+    mock_client.fput_object.side_effect = fput_object
+
+    stats = upload_files_to_minio(files=files, client=mock_client, bucket_name="bucket", max_workers=3, max_retries=2)
+
+    assert stats.uploaded_files == 4
+    assert stats.failed_files == 1
+    assert stats.uploaded_bytes == 8
+    assert mock_client.fput_object.call_count == 5 + 1 + 2
+    uploaded_objects = {call.kwargs["object_name"] for call in mock_client.fput_object.call_args_list}
+    assert uploaded_objects == {destination_file for _, destination_file in files}
+
+
+def test_save_json_object_to_minio(mocker):
+    mocker.patch.dict(os.environ, {"BUCKET_STORAGE_BUCKET": "bucket"})
+    mock_client = mocker.Mock()
+
+    save_json_object_to_minio(
+        json_object={"mean_grade": 7.5}, destination_file="results/summary.json", client=mock_client
+    )
+
+    mock_client.put_object.assert_called_once()
+    kwargs = mock_client.put_object.call_args.kwargs
+    assert kwargs["bucket_name"] == "bucket"
+    assert kwargs["object_name"] == "results/summary.json"
+    assert json.loads(kwargs["data"].read()) == {"mean_grade": 7.5}
+    assert kwargs["length"] == len(json.dumps({"mean_grade": 7.5}))
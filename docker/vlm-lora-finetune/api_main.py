@@ -1,5 +1,4 @@
 # main.py
-import asyncio
 import io
 import os
 import re
@@ -7,7 +6,6 @@ import shutil
 import time
 import uuid
 import zipfile
-from concurrent.futures import ProcessPoolExecutor
 from contextlib import asynccontextmanager
 from typing import List, Optional
 
@@ -18,7 +16,8 @@ from clipora.config import TrainConfig, parse_yaml_to_config
 from fastapi import FastAPI, File, Form, HTTPException, UploadFile, status
 from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse
+from job_scheduler import JobScheduler
 from pydantic import BaseModel, ValidationError
 from train import main as train_main
 
@@ -30,24 +29,30 @@ TRAIN_JOB_OUTPUT_DIR = os.getenv("TRAIN_JOB_OUTPUT_DIR", "/tmp/trained_models/")
 os.makedirs(FILE_DOWNLOAD_DIR, exist_ok=True)
 os.makedirs(TRAIN_JOB_OUTPUT_DIR, exist_ok=True)
 
+# Size of the chunks of uploaded and downloaded files
+FILE_CHUNK_SIZE = 1024 * 1024
+# Files stored without compression in downloaded ZIPs, model weights barely compress
+STORED_FILE_EXTENSIONS = (".safetensors", ".bin", ".pt", ".pth", ".ckpt", ".npy", ".zip")
+
 
 # --- Lifespan Manager for Executor and DB ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # On startup: Create process pool and initialize the database
-    # will be used to run CPU-intensive tasks in a separate process
+    # On startup: initialize the database and start the job scheduler
+    # training jobs run in separate processes, at most JOBS_PER_DEVICE per GPU,
     # so that API will stay responsive
     job_db.init_db()
-    app.state.process_pool = ProcessPoolExecutor()
+    app.state.scheduler = JobScheduler(target=train_job)
+    app.state.scheduler.start()
     yield
-    # On shutdown: Gracefully close the process pool
-    app.state.process_pool.shutdown()
+    # On shutdown: stop the running jobs, they are requeued on the next start
+    await app.state.scheduler.stop()
 
 
 # --- (Modified) Background Task (runs in a separate process) ---
 def train_job(job_id: str, config: TrainConfig, zip_path: str | None = None):
     """
-    This function is CPU-intensive and runs in a separate process.
+    This function is CPU-intensive and runs in a separate process started by the job scheduler.
     It communicates status by calling functions from the `db` module.
     """
     # Create job specific output directory for training data
@@ -73,8 +78,9 @@ def train_job(job_id: str, config: TrainConfig, zip_path: str | None = None):
         job_db.update_job(job_id, status="training", detail="Model training in progress...")
         job_callback = job_db.create_job_callback(job_id)
         train_main(config, job_callback)
+        job_callback.flush()
 
-        job_db.update_job(job_id, status="complete", detail="Training finished successfully.")
+        job_db.update_job(job_id, status="complete", detail="Training finished successfully.", progress=100.0)
     except Exception as e:
         job_db.update_job(job_id, status="failed", detail=str(e))
 
@@ -103,6 +109,13 @@ app.add_middleware(
 )
 
 
+async def _save_upload_file(file: UploadFile, path: str):
+    """Writes an uploaded file to disk chunk by chunk, without blocking the event loop on disk writes."""
+    with open(path, "wb") as buffer:
+        while chunk := await file.read(FILE_CHUNK_SIZE):
+            await run_in_threadpool(buffer.write, chunk)
+
+
 # --- Training Endpoint ---
 @app.post("/train/", summary="Submit a training job", status_code=status.HTTP_202_ACCEPTED)
 async def train_model(
@@ -110,6 +123,7 @@ async def train_model(
     file: Optional[UploadFile] = File(
         None, description="A ZIP file with the dataset (required if not using HuggingFace datasets)."
     ),
+    priority: int = Form(0, description="Jobs with a higher priority are started first."),
 ):
     job_id = str(uuid.uuid4())
 
@@ -131,18 +145,15 @@ async def train_model(
 
         zip_path = os.path.join(FILE_DOWNLOAD_DIR, f"{job_id}.zip")
         try:
-            with open(zip_path, "wb") as buffer:
-                while chunk := await file.read(1024 * 1024):
-                    buffer.write(chunk)
+            await _save_upload_file(file, zip_path)
         finally:
             await file.close()
     else:
         zip_path = None  # Not needed for HuggingFace datasets
 
-    job_db.create_job(job_id)
-
-    loop = asyncio.get_running_loop()
-    loop.run_in_executor(app.state.process_pool, train_job, job_id, config, zip_path)
+    # the job waits in the jobs table until the scheduler starts it on a free device
+    job_db.create_job(job_id, config=config_str, zip_path=zip_path, priority=priority)
+    app.state.scheduler.notify()
 
     return {
         "message": "Training job accepted.",
@@ -151,13 +162,31 @@ async def train_model(
     }
 
 
+@app.post("/cancel/{job_id}", summary="Cancel a queued or running job", name="cancel_job")
+async def cancel_job(job_id: str):
+    """
+    Cancels a training job. Queued jobs are never started, running jobs are stopped.
+    """
+
+    job = job_db.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found.")
+    if not await app.state.scheduler.cancel(job_id):
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT, detail=f"Job with status '{job['status']}' cannot be cancelled."
+        )
+    return _job_status_return(job_db.get_job(job_id))
+
+
 def _extract_percentage(s):
     match = re.search(r"(\d+\.?\d*)%", s)
     return float(match.group(1)) if match else None
 
 
 def _job_status_return(job_dict):
-    job_dict["progress"] = _extract_percentage(job_dict["detail"]) if job_dict["detail"] else None
+    # jobs from before the progress column only have the percentage in detail
+    if job_dict.get("progress") is None and job_dict["detail"]:
+        job_dict["progress"] = _extract_percentage(job_dict["detail"])
     return job_dict
 
 
@@ -174,18 +203,26 @@ async def get_status(job_id: str):
     return _job_status_return(job)
 
 
-@app.get("/list_jobs/", summary="Return all jobs", name="list_jobs")
-async def list_jobs():
+@app.get("/list_jobs/", summary="Return jobs, newest first", name="list_jobs")
+async def list_jobs(limit: int = 100, offset: int = 0, job_status: Optional[str] = None):
     """
-    Fetches all jobs from the database.
+    Fetches jobs from the database, newest first.
+
+    - **limit**: Maximum number of jobs to return.
+    - **offset**: Number of jobs to skip, for paging.
+    - **job_status**: Only return jobs with this status.
     """
 
-    jobs = job_db.get_all_jobs()
+    jobs = job_db.get_all_jobs(limit=limit, offset=offset, status=job_status)
     if not jobs:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No jobs found.")
     return [_job_status_return(job) for job in jobs]
 
 
+def _parse_classes(classes: str) -> list[str]:
+    return [line.strip() for line in classes.split("\n") if line.strip()]
+
+
 @app.post("/inference/", summary="Run inference on a single image with specified classes", name="classes_inference")
 async def classes_inference(job_id: str, image: UploadFile, classes: str = Form(...)):
     """
@@ -196,21 +233,52 @@ async def classes_inference(job_id: str, image: UploadFile, classes: str = Form(
     - **classes**: A list of strings separated by new lines, used as texts/"classes".
     """
 
-    classes_list = [line.strip() for line in classes.split("\n") if line.strip()]
-    image_path = os.path.join("/tmp/", str(uuid.uuid4()) + "_" + image.filename)
-    with open(image_path, "wb") as buffer:
-        shutil.copyfileobj(image.file, buffer)
-
+    classes_list = _parse_classes(classes)
     job_dict = job_db.get_job(job_id)
     if job_dict is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job ID not found.")
 
-    probabilities, classes_list = merge_and_infer.run_single_inference(job_dict, image_path, classes_list)
+    image_file = io.BytesIO(await image.read())
+    # the model is cached between requests (see merge_and_infer.ModelCache), inference runs outside the event loop
+    probabilities, classes_list = await run_in_threadpool(
+        merge_and_infer.run_single_inference, job_dict, image_file, classes_list
+    )
     if probabilities is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Failed to run inference.")
     return {"probabilities": probabilities, "classes": classes_list}
 
 
+@app.post("/batch_inference/", summary="Run inference on several images with specified classes", name="batch_inference")
+async def batch_inference(job_id: str, images: List[UploadFile] = File(...), classes: str = Form(...)):
+    """
+    Like /inference/, but runs inference on several images in a single forward pass.
+
+    - **images**: The uploaded image files.
+    - **classes**: A list of strings separated by new lines, used as texts/"classes".
+
+    Returns the probabilities of each image in the order of the uploaded images.
+    """
+
+    classes_list = _parse_classes(classes)
+    job_dict = job_db.get_job(job_id)
+    if job_dict is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job ID not found.")
+
+    image_files = [io.BytesIO(await image.read()) for image in images]
+    probabilities, classes_list = await run_in_threadpool(
+        merge_and_infer.run_batch_inference, job_dict, image_files, classes_list
+    )
+    if probabilities is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Failed to run inference.")
+    return {
+        "results": [
+            {"filename": image.filename, "probabilities": image_probabilities}
+            for image, image_probabilities in zip(images, probabilities)
+        ],
+        "classes": classes_list,
+    }
+
+
 @app.get("/download_finetuned_model/{job_id}")
 async def download_finetuned_model(job_id: str):
     """
@@ -230,32 +298,110 @@ async def download_finetuned_model(job_id: str):
             status_code=404, detail=f"Job ID '{job_id}' does not have a valid model folder at '{model_folder_path}'."
         )
 
-    # 3. Create an in-memory binary stream (a virtual file) to hold the ZIP data.
-    # This avoids writing a temporary file to the disk, which is more efficient.
-    zip_io_buffer = io.BytesIO()
-
-    # 4. Create the ZIP file within the in-memory buffer.
-    with zipfile.ZipFile(zip_io_buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as temp_zip_file:
-        for root, _, files in os.walk(model_folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Define the name of the file inside the ZIP archive.
-                # os.path.relpath ensures the paths are relative to the model folder,
-                # recreating the directory structure correctly inside the zip.
-                archive_name = os.path.relpath(file_path, model_folder_path)
-                temp_zip_file.write(file_path, arcname=archive_name)
-
-    # 5. Rewind the in-memory buffer to the beginning.
-    zip_io_buffer.seek(0)
+    # 3. Serve the cached ZIP of this version of the model folder if there is one, else build it while streaming.
     download_filename = f"{job_id}_model.zip"
+    cache_path = _get_zip_cache_path(job_id, model_folder_path)
+    if os.path.exists(cache_path):
+        return FileResponse(cache_path, media_type="application/zip", filename=download_filename)
 
     return StreamingResponse(
-        content=zip_io_buffer,
+        content=iter_zip_folder(model_folder_path, cache_path=cache_path),
         media_type="application/zip",
         headers={"Content-Disposition": f"attachment; filename={download_filename}"},
     )
 
 
+class _ZipStreamBuffer:
+    """Write-only stream collecting the output of a ZipFile until it is read with pop()."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _get_zip_cache_path(job_id: str, model_folder_path: str) -> str:
+    # the latest modification time identifies the version of the folder, e.g. a new best checkpoint
+    latest_mtime_ns = max(
+        (
+            os.stat(os.path.join(root, file)).st_mtime_ns
+            for root, _, files in os.walk(model_folder_path)
+            for file in files
+        ),
+        default=0,
+    )
+    folder_name = os.path.basename(os.path.normpath(model_folder_path))
+    return os.path.join(TRAIN_JOB_OUTPUT_DIR, job_id, "download_cache", f"{folder_name}_{latest_mtime_ns}.zip")
+
+
+def iter_zip_folder(folder_path: str, cache_path: str | None = None):
+    """Yields a ZIP of the folder in chunks, so the archive is never held in memory.
+
+    Model weights are stored without compression, other files are deflated. If `cache_path` is given, the archive
+    is also written there once it was streamed completely, replacing the older archives in its directory.
+    """
+    cache_file = None
+    tmp_cache_path = None
+    if cache_path:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_cache_path = f"{cache_path}.tmp-{uuid.uuid4().hex}"
+        cache_file = open(tmp_cache_path, "wb")
+
+    def emit():
+        data = buffer.pop()
+        if cache_file and data:
+            cache_file.write(data)
+        return data
+
+    buffer = _ZipStreamBuffer()
+    completed = False
+    try:
+        with zipfile.ZipFile(buffer, mode="w") as zip_file:
+            for root, _, files in os.walk(folder_path):
+                for file in sorted(files):
+                    file_path = os.path.join(root, file)
+                    # os.path.relpath ensures the paths are relative to the model folder,
+                    # recreating the directory structure correctly inside the zip.
+                    zip_info = zipfile.ZipInfo.from_file(file_path, arcname=os.path.relpath(file_path, folder_path))
+                    zip_info.compress_type = (
+                        zipfile.ZIP_STORED if file.endswith(STORED_FILE_EXTENSIONS) else zipfile.ZIP_DEFLATED
+                    )
+                    with open(file_path, "rb") as src, zip_file.open(zip_info, "w") as dest:
+                        while chunk := src.read(FILE_CHUNK_SIZE):
+                            dest.write(chunk)
+                            if data := emit():
+                                yield data
+                    if data := emit():
+                        yield data
+        # the central directory is written on close
+        if data := emit():
+            yield data
+        completed = True
+    finally:
+        if cache_file:
+            cache_file.close()
+            if completed:
+                # archives of older versions of the model are not needed anymore
+                cache_dir = os.path.dirname(cache_path)
+                for old_file in os.listdir(cache_dir):
+                    if old_file.endswith(".zip"):
+                        os.remove(os.path.join(cache_dir, old_file))
+                os.replace(tmp_cache_path, cache_path)
+            else:
+                # client disconnected before the end
+                os.remove(tmp_cache_path)
+
+
 def extract_zip_from_path_sync(zip_path: str, output_dir: str):
     """Synchronously extracts a zip file from a path to a directory."""
     with zipfile.ZipFile(zip_path, "r") as zip_ref:
@@ -291,11 +437,13 @@ async def upload_finetuned_lora(
         job_db.update_job(job_id, status="extracting", detail="Extracting model artifacts from ZIP file.")
 
         zip_path = os.path.join(FILE_DOWNLOAD_DIR, f"{job_id}.zip")
-        with open(zip_path, "wb") as buffer:
-            while chunk := await file.read(1024 * 1024):
-                buffer.write(chunk)
-
-        await run_in_threadpool(extract_zip_from_path_sync, zip_path, output_dir)
+        try:
+            await _save_upload_file(file, zip_path)
+            await run_in_threadpool(extract_zip_from_path_sync, zip_path, output_dir)
+        finally:
+            # the extracted model is all we need
+            if os.path.exists(zip_path):
+                os.remove(zip_path)
 
         job_db.update_job(
             job_id,
@@ -28,6 +28,11 @@ class TrainConfig:
     csv_separator: str = ","
     shuffle: bool = True
     workers: int = 0
+    # if set, the datasets are decoded, resized and tokenized once into memory-mapped shards in this directory
+    # (one subdirectory per split, dataset, image size and model) and training reads the shards. Random crop
+    # augmentation is not applied then.
+    packed_dataset_dir: str = ""
+    pack_shard_size: int = 4096
 
     lora_rank: int = 16
     lora_alpha: int = 32
@@ -49,7 +54,11 @@ class TrainConfig:
     warmup: int = 500
     save_interval: int = 1000
     eval_interval: int = 100
-    eval_steps: int = 100
+    eval_steps: int = 100  # number of distinct eval batches per evaluation, 0 for the whole eval dataset
+    # stop training after this many evaluations without the eval loss improving by more than early_stopping_min_delta.
+    # 0 disables early stopping
+    early_stopping_patience: int = 0
+    early_stopping_min_delta: float = 0.0
 
 
 def parse_yaml_to_config(yaml_path: str) -> TrainConfig:
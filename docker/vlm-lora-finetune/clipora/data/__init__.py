@@ -1,11 +1,21 @@
+import bisect
+import hashlib
+import json
 import logging
 import os
+import shutil
+import uuid
 
 import datasets
+import numpy as np
 import pandas as pd
+import torch
 from open_clip import tokenize
 from PIL import Image
 from torch.utils.data import DataLoader, Dataset
+from torchvision import transforms as T
+
+PACKED_INDEX_FILE = "index.json"
 
 
 class HFDataset(Dataset):
@@ -51,22 +61,199 @@ class CSVDataset(Dataset):
         return images, texts
 
 
-def get_dataloader(args, preprocess, split="train"):
+class PackedDataset(Dataset):
+    """Dataset packed by pack_dataset: resized images and tokenized captions in memory-mapped numpy shards.
+
+    Reading a sample is a page cache read instead of decoding an image and tokenizing a caption. Only the conversion
+    to float and the normalization of `transforms` are applied to the images.
+    """
+
+    def __init__(self, data_location, transforms):
+        logging.debug(f"Loading packed data from {data_location}.")
+        self.data_location = data_location
+        with open(os.path.join(data_location, PACKED_INDEX_FILE)) as f:
+            self.index = json.load(f)
+        self.shard_offsets = np.cumsum([0] + [shard["num_samples"] for shard in self.index["shards"]]).tolist()
+        self.normalize = get_normalize_transform(transforms)
+        # memory maps are opened lazily, so they are not pickled into the dataloader workers
+        self.shards = None
+        logging.debug("Done loading data.")
+
+    def __len__(self):
+        return self.shard_offsets[-1]
+
+    def _open_shards(self):
+        self.shards = [
+            (
+                np.load(os.path.join(self.data_location, shard["images"]), mmap_mode="r"),
+                np.load(os.path.join(self.data_location, shard["texts"]), mmap_mode="r"),
+            )
+            for shard in self.index["shards"]
+        ]
+
+    def __getitem__(self, idx):
+        if self.shards is None:
+            self._open_shards()
+        shard_idx = bisect.bisect_right(self.shard_offsets, idx) - 1
+        images, texts = self.shards[shard_idx]
+        sample_idx = idx - self.shard_offsets[shard_idx]
+        image = torch.from_numpy(np.array(images[sample_idx])).permute(2, 0, 1).float().div_(255)
+        return self.normalize(image), torch.from_numpy(np.array(texts[sample_idx])).long()
+
+
+def get_image_size(transforms):
+    # open_clip transforms start with a Resize or RandomResizedCrop to the model input size
+    for transform in getattr(transforms, "transforms", []):
+        size = getattr(transform, "size", None)
+        if size is not None:
+            return size if isinstance(size, int) else size[0]
+    raise ValueError("Could not find the image size from the transforms.")
+
+
+def get_normalize_transform(transforms):
+    for transform in getattr(transforms, "transforms", []):
+        if isinstance(transform, T.Normalize):
+            return transform
+    raise ValueError("Could not find the normalization from the transforms.")
+
+
+class ResizeToArray:
+    """Resizes and center crops an image to a square uint8 HWC array, the format of the packed images."""
+
+    def __init__(self, image_size):
+        self.resize = T.Compose(
+            [T.Resize(image_size, interpolation=T.InterpolationMode.BICUBIC), T.CenterCrop(image_size)]
+        )
+
+    def __call__(self, image):
+        return np.asarray(self.resize(image.convert("RGB")), dtype=np.uint8)
+
+
+def pack_dataset(dataset, output_dir, image_size, shard_size=4096, batch_size=256, workers=0):
+    """Packs a dataset, created with ResizeToArray transforms, into memory-mapped shards readable by PackedDataset.
+
+    The shards are written to a temporary directory that is renamed to `output_dir` when complete, so an
+    interrupted run never leaves a partial packed dataset behind.
+    """
+    num_samples = len(dataset)
+    shard_sizes = [min(shard_size, num_samples - start) for start in range(0, num_samples, shard_size)]
+    tmp_dir = f"{output_dir.rstrip(os.sep)}.tmp-{uuid.uuid4().hex}"
+    os.makedirs(tmp_dir)
+    logging.info(f"Packing {num_samples} samples into {len(shard_sizes)} shards in {output_dir}.")
+
+    shards = []
+    for shard_idx, shard_num_samples in enumerate(shard_sizes):
+        shards.append(
+            {
+                "images": f"shard_{shard_idx:05d}_images.npy",
+                "texts": f"shard_{shard_idx:05d}_texts.npy",
+                "num_samples": shard_num_samples,
+            }
+        )
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=workers)
+    samples = ((image, text) for images, texts in loader for image, text in zip(images.numpy(), texts.numpy()))
+    context_length = None
+    for shard in shards:
+        images = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, shard["images"]),
+            mode="w+",
+            dtype=np.uint8,
+            shape=(shard["num_samples"], image_size, image_size, 3),
+        )
+        texts = None
+        for i in range(shard["num_samples"]):
+            image, text = next(samples)
+            if texts is None:
+                context_length = len(text)
+                texts = np.lib.format.open_memmap(
+                    os.path.join(tmp_dir, shard["texts"]),
+                    mode="w+",
+                    dtype=np.int32,
+                    shape=(shard["num_samples"], context_length),
+                )
+            images[i] = image
+            texts[i] = text
+        images.flush()
+        texts.flush()
+        del images, texts
+
+    with open(os.path.join(tmp_dir, PACKED_INDEX_FILE), "w") as f:
+        json.dump(
+            {
+                "num_samples": num_samples,
+                "image_size": image_size,
+                "context_length": context_length,
+                "shards": shards,
+            },
+            f,
+        )
+    try:
+        os.rename(tmp_dir, output_dir)
+    except OSError:
+        # another process (e.g. another training job) packed the same dataset first
+        shutil.rmtree(tmp_dir)
+    logging.info(f"Done packing {output_dir}.")
+
+
+def get_source_dataset(args, transforms, split):
     if args.datatype == "hf":
-        dataset = HFDataset(
+        return HFDataset(
             data_location=args.train_dataset if split == "train" else args.eval_dataset,
-            transforms=preprocess,
+            transforms=transforms,
             image_col=args.image_col,
             text_col=args.text_col,
         )
     elif args.datatype == "csv":
-        dataset = CSVDataset(
+        return CSVDataset(
             data_location=args.train_dataset if split == "train" else args.eval_dataset,
-            transforms=preprocess,
+            transforms=transforms,
             image_col=args.image_col,
             text_col=args.text_col,
             sep=args.csv_separator,
         )
+    raise ValueError(f"Unknown datatype: {args.datatype}")
+
+
+def get_packed_dataset_key(args, split, image_size):
+    """Hash of everything the packed samples depend on, so a changed dataset or model packs a new copy."""
+    data_location = args.train_dataset if split == "train" else args.eval_dataset
+    source = {
+        "datatype": args.datatype,
+        "data_location": os.path.abspath(data_location) if os.path.exists(data_location) else data_location,
+        "image_col": args.image_col,
+        "text_col": args.text_col,
+        "csv_separator": args.csv_separator if args.datatype == "csv" else None,
+        "image_size": image_size,
+        # the tokenizer and its context length come with the model
+        "model_name": args.model_name,
+    }
+    if os.path.isfile(data_location):
+        stat = os.stat(data_location)
+        source.update(size=stat.st_size, mtime=stat.st_mtime)
+    return hashlib.sha256(json.dumps(source, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_dataloader(args, preprocess, split="train", accelerator=None):
+    if args.packed_dataset_dir:
+        # decode, resize and tokenize once, then train from the packed shards
+        image_size = get_image_size(preprocess)
+        packed_dir = os.path.join(args.packed_dataset_dir, f"{split}-{get_packed_dataset_key(args, split, image_size)}")
+        # only the main process packs, the other ranks wait for it instead of packing the same dataset
+        is_main_process = accelerator is None or accelerator.is_main_process
+        if is_main_process and not os.path.exists(os.path.join(packed_dir, PACKED_INDEX_FILE)):
+            pack_dataset(
+                get_source_dataset(args, ResizeToArray(image_size), split),
+                packed_dir,
+                image_size=image_size,
+                shard_size=args.pack_shard_size,
+                batch_size=args.batch_size,
+                workers=args.workers,
+            )
+        if accelerator is not None:
+            accelerator.wait_for_everyone()
+        dataset = PackedDataset(packed_dir, preprocess)
+    else:
+        dataset = get_source_dataset(args, preprocess, split)
     num_samples = len(dataset)
 
     dataloader = DataLoader(
@@ -76,7 +263,8 @@ def get_dataloader(args, preprocess, split="train"):
         num_workers=args.workers,
         pin_memory=True,
         drop_last=True,
-        prefetch_factor=2,
+        prefetch_factor=2 if args.workers > 0 else None,
+        persistent_workers=args.workers > 0,
     )
 
     dataloader.num_samples = num_samples
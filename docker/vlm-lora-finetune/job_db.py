@@ -2,18 +2,48 @@ import datetime
 import logging
 import os
 import sqlite3
+import threading
+import time
 from typing import Any, Dict, Optional
 
 TRAIN_JOB_OUTPUT_DIR = os.getenv("TRAIN_JOB_OUTPUT_DIR", "/tmp/trained_models/")
 DB_PATH = os.path.join(TRAIN_JOB_OUTPUT_DIR, "training_jobs.db")
+# Minimum number of seconds between two progress writes of a job, if its percentage does not change
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "10"))
+
+# Structured progress columns
+PROGRESS_COLUMNS = {
+    "progress": "REAL",
+    "step": "INTEGER",
+    "total_steps": "INTEGER",
+    "loss": "REAL",
+}
+# Columns added after the first version of the table, added to databases created before they existed
+ADDED_COLUMNS = {
+    **PROGRESS_COLUMNS,
+    "priority": "INTEGER NOT NULL DEFAULT 0",
+    "device": "TEXT",
+    "config": "TEXT",
+    "zip_path": "TEXT",
+}
+# Statuses of jobs whose training was started, requeued if the API restarts while they run
+STARTED_STATUSES = ("starting", "extracting", "training")
+
+# One connection per process and thread, sqlite connections can't be shared between threads
+_local = threading.local()
 
 
 def get_db_connection():
-    """Establishes a database connection."""
-    logging.debug(f"Using sqlite database located in {DB_PATH}")
-    conn = sqlite3.connect(DB_PATH, timeout=15)
-    conn.execute("PRAGMA journal_mode=WAL;")
-    conn.row_factory = sqlite3.Row
+    """Returns the database connection of the current process and thread, connecting on first use."""
+    conn = getattr(_local, "conn", None)
+    if conn is None or _local.pid != os.getpid():
+        logging.debug(f"Using sqlite database located in {DB_PATH}")
+        conn = sqlite3.connect(DB_PATH, timeout=15)
+        conn.execute("PRAGMA journal_mode=WAL;")
+        conn.execute("PRAGMA synchronous=NORMAL;")
+        conn.row_factory = sqlite3.Row
+        _local.conn = conn
+        _local.pid = os.getpid()
     return conn
 
 
@@ -23,9 +53,12 @@ def init_db():
     This is the primary place to define the table schema.
     """
     conn = get_db_connection()
-    try:
+    with conn:
         # best_finetuned_model_path is the path to latest checkpoint
         # folder will contain model weights and config that were saved with hf peft
+        # progress is the training progress in percent, loss the latest training loss
+        # config (training config YAML), zip_path (training data) and priority are used by the job scheduler
+        # to start queued jobs, device is the device a started job trains on
         conn.execute(
             """
             CREATE TABLE IF NOT EXISTS jobs (
@@ -33,14 +66,26 @@ def init_db():
                 status TEXT NOT NULL,
                 detail TEXT,
                 best_finetuned_model_path TEXT,
+                progress REAL,
+                step INTEGER,
+                total_steps INTEGER,
+                loss REAL,
+                priority INTEGER NOT NULL DEFAULT 0,
+                device TEXT,
+                config TEXT,
+                zip_path TEXT,
                 created_at TEXT NOT NULL,
                 updated_at TEXT NOT NULL
             )
         """
         )
-        conn.commit()
-    finally:
-        conn.close()
+        existing_columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in ADDED_COLUMNS.items():
+            if column not in existing_columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_created_at ON jobs (created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, priority DESC, created_at)")
 
 
 def create_job(job_id: str, **kwargs: Any):
@@ -62,11 +107,8 @@ def create_job(job_id: str, **kwargs: Any):
     sql = f"INSERT INTO jobs ({columns}) VALUES ({placeholders})"
 
     conn = get_db_connection()
-    try:
+    with conn:
         conn.execute(sql, tuple(job_data.values()))
-        conn.commit()
-    finally:
-        conn.close()
 
 
 def update_job(job_id: str, **kwargs: Any):
@@ -76,7 +118,7 @@ def update_job(job_id: str, **kwargs: Any):
     if not kwargs:
         return  # Nothing to update
 
-    print(f"Updating job {job_id}")
+    logging.debug(f"Updating job {job_id}")
     # Automatically update the 'updated_at' timestamp
     kwargs["updated_at"] = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
@@ -84,35 +126,118 @@ def update_job(job_id: str, **kwargs: Any):
     sql = f"UPDATE jobs SET {set_clause} WHERE id = ?"
 
     conn = get_db_connection()
-    try:
+    with conn:
         conn.execute(sql, (*kwargs.values(), job_id))
-        conn.commit()
-    finally:
-        conn.close()
 
 
 def get_job(job_id: str) -> Optional[Dict]:
     """Fetches a job record by its ID and returns it as a dictionary."""
+    row = get_db_connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_all_jobs(limit: Optional[int] = None, offset: int = 0, status: Optional[str] = None) -> Optional[list[Dict]]:
+    """Fetches job records, newest first, and returns them as a list of dictionaries.
+
+    Args:
+        limit (int, optional): Maximum number of jobs to return. Defaults to None, all jobs.
+        offset (int, optional): Number of jobs to skip. Defaults to 0.
+        status (str, optional): Only return jobs with this status. Defaults to None, any status.
+    """
+    sql = "SELECT * FROM jobs"
+    params: list[Any] = []
+    if status is not None:
+        sql += " WHERE status = ?"
+        params.append(status)
+    sql += " ORDER BY created_at DESC LIMIT ? OFFSET ?"
+    params += [limit if limit is not None else -1, offset]
+    rows = get_db_connection().execute(sql, params).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_queued_jobs(limit: int) -> list[Dict]:
+    """Fetches the next queued jobs to start, highest priority first, then oldest first."""
+    rows = (
+        get_db_connection()
+        .execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND config IS NOT NULL "
+            "ORDER BY priority DESC, created_at ASC LIMIT ?",
+            (limit,),
+        )
+        .fetchall()
+    )
+    return [dict(row) for row in rows]
+
+
+def claim_job(job_id: str, device: str) -> bool:
+    """Marks a queued job as starting on a device. Returns False if the job is not queued anymore (e.g. cancelled)."""
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    with conn:
+        cursor = conn.execute(
+            "UPDATE jobs SET status = 'starting', detail = ?, device = ?, updated_at = ? "
+            "WHERE id = ? AND status = 'queued'",
+            (f"Starting on device {device}.", device, now, job_id),
+        )
+    return cursor.rowcount == 1
+
 
+def requeue_started_jobs() -> int:
+    """Puts jobs that were started but did not finish, e.g. because the API restarted, back in the queue.
 
-def get_all_jobs() -> Optional[list[Dict]]:
-    """Fetches all job records and returns them as a list of dictionaries."""
+    Returns:
+        int: The number of requeued jobs.
+    """
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    placeholders = ", ".join(["?"] * len(STARTED_STATUSES))
     conn = get_db_connection()
-    try:
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM jobs")
-        rows = cursor.fetchall()
-        return [dict(row) for row in rows] if rows else []
-    finally:
-        conn.close()
+    with conn:
+        cursor = conn.execute(
+            f"UPDATE jobs SET status = 'queued', detail = 'Job was interrupted and is waiting to restart.', "
+            f"device = NULL, progress = NULL, step = NULL, loss = NULL, updated_at = ? "
+            f"WHERE status IN ({placeholders}) AND config IS NOT NULL",
+            (now, *STARTED_STATUSES),
+        )
+    return cursor.rowcount
+
+
+class JobProgressReporter:
+    """Job callback that coalesces the training progress updates of a job.
+
+    Progress updates (progress, step, total_steps, loss) are only written when the integer percentage changes or
+    `min_interval` seconds have passed since the last write. Any other update (e.g. status or
+    best_finetuned_model_path) is written immediately, together with the pending progress.
+    """
+
+    def __init__(self, job_id: str, min_interval: float = PROGRESS_UPDATE_INTERVAL):
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.pending: Dict[str, Any] = {}
+        self.last_percentage: Optional[int] = None
+        self.last_write_time = 0.0
+
+    def __call__(self, **kwargs: Any):
+        progress_only = all(key in PROGRESS_COLUMNS for key in kwargs)
+        self.pending.update(kwargs)
+        percentage = int(self.pending["progress"]) if self.pending.get("progress") is not None else None
+        if (
+            progress_only
+            and percentage == self.last_percentage
+            and time.monotonic() - self.last_write_time < self.min_interval
+        ):
+            return
+        self.flush()
+
+    def flush(self):
+        """Writes the pending updates, if any."""
+        if not self.pending:
+            return
+        if self.pending.get("progress") is not None:
+            self.last_percentage = int(self.pending["progress"])
+            self.pending.setdefault("detail", f"Training at {self.last_percentage}%")
+        update_job(self.job_id, **self.pending)
+        self.pending = {}
+        self.last_write_time = time.monotonic()
 
 
 def create_job_callback(job_id):
@@ -121,8 +246,4 @@ def create_job_callback(job_id):
     Args:
         job_id (str): The ID of the job to update.
     """
-
-    def callback(**kwargs):
-        update_job(job_id, **kwargs)
-
-    return callback
+    return JobProgressReporter(job_id)
@@ -0,0 +1,187 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import threading
+from typing import Callable, Optional
+
+import job_db
+import yaml  # type: ignore[import-untyped]
+from clipora.config import TrainConfig
+
+# Devices training jobs run on, e.g. "0,1". Defaults to all visible GPUs, or "cpu" if there are none
+TRAIN_DEVICES = os.getenv("TRAIN_DEVICES", "")
+# Number of jobs training at the same time on each device
+JOBS_PER_DEVICE = int(os.getenv("JOBS_PER_DEVICE", "1"))
+# Seconds between checks of the queue and the running jobs, in addition to checks on submit and cancel
+SCHEDULER_POLL_INTERVAL = float(os.getenv("SCHEDULER_POLL_INTERVAL", "5"))
+
+# Statuses written by the job itself when it ends
+FINAL_STATUSES = ("complete", "failed", "cancelled")
+
+# Environment variables pinning a job process to its device
+DEVICE_ENV_VARS = ("CUDA_VISIBLE_DEVICES", "HIP_VISIBLE_DEVICES")
+_ENVIRON_LOCK = threading.Lock()
+
+
+def get_default_devices() -> list[str]:
+    import torch
+
+    if torch.cuda.is_available():
+        return [str(i) for i in range(torch.cuda.device_count())]
+    return ["cpu"]
+
+
+@contextlib.contextmanager
+def device_environment(device: str):
+    """Sets the device environment variables while starting a job process.
+
+    A spawned process starts with the environment of its parent, and unpickling its target imports modules that
+    initialize the GPU, so the variables must be set before the process starts rather than in the process.
+    """
+    with _ENVIRON_LOCK:
+        saved = {name: os.environ.get(name) for name in DEVICE_ENV_VARS}
+        if device != "cpu":
+            for name in DEVICE_ENV_VARS:
+                os.environ[name] = device
+        try:
+            yield
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+
+class JobScheduler:
+    """Starts queued training jobs from the jobs table, at most `jobs_per_device` at a time on each device.
+
+    The queue is the jobs table itself (status "queued", ordered by priority then creation time), so queued jobs
+    survive API restarts, and jobs that were training when the API stopped are requeued on start. Each job trains
+    in its own process, pinned to its device with CUDA_VISIBLE_DEVICES/HIP_VISIBLE_DEVICES, so it can be cancelled
+    by terminating the process.
+
+    Args:
+        target (Callable): The function training a job, called with (job_id, config, zip_path).
+        devices (list[str], optional): The devices to train on. Defaults to TRAIN_DEVICES, or all GPUs.
+        jobs_per_device (int, optional): Number of concurrent jobs per device. Defaults to JOBS_PER_DEVICE.
+        poll_interval (float, optional): Seconds between checks of the queue. Defaults to SCHEDULER_POLL_INTERVAL.
+    """
+
+    def __init__(
+        self,
+        target: Callable,
+        devices: Optional[list[str]] = None,
+        jobs_per_device: int = JOBS_PER_DEVICE,
+        poll_interval: float = SCHEDULER_POLL_INTERVAL,
+    ):
+        if devices is None:
+            devices = TRAIN_DEVICES.split(",") if TRAIN_DEVICES else get_default_devices()
+        self.target = target
+        self.devices = [device.strip() for device in devices]
+        self.jobs_per_device = jobs_per_device
+        self.poll_interval = poll_interval
+        self.running: dict[str, tuple[multiprocessing.Process, str]] = {}  # job id -> (process, device)
+        # spawn, as the API process may have initialized the GPU for inference
+        self.mp_context = multiprocessing.get_context("spawn")
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        requeued = job_db.requeue_started_jobs()
+        if requeued:
+            logging.info(f"Requeued {requeued} interrupted training jobs.")
+        logging.info(f"Scheduling training jobs on devices {self.devices}, {self.jobs_per_device} per device.")
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stops scheduling and terminates the running jobs, which are requeued on the next start."""
+        if self.task is not None:
+            self.task.cancel()
+        for process, _ in self.running.values():
+            process.terminate()
+        for process, _ in self.running.values():
+            await asyncio.to_thread(process.join)
+        self.running.clear()
+
+    def notify(self):
+        """Wakes up the scheduler, e.g. after a job was submitted."""
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                self.reap_finished_jobs()
+                self.start_queued_jobs()
+            except Exception:
+                logging.exception("Error while scheduling training jobs")
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def get_free_devices(self) -> list[str]:
+        jobs_on_device = {device: 0 for device in self.devices}
+        for _, device in self.running.values():
+            jobs_on_device[device] += 1
+        # one entry per free slot, least loaded devices first
+        return [
+            device
+            for n_jobs, device in sorted((n_jobs, device) for device, n_jobs in jobs_on_device.items())
+            for _ in range(self.jobs_per_device - n_jobs)
+        ]
+
+    def start_queued_jobs(self):
+        free_devices = self.get_free_devices()
+        if not free_devices:
+            return
+        for job, device in zip(job_db.get_queued_jobs(limit=len(free_devices)), free_devices):
+            if not job_db.claim_job(job["id"], device):
+                continue
+            try:
+                config = TrainConfig(**yaml.safe_load(job["config"]))
+                process = self.mp_context.Process(
+                    target=self.target, args=(job["id"], config, job["zip_path"]), name=f"train-{job['id']}"
+                )
+                with device_environment(device):
+                    process.start()
+            except Exception as e:
+                logging.exception(f"Failed to start job {job['id']}")
+                job_db.update_job(job["id"], status="failed", detail=f"Failed to start job: {e}")
+                continue
+            logging.info(f"Started job {job['id']} on device {device} (priority {job['priority']}).")
+            self.running[job["id"]] = (process, device)
+
+    def reap_finished_jobs(self):
+        for job_id, (process, _) in list(self.running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            del self.running[job_id]
+            job = job_db.get_job(job_id)
+            if job and job["status"] not in FINAL_STATUSES:
+                job_db.update_job(
+                    job_id,
+                    status="failed",
+                    detail=f"Training process exited unexpectedly (exit code {process.exitcode}).",
+                )
+            logging.info(f"Job {job_id} finished with status {job['status'] if job else None}.")
+
+    async def cancel(self, job_id: str) -> bool:
+        """Cancels a queued or running job. Returns False if the job is not queued or running."""
+        job = job_db.get_job(job_id)
+        if job is None or job["status"] in FINAL_STATUSES:
+            return False
+        if job_id in self.running:
+            process, _ = self.running.pop(job_id)
+            process.terminate()
+            await asyncio.to_thread(process.join, 30)
+        elif job["status"] != "queued":
+            # started, but not by this scheduler
+            return False
+        job_db.update_job(job_id, status="cancelled", detail="Job was cancelled.")
+        self.notify()
+        return True
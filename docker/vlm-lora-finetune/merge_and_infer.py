@@ -4,9 +4,12 @@
 # lora adapter weights.
 
 import argparse
+import itertools
 import os
 import re
 import shutil
+import threading
+from collections import OrderedDict
 
 import open_clip
 import torch
@@ -20,6 +23,14 @@ from train import main as train_main
 
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
+# Loaded models kept for inference requests, see ModelCache
+MODEL_CACHE_MAX_MODELS = int(os.getenv("MODEL_CACHE_MAX_MODELS", "2"))
+MODEL_CACHE_MAX_MEMORY_GB = float(os.getenv("MODEL_CACHE_MAX_MEMORY_GB", "0"))  # 0 = no memory bound
+# Merge the LoRA weights into the base weights of cached models, so inference runs without the adapter overhead
+MERGE_LORA_FOR_INFERENCE = os.getenv("MERGE_LORA_FOR_INFERENCE", "true").lower() == "true"
+# Number of class texts whose features are kept per cached model, see TextFeatureCache
+TEXT_FEATURE_CACHE_SIZE = int(os.getenv("TEXT_FEATURE_CACHE_SIZE", "4096"))
+
 
 def compute_clip_loss(model, X, Y):
     loss = open_clip.ClipLoss()
@@ -99,38 +110,184 @@ def run_inference_comparison(lora_model, preprocess, config):
     visualize_results.main(original_model, lora_model, preprocess, config)
 
 
-def run_single_inference(job_dict, image_path, classes: list[str]):
-    # run inference on a single image using the LORA model
-    # gets the finetuned model that was saved in the training job job_id
-    if not job_dict:
-        print("No job info provided")
-        return None, None
-
+def get_lora_adapter_path(job_dict):
     TRAIN_JOB_OUTPUT_DIR = os.getenv("TRAIN_JOB_OUTPUT_DIR", "/tmp/trained_models/")
     lora_adapter_path = job_dict["best_finetuned_model_path"]
     # If relative path, assume it's relative to TRAIN_JOB_OUTPUT_DIR
     if not os.path.isabs(lora_adapter_path):
         lora_adapter_path = os.path.join(TRAIN_JOB_OUTPUT_DIR, job_dict["id"], lora_adapter_path)
-    config_path = os.path.join(lora_adapter_path, "train_config.yaml")
-    config = parse_yaml_to_config(config_path)
-    lora_model, preprocess = init_model(config, lora_adapter_path=lora_adapter_path)
-    lora_model.to(device)
-    processed_image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
+    return lora_adapter_path
+
+
+def get_model_memory(model):
+    return sum(
+        tensor.numel() * tensor.element_size() for tensor in itertools.chain(model.parameters(), model.buffers())
+    )
 
-    text_tokens = open_clip.tokenize(classes).to(device)
+
+class TextFeatureCache:
+    """LRU cache of the normalized text features of a model, keyed by class text.
+
+    Clients query the same class lists over and over, so in steady state only the image tower has to run.
+    """
+
+    def __init__(self, max_size=TEXT_FEATURE_CACHE_SIZE):
+        self.max_size = max_size
+        self.features = OrderedDict()  # class text -> normalized text features
+        self.lock = threading.Lock()
+
+    def get_features(self, model, classes: list[str]):
+        """Returns the normalized text features of the classes, stacked, encoding only the classes not in the cache."""
+        with self.lock:
+            missing = list(dict.fromkeys(text for text in classes if text not in self.features))
+            if missing:
+                text_tokens = open_clip.tokenize(missing).to(device)
+                with torch.no_grad(), torch.autocast("cuda"):
+                    text_features = model.encode_text(text_tokens)
+                    text_features /= text_features.norm(dim=-1, keepdim=True)
+                self.features.update(zip(missing, text_features))
+            for text in classes:
+                self.features.move_to_end(text)
+            text_features = torch.stack([self.features[text] for text in classes])
+            # never evict the classes of this request, even if there are more of them than max_size
+            while len(self.features) > max(self.max_size, len(set(classes))):
+                self.features.popitem(last=False)
+            return text_features
+
+
+class ModelCache:
+    """LRU cache of LoRA models loaded for inference.
+
+    Models are keyed by job id and adapter path, so a job that saves a new best checkpoint gets its new model loaded,
+    while the old one ages out. The least recently used models are evicted when there are more than `max_models`
+    models or, if `max_memory_bytes` is set, when their parameters take more memory than that. The newest model is
+    always kept. Each model has its own TextFeatureCache, evicted together with the model.
+    """
+
+    def __init__(
+        self,
+        max_models=MODEL_CACHE_MAX_MODELS,
+        max_memory_bytes=MODEL_CACHE_MAX_MEMORY_GB * 1024**3,
+        merge=MERGE_LORA_FOR_INFERENCE,
+    ):
+        self.max_models = max_models
+        self.max_memory_bytes = max_memory_bytes
+        self.merge = merge
+        # (job id, adapter path) -> (model, preprocess, text feature cache, memory in bytes)
+        self.models = OrderedDict()
+        # Guards self.models and self.loading_locks, held only for lookups, inserts and evictions
+        self.lock = threading.Lock()
+        # One lock per model being loaded, so concurrent requests for the same job load its model only once, while
+        # requests for other jobs are served meanwhile
+        self.loading_locks = {}
+
+    def _lookup(self, key):
+        # must hold self.lock
+        if key not in self.models:
+            return None
+        self.models.move_to_end(key)
+        model, preprocess, text_feature_cache, _ = self.models[key]
+        return model, preprocess, text_feature_cache
+
+    def get(self, job_dict):
+        """Returns the (model, preprocess, text feature cache) of a job, loading the model on a cache miss."""
+        lora_adapter_path = get_lora_adapter_path(job_dict)
+        key = (job_dict["id"], lora_adapter_path)
+        with self.lock:
+            cached = self._lookup(key)
+            if cached is not None:
+                return cached
+            loading_lock = self.loading_locks.setdefault(key, threading.Lock())
+
+        with loading_lock:
+            # another request may have loaded the model while this one waited
+            with self.lock:
+                cached = self._lookup(key)
+            if cached is not None:
+                return cached
+
+            try:
+                print(f"Loading model of job {job_dict['id']} from {lora_adapter_path}")
+                config = parse_yaml_to_config(os.path.join(lora_adapter_path, "train_config.yaml"))
+                model, preprocess = init_model(config, lora_adapter_path=lora_adapter_path)
+                if self.merge:
+                    model = model.merge_and_unload()
+                model.to(device)
+                model.eval()
+                text_feature_cache = TextFeatureCache()
+                with self.lock:
+                    self.models[key] = (model, preprocess, text_feature_cache, get_model_memory(model))
+                    self.evict()
+            finally:
+                with self.lock:
+                    self.loading_locks.pop(key, None)
+            return model, preprocess, text_feature_cache
+
+    def evict(self):
+        # must hold self.lock
+        while len(self.models) > 1 and (
+            len(self.models) > self.max_models
+            or (
+                self.max_memory_bytes > 0 and sum(memory for *_, memory in self.models.values()) > self.max_memory_bytes
+            )
+        ):
+            (job_id, lora_adapter_path), _ = self.models.popitem(last=False)
+            print(f"Evicted model of job {job_id} ({lora_adapter_path}) from the model cache")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    def clear(self):
+        with self.lock:
+            self.models.clear()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+model_cache = ModelCache()
+
+
+def run_batch_inference(job_dict, images, classes: list[str]):
+    """Runs inference on several images with the finetuned model of a job, in a single forward pass.
+
+    Args:
+        job_dict (dict): The job, as returned by job_db.get_job.
+        images (list): Image paths or file-like objects.
+        classes (list[str]): The texts/classes to compare each image with.
+
+    Returns:
+        tuple: The class probabilities of each image (list of lists) and the classes, or (None, None) if no job info
+        was provided.
+    """
+    if not job_dict:
+        print("No job info provided")
+        return None, None
+
+    lora_model, preprocess, text_feature_cache = model_cache.get(job_dict)
+    processed_images = []
+    for image in images:
+        with Image.open(image) as img:
+            processed_images.append(preprocess(img.convert("RGB")))
+    processed_images = torch.stack(processed_images).to(device)
+
+    text_features = text_feature_cache.get_features(lora_model, classes)
 
     with torch.no_grad(), torch.autocast("cuda"):
-        image_features = lora_model.encode_image(processed_image)
-        text_features = lora_model.encode_text(text_tokens)
+        image_features = lora_model.encode_image(processed_images)
         image_features /= image_features.norm(dim=-1, keepdim=True)
-        text_features /= text_features.norm(dim=-1, keepdim=True)
 
         text_probs = (100.0 * image_features @ text_features.T).softmax(dim=-1).cpu().numpy()
 
-    print(text_probs)
     return text_probs.tolist(), classes
 
 
+def run_single_inference(job_dict, image, classes: list[str]):
+    # run inference on a single image (path or file-like object) using the LORA model
+    # gets the finetuned model that was saved in the training job job_id, see ModelCache
+    probabilities, classes = run_batch_inference(job_dict, [image], classes)
+    print(probabilities)
+    return probabilities, classes
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Run inference comparison between original CLIP model and LORA fine-tuned model.",
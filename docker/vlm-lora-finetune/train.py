@@ -27,15 +27,22 @@ def compute_clip_loss(model, X, Y):
 
 
 @torch.no_grad()
-def evaluate(model, dataloader, config):
+def evaluate(model, dataloader, config, accelerator):
+    """Computes the mean loss over the first `config.eval_steps` batches (all batches if 0) of the eval dataloader.
+
+    Must be called on all processes: each one evaluates its shard of the data and the losses are gathered, so every
+    process gets the same eval loss.
+    """
     out = {}
     model.eval()
-    losses = torch.zeros(config.eval_steps)
-    for k in range(config.eval_steps):
-        X, Y = next(iter(dataloader))
-        loss = compute_clip_loss(model, X, Y)
-        losses[k] = loss.item()
-    out["eval_loss"] = losses.mean()
+    # loss sum and number of batches of this process
+    totals = torch.zeros(2, device=accelerator.device)
+    batches = itertools.islice(dataloader, config.eval_steps) if config.eval_steps > 0 else dataloader
+    for X, Y in batches:
+        totals[0] += compute_clip_loss(model, X, Y).detach().float()
+        totals[1] += 1
+    totals = accelerator.reduce(totals, reduction="sum")
+    out["eval_loss"] = (totals[0] / totals[1]).item() if totals[1] > 0 else float("nan")
     model.train()
     return out
 
@@ -91,7 +98,7 @@ def main(config: TrainConfig, job_callback: Callable | None = None):
     Args:
         config (TrainConfig): clipora training config
         job_callback (Callable | None, optional): A callback function to update job status
-        each iteration. Used by API. Defaults to None.
+        each iteration, with progress, step, total_steps and loss keyword arguments. Used by API. Defaults to None.
     """
     logging.basicConfig(level=logging.INFO)
 
@@ -120,8 +127,8 @@ def main(config: TrainConfig, job_callback: Callable | None = None):
 
     model, preprocess_train = init_model(config)
 
-    train_dataloader = get_dataloader(config, preprocess_train, "train")
-    eval_dataloader = get_dataloader(config, preprocess_train, "val")
+    train_dataloader = get_dataloader(config, preprocess_train, "train", accelerator)
+    eval_dataloader = get_dataloader(config, preprocess_train, "val", accelerator)
     assert len(train_dataloader), "No data found, please check your data location."
 
     if config.gradient_checkpointing:
@@ -181,25 +188,38 @@ def main(config: TrainConfig, job_callback: Callable | None = None):
     progress_bar.set_description("Steps")
     global_step = 0
     best_val_loss = float("inf")
+    # number of evaluations since the eval loss last improved, for early stopping
+    evals_without_improvement = 0
+    stop_training = False
 
     for epoch in range(config.epochs):
         model.train()
         for step, batch in enumerate(train_dataloader):
-            if accelerator.is_local_main_process:
-                if global_step % config.eval_interval == 0:
+            if global_step % config.eval_interval == 0:
+                # all processes evaluate their shard of the eval data, so they all get the same eval loss
+                eval_loss = evaluate(model, eval_dataloader, config, accelerator)
+                accelerator.log(eval_loss, step=global_step)
+                if accelerator.is_local_main_process:
+                    progress_bar.write(f"Step: {global_step}, Eval loss: {eval_loss['eval_loss']}")
+                if eval_loss["eval_loss"] < best_val_loss - config.early_stopping_min_delta:
+                    best_val_loss = eval_loss["eval_loss"]
+                    evals_without_improvement = 0
                     if accelerator.is_local_main_process:
-                        eval_loss = evaluate(model, eval_dataloader, config)
-                        accelerator.log(eval_loss, step=global_step)
-                        progress_bar.write(f"Step: {global_step}, Eval loss: {eval_loss['eval_loss']}")
-                        if eval_loss["eval_loss"] < best_val_loss:
-                            best_val_loss = eval_loss["eval_loss"]
-                            checkpoint_name = f"checkpoint_{global_step}"
-                            save_path = os.path.join(config.output_dir, checkpoint_name)
-                            model.save_pretrained(save_path)
-                            if job_callback:
-                                job_callback(best_finetuned_model_path=checkpoint_name)
-                            # save the clipora config we used for training for later use and bookkeeping
-                            save_config_to_yaml(config, os.path.join(save_path, "train_config.yaml"))
+                        checkpoint_name = f"checkpoint_{global_step}"
+                        save_path = os.path.join(config.output_dir, checkpoint_name)
+                        model.save_pretrained(save_path)
+                        if job_callback:
+                            job_callback(best_finetuned_model_path=checkpoint_name)
+                        # save the clipora config we used for training for later use and bookkeeping
+                        save_config_to_yaml(config, os.path.join(save_path, "train_config.yaml"))
+                else:
+                    evals_without_improvement += 1
+                    if 0 < config.early_stopping_patience <= evals_without_improvement:
+                        accelerator.print(
+                            f"Eval loss has not improved in {evals_without_improvement} evaluations, stopping early."
+                        )
+                        stop_training = True
+                        break
 
             X, Y = batch
             loss = compute_clip_loss(model, X, Y)
@@ -210,19 +230,25 @@ def main(config: TrainConfig, job_callback: Callable | None = None):
             optimizer.step()
             scheduler(global_step)
             progress_bar.update(1)
-            if job_callback:
-                percent = int((epoch * len(train_dataloader) + step) / (config.epochs * len(train_dataloader)) * 100)
-                job_callback(status="training", detail=f"Training at {percent}%")
             global_step += 1
+            loss_value = loss.item()
+            if job_callback and accelerator.is_main_process:
+                # the callback coalesces these updates, see job_db.JobProgressReporter
+                total_steps = config.epochs * len(train_dataloader)
+                job_callback(
+                    progress=100 * global_step / total_steps, step=global_step, total_steps=total_steps, loss=loss_value
+                )
 
             logs = {
-                "loss": loss.item(),
+                "loss": loss_value,
                 "learning_rate": optimizer.param_groups[0]["lr"],
                 "step": global_step,
                 "epoch": epoch,
             }
             progress_bar.set_postfix(**logs)
             accelerator.log(logs, step=global_step)
+        if stop_training:
+            break
 
     accelerator.wait_for_everyone()
 
@@ -0,0 +1,307 @@
+"""
+Load-generation benchmark for the SwinUNETR inference service.
+
+Replays the volumes of a directory against the service at a fixed concurrency (closed loop) or at a fixed arrival
+rate (open loop, Poisson arrivals), and reports latency percentiles, throughput and the mean duration of each
+stage from the Server-Timing response header.
+
+Examples:
+
+    # benchmark a running service (e.g. port forwarded) at 1, 4 and 8 concurrent clients
+    python benchmark.py --data-dir ./Abdomen/RawData/Training/img --concurrency 1 4 8
+
+    # start the service locally for each combination of settings, with the stub model and synthetic volumes,
+    # so it runs without a GPU
+    python benchmark.py --service-dir ../helm/mount --stub-model --synthetic 4 --concurrency 1 4 \\
+        --sweep INFER_OVERLAP=0.25,0.5 --sweep SW_BATCH_SIZE=4,8
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import numpy as np
+import requests
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+LOGGER = logging.getLogger(__name__)
+
+VOLUME_SUFFIXES = (".nii.gz", ".nii", ".npy")
+
+
+def get_volume_paths(data_dir: str) -> List[str]:
+    """Returns the paths of the volumes (.nii, .nii.gz or .npy) in a directory, sorted."""
+    paths = sorted(
+        os.path.join(data_dir, file_name) for file_name in os.listdir(data_dir) if file_name.endswith(VOLUME_SUFFIXES)
+    )
+    if not paths:
+        raise ValueError(f"No .nii, .nii.gz or .npy volumes found in {data_dir}")
+    return paths
+
+
+def write_synthetic_volumes(output_dir: str, num_volumes: int, shape: List[int], seed: int = 0) -> List[str]:
+    """Writes random CT-like volumes (Hounsfield units) as .npy files, for benchmarking without a dataset."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(num_volumes):
+        path = os.path.join(output_dir, f"synthetic_{i:03d}.npy")
+        np.save(path, rng.uniform(-1000, 1000, size=shape).astype(np.float32))
+        paths.append(path)
+    return paths
+
+
+def parse_server_timing(header: Optional[str]) -> Dict[str, float]:
+    """Parses a Server-Timing header ("stage;dur=12.3, ...") into durations in milliseconds per stage."""
+    timings: Dict[str, float] = {}
+    for entry in (header or "").split(","):
+        name, *params = [part.strip() for part in entry.split(";")]
+        for param in params:
+            if name and param.startswith("dur="):
+                timings[name] = float(param.removeprefix("dur="))
+    return timings
+
+
+def send_volume(
+    session: requests.Session, server_url: str, image_path: str, timeout: float, start: Optional[float] = None
+) -> dict:
+    """Sends one volume to the prediction endpoint and returns its latency, status and stage timings.
+
+    The latency is measured from `start` (a time.perf_counter() value), e.g. the scheduled arrival of the request,
+    and defaults to the time the request is sent.
+    """
+    with open(image_path, "rb") as f:
+        content = f.read()
+    start = time.perf_counter() if start is None else start
+    try:
+        response = session.post(server_url, files={"file": (os.path.basename(image_path), content)}, timeout=timeout)
+        status = response.status_code
+        timings = parse_server_timing(response.headers.get("Server-Timing"))
+        response_bytes = len(response.content)
+    except requests.exceptions.RequestException as e:
+        LOGGER.error(f"Request for {image_path} failed: {e}")
+        status, timings, response_bytes = None, {}, 0
+    return {
+        "image_path": image_path,
+        "latency": time.perf_counter() - start,
+        "status": status,
+        "timings": timings,
+        "response_bytes": response_bytes,
+    }
+
+
+def run_load(
+    server_url: str,
+    image_paths: List[str],
+    num_requests: int,
+    concurrency: int,
+    arrival_rate: Optional[float] = None,
+    timeout: float = 600.0,
+    seed: int = 0,
+) -> tuple[List[dict], float]:
+    """Replays the volumes against the service, cycling through them.
+
+    Args:
+        server_url (str): URL of the prediction endpoint.
+        image_paths (List[str]): Volumes to send.
+        num_requests (int): Number of requests to send.
+        concurrency (int): Maximum number of requests in flight.
+        arrival_rate (float, optional): If set, requests arrive at this mean rate (requests/s, Poisson arrivals)
+            instead of each client sending its next request as soon as the previous one returns. Latencies are then
+            measured from the scheduled arrivals, so they include the time requests wait for a free client.
+        timeout (float): Timeout of each request in seconds.
+        seed (int): Seed of the arrival times.
+
+    Returns:
+        The result of each request (see send_volume) and the wall time of the run in seconds.
+    """
+    paths = itertools.islice(itertools.cycle(image_paths), num_requests)
+    sessions = threading.local()
+
+    def send(path, scheduled_start=None):
+        if not hasattr(sessions, "session"):
+            sessions.session = requests.Session()
+        return send_volume(sessions.session, server_url, path, timeout, start=scheduled_start)
+
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if arrival_rate:
+            futures = []
+            next_arrival = start
+            for path in paths:
+                next_arrival += rng.expovariate(arrival_rate)
+                time.sleep(max(next_arrival - time.perf_counter(), 0))
+                # measured from the arrival, not when a client is free, to avoid coordinated omission
+                futures.append(executor.submit(send, path, next_arrival))
+            results = [future.result() for future in futures]
+        else:
+            results = list(executor.map(send, paths))
+    return results, time.perf_counter() - start
+
+
+def summarize(results: List[dict], wall_time: float) -> dict:
+    """Computes latency percentiles (seconds), throughput and mean stage timings (ms) of successful requests."""
+    successful = [result for result in results if result["status"] == 200]
+    latencies = np.array([result["latency"] for result in successful])
+    summary = {
+        "requests": len(results),
+        "errors": len(results) - len(successful),
+        "wall_time": wall_time,
+        "volumes_per_second": len(successful) / wall_time if wall_time > 0 else 0.0,
+    }
+    if len(latencies):
+        summary.update(
+            {
+                "latency_mean": float(latencies.mean()),
+                "latency_p50": float(np.percentile(latencies, 50)),
+                "latency_p95": float(np.percentile(latencies, 95)),
+                "latency_p99": float(np.percentile(latencies, 99)),
+                "latency_max": float(latencies.max()),
+            }
+        )
+        stages = sorted({stage for result in successful for stage in result["timings"]})
+        for stage in stages:
+            durations = [result["timings"][stage] for result in successful if stage in result["timings"]]
+            summary[f"stage_{stage}_ms"] = float(np.mean(durations))
+    return summary
+
+
+def wait_until_healthy(base_url: str, timeout: float, process: Optional[subprocess.Popen] = None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Inference service exited with code {process.returncode}")
+        try:
+            if requests.get(f"{base_url}/health", timeout=5).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(1)
+    raise TimeoutError(f"Inference service at {base_url} not healthy after {timeout} seconds")
+
+
+@contextlib.contextmanager
+def local_service(service_dir: str, env_overrides: Dict[str, str], port: int, startup_timeout: float) -> Iterator[str]:
+    """Starts inference_service.py from `service_dir` with the given environment, yields its base URL."""
+    env = {**os.environ, **env_overrides, "PORT": str(port)}
+    LOGGER.info(f"Starting inference service with {env_overrides}")
+    process = subprocess.Popen([sys.executable, "inference_service.py"], cwd=service_dir, env=env)
+    base_url = f"http://localhost:{port}"
+    try:
+        wait_until_healthy(base_url, startup_timeout, process)
+        yield base_url
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def get_sweep_settings(sweep: List[str]) -> List[Dict[str, str]]:
+    """Expands ["NAME=value1,value2", ...] into every combination of the settings."""
+    names, values = [], []
+    for setting in sweep:
+        name, _, setting_values = setting.partition("=")
+        names.append(name)
+        values.append(setting_values.split(","))
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def main(args: argparse.Namespace):
+    if not args.service_dir and (args.sweep or args.stub_model):
+        raise ValueError("--sweep and --stub-model configure the local service, they require --service-dir")
+    with contextlib.ExitStack() as stack:
+        if args.synthetic:
+            synthetic_dir = stack.enter_context(tempfile.TemporaryDirectory())
+            image_paths = write_synthetic_volumes(synthetic_dir, args.synthetic, args.synthetic_shape)
+        else:
+            image_paths = get_volume_paths(args.data_dir)
+        LOGGER.info(f"Benchmarking with {len(image_paths)} volumes")
+
+        service_settings = get_sweep_settings(args.sweep) if args.service_dir else [{}]
+        rows = []
+        for settings in service_settings:
+            with contextlib.ExitStack() as service_stack:
+                if args.service_dir:
+                    env_overrides = {**settings, **({"STUB_MODEL": "true", "DEVICE": "cpu"} if args.stub_model else {})}
+                    base_url = service_stack.enter_context(
+                        local_service(args.service_dir, env_overrides, args.port, args.startup_timeout)
+                    )
+                else:
+                    base_url = args.server_url.rstrip("/")
+                    wait_until_healthy(base_url, args.startup_timeout)
+                server_url = f"{base_url}/predict/"
+
+                if args.warmup:
+                    run_load(server_url, image_paths, args.warmup, concurrency=1, timeout=args.timeout)
+                for concurrency in args.concurrency:
+                    results, wall_time = run_load(
+                        server_url,
+                        image_paths,
+                        num_requests=args.num_requests,
+                        concurrency=concurrency,
+                        arrival_rate=args.arrival_rate,
+                        timeout=args.timeout,
+                    )
+                    row = {**settings, "concurrency": concurrency, "arrival_rate": args.arrival_rate}
+                    row.update(summarize(results, wall_time))
+                    LOGGER.info(json.dumps(row))
+                    rows.append(row)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(rows, f, indent=2)
+        LOGGER.info(f"Results saved to {args.output}")
+    return rows
+
+
+def get_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Benchmark the SwinUNETR inference service.")
+    data = parser.add_mutually_exclusive_group(required=True)
+    data.add_argument("--data-dir", type=str, help="Directory of .nii, .nii.gz or .npy volumes to send.")
+    data.add_argument("--synthetic", type=int, help="Send this many random .npy volumes instead of a dataset.")
+    parser.add_argument(
+        "--synthetic-shape", type=int, nargs=3, default=[256, 256, 96], help="Shape of the synthetic volumes."
+    )
+    parser.add_argument("--server-url", type=str, default="http://localhost:8000", help="URL of a running service.")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1], help="Concurrent requests, one run each.")
+    parser.add_argument(
+        "--arrival-rate", type=float, default=None, help="Mean arrival rate (requests/s) for open-loop runs."
+    )
+    parser.add_argument("--num-requests", type=int, default=16, help="Number of requests per run.")
+    parser.add_argument("--warmup", type=int, default=1, help="Number of requests sent before measuring.")
+    parser.add_argument("--timeout", type=float, default=600.0, help="Timeout of each request in seconds.")
+    parser.add_argument(
+        "--service-dir",
+        type=str,
+        default=None,
+        help="Start the service from this directory (helm/mount) for each sweep setting instead of using --server-url.",
+    )
+    parser.add_argument(
+        "--sweep",
+        type=str,
+        action="append",
+        default=[],
+        help="Service environment variable and values to sweep, e.g. INFER_OVERLAP=0.25,0.5. Can be repeated.",
+    )
+    parser.add_argument("--stub-model", action="store_true", help="Run the local service with the CPU stub model.")
+    parser.add_argument("--port", type=int, default=8123, help="Port of the local service.")
+    parser.add_argument("--startup-timeout", type=float, default=600.0, help="Seconds to wait for the service.")
+    parser.add_argument("--output", type=str, default=None, help="Save the results as JSON to this file.")
+    return parser
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
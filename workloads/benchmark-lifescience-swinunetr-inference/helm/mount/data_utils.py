@@ -1,4 +1,5 @@
 import logging
+import os
 
 from monai import transforms
 
@@ -6,14 +7,18 @@ LOGGER = logging.getLogger(__name__)
 
 IMAGE_DATA = "image"
 SPACING_MODE = "bilinear"
-DEVICE = "cuda"
+DEVICE = os.environ.get("DEVICE", "cuda")
 
 
-def get_transforms(args):
-    """Returns the transforms to be applied to the input data."""
+def get_transforms(args, load_image=True):
+    """Returns the transforms to be applied to the input data.
+
+    With load_image=False, the transforms expect the image already loaded, e.g. as a MetaTensor decoded in memory.
+    """
+    load_transforms = [transforms.LoadImaged(keys=[IMAGE_DATA])] if load_image else []
     inference_transforms = transforms.Compose(
         [
-            transforms.LoadImaged(keys=[IMAGE_DATA]),
+            *load_transforms,
             transforms.EnsureChannelFirstd(keys=[IMAGE_DATA], channel_dim="no_channel"),
             transforms.Spacingd(
                 keys=[IMAGE_DATA], pixdim=(args.space_x, args.space_y, args.space_z), mode=SPACING_MODE
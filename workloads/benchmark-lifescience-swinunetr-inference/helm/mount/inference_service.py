@@ -1,19 +1,27 @@
 import argparse
+import asyncio
+import gzip
+import io
 import logging
 import os
-import tempfile
+import time
 import traceback
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager, nullcontext
+from typing import List
 
 import nibabel as nib
 import numpy as np
 import torch
 import uvicorn
 from data_utils import DEVICE, IMAGE_DATA, get_post_transforms_inverter, get_transforms
-from fastapi import FastAPI, File, HTTPException, UploadFile
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, File, HTTPException, Query, UploadFile
+from fastapi.responses import Response
 from monai import transforms
-from swinunetr import SwinUnetrModelForInference
+from monai.data import MetaTensor
+from sliding_window_batcher import SlidingWindowBatcher
+from swinunetr import StubModelForInference, SwinUnetrModelForInference
 from torch.cuda.amp import autocast
 
 LOGGER = logging.getLogger(__name__)
@@ -35,22 +43,49 @@ ARGS = argparse.Namespace(
     compile=os.environ.get("COMPILE", "false").lower() == "true",
     compile_mode=os.environ.get("COMPILE_MODE", "max-autotune"),
     autocast=os.environ.get("AUTOCAST", "false").lower() == "true",
+    sw_batch_size=int(os.environ.get("SW_BATCH_SIZE", "4")),
+    # Windows of concurrent requests are batched together, waiting at most this long for more requests
+    max_batch_wait_ms=float(os.environ.get("MAX_BATCH_WAIT_MS", "5")),
+    # Threads running the CPU pre- and post-processing of requests
+    transform_workers=int(os.environ.get("TRANSFORM_WORKERS", "4")),
+    # gzip level of .nii.gz predictions, 1 is the nibabel default
+    output_compression_level=int(os.environ.get("OUTPUT_COMPRESSION_LEVEL", "1")),
+    # Resample, invert and threshold on the device and return uint8 masks, see postprocess_on_device
+    gpu_transforms=os.environ.get("GPU_TRANSFORMS", "false").lower() == "true",
+    # Use a randomly initialized stand-in model, for benchmarking the service without a GPU
+    stub_model=os.environ.get("STUB_MODEL", "false").lower() == "true",
 )
 
-MODEL: SwinUnetrModelForInference | None = None
+# Channels of a thresholded mask are packed into the bits of one float32 channel, exact up to 24 bits
+MAX_PACKED_CHANNELS = 24
+
+# Output formats of the predictions: media type and file suffix
+OUTPUT_FORMATS = {
+    "nii.gz": ("application/gzip", ".nii.gz"),
+    "nii": ("application/octet-stream", ".nii"),
+    "npy": ("application/octet-stream", ".npy"),
+}
+
+MODEL: SwinUnetrModelForInference | StubModelForInference | None = None
 IMAGE_TRANSFORMS: transforms.Compose | None = None
 POST_TRANSFORMS_INVERTER: transforms.Compose | None = None
-AUTOCAST_CONTEXT = nullcontext()
+BATCHER: SlidingWindowBatcher | None = None
+TRANSFORM_POOL: ThreadPoolExecutor | None = None
 
 
 def load_model(args):
     """Loads the pre-trained model."""
-    global MODEL, IMAGE_TRANSFORMS, POST_TRANSFORMS_INVERTER, AUTOCAST_CONTEXT
-    MODEL = SwinUnetrModelForInference.from_pretrained(args.hf_model)
+    global MODEL, IMAGE_TRANSFORMS, POST_TRANSFORMS_INVERTER, BATCHER, TRANSFORM_POOL
+    if args.stub_model:
+        LOGGER.warning("Using a stub model with random weights, predictions are meaningless.")
+        MODEL = StubModelForInference()
+    else:
+        MODEL = SwinUnetrModelForInference.from_pretrained(args.hf_model)
 
     if args.compile:
+        # compile the network itself, it runs on fixed size batches of windows
         LOGGER.info(f"Compiling model to {args.compile_mode}")
-        MODEL = torch.compile(MODEL, mode=args.compile_mode, dynamic=False)
+        MODEL.model = torch.compile(MODEL.model, mode=args.compile_mode, dynamic=False)
         LOGGER.info("Model compiled successfully.")
 
     # Set the model to evaluation mode
@@ -58,23 +93,33 @@ def load_model(args):
     MODEL.to(DEVICE)
     LOGGER.info(f"Model loaded on {DEVICE}.")
 
-    # Configure autocast context once during model loading
     if args.autocast:
-        LOGGER.info("Configuring autocast for inference")
-        AUTOCAST_CONTEXT = autocast()
-    else:
-        AUTOCAST_CONTEXT = nullcontext()
+        LOGGER.info("Using autocast for inference")
 
-    IMAGE_TRANSFORMS = get_transforms(args=args)
+    # uploads are decoded in memory, so the transforms start after loading the image
+    IMAGE_TRANSFORMS = get_transforms(args=args, load_image=False)
     POST_TRANSFORMS_INVERTER = get_post_transforms_inverter(IMAGE_TRANSFORMS)
     LOGGER.info("Image transform pipeline initialized.")
 
+    BATCHER = SlidingWindowBatcher(
+        predictor=MODEL.model,
+        roi_size=(args.roi_x, args.roi_y, args.roi_z),
+        sw_batch_size=args.sw_batch_size,
+        overlap=args.infer_overlap,
+        mode="gaussian",
+        max_wait=args.max_batch_wait_ms / 1000,
+        pad_batches=args.compile,
+        autocast_context=autocast if args.autocast else nullcontext,
+    )
+    TRANSFORM_POOL = ThreadPoolExecutor(max_workers=args.transform_workers, thread_name_prefix="transforms")
+    LOGGER.info(f"Sliding window batcher started with sw_batch_size={args.sw_batch_size}.")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load model on server startup."""
     LOGGER.info("Server startup: Loading model...")
-    global MODEL, IMAGE_TRANSFORMS, POST_TRANSFORMS_INVERTER, AUTOCAST_CONTEXT
+    global MODEL, IMAGE_TRANSFORMS, POST_TRANSFORMS_INVERTER, BATCHER, TRANSFORM_POOL
     try:
         load_model(ARGS)
     except Exception as e:
@@ -82,10 +127,15 @@ async def lifespan(app: FastAPI):
         LOGGER.error(f"Traceback: \n{traceback.format_exc()}")
     yield
 
+    if BATCHER is not None:
+        BATCHER.stop()
+    if TRANSFORM_POOL is not None:
+        TRANSFORM_POOL.shutdown()
+    BATCHER = None
+    TRANSFORM_POOL = None
     MODEL = None
     IMAGE_TRANSFORMS = None
     POST_TRANSFORMS_INVERTER = None
-    AUTOCAST_CONTEXT = nullcontext()
 
 
 app = FastAPI(title="SwinUNETR Inference Service", lifespan=lifespan)
@@ -104,112 +154,244 @@ async def health_check():
     return {"status": "ok"}
 
 
-@app.post("/predict/", response_class=FileResponse)
-async def predict(file: UploadFile = File(...)):
+def get_file_suffix(filename: str) -> str:
+    for file_suffix in (".nii.gz", ".nii", ".npy"):
+        if filename.endswith(file_suffix):
+            return file_suffix
+    raise HTTPException(status_code=400, detail="Unsupported file type. Use .nii, .nii.gz, or .npy")
+
+
+def decode_volume(content: bytes, filename: str) -> MetaTensor:
+    """Decodes an uploaded NIfTI or .npy volume from memory into a MetaTensor like LoadImaged would return."""
+    file_suffix = get_file_suffix(filename)
+    if file_suffix == ".npy":
+        img_data_np = np.load(io.BytesIO(content)).astype(np.float32)
+        affine = np.eye(4)
+        LOGGER.warning(
+            "Using identity affine for .npy input. Inverse transform might not perfectly restore original physical space if original .npy had specific spacing."
+        )
+    else:
+        if file_suffix == ".nii.gz":
+            content = gzip.decompress(content)
+        nib_image = nib.Nifti1Image.from_bytes(content)
+        img_data_np = np.asarray(nib_image.dataobj, dtype=np.float32)
+        affine = nib_image.affine
+    affine = torch.as_tensor(affine, dtype=torch.float64)
+    meta = {
+        "original_affine": affine.clone(),
+        "spatial_shape": np.asarray(img_data_np.shape),
+        "original_channel_dim": "no_channel",
+        "filename_or_obj": filename,
+    }
+    return MetaTensor(torch.from_numpy(img_data_np), affine=affine, meta=meta)
+
+
+def preprocess(content: bytes, filename: str) -> MetaTensor:
+    """Decodes and transforms an input volume, returns it (C, H, W, D) on the device."""
+    image = decode_volume(content, filename)
+    if ARGS.gpu_transforms:
+        # resample and scale on the device
+        image = image.to(DEVICE)
+    # Prepare data dictionary for MONAI transforms
+    data_dict = {IMAGE_DATA: image}
+    # Apply transforms
+    val_input_transformed_dict = IMAGE_TRANSFORMS(data_dict)
+
+    val_inputs = val_input_transformed_dict[IMAGE_DATA].to(DEVICE)
+    LOGGER.info(f"Shape transformed inputs: {val_inputs.shape}")
+    return val_inputs
+
+
+def postprocess(logits: torch.Tensor, val_inputs: MetaTensor) -> tuple[np.ndarray, np.ndarray]:
+    """Inverts the transforms of the predicted logits and thresholds them into a segmentation mask.
+
+    Returns the mask and its affine.
     """
-    Accepts an image file (NIfTI or .npy), performs inference,
-    and returns the segmentation mask as a NIfTI file.
+    LOGGER.info(f"Shape of prediction before inversion: {logits.shape}")
+    # Post-processing and transforms inversion, using the transforms applied to the inputs
+    invert_dict = {
+        IMAGE_DATA: MetaTensor(logits[0], meta=val_inputs.meta, applied_operations=val_inputs.applied_operations),
+    }
+    inverted = POST_TRANSFORMS_INVERTER(invert_dict)
+    inverted_logits = inverted[IMAGE_DATA]
+    LOGGER.info(f"Shape of prediction after inverse transforms: {inverted_logits.shape}")
+
+    probs = torch.sigmoid(inverted_logits)
+    LOGGER.info(f"Max/Min probs: {probs.max()} / {probs.min()}")
+    seg = (probs > 0.5).float()
+    prediction_np = seg.cpu().numpy().squeeze()
+    LOGGER.info(f"Final prediction shape: {prediction_np.shape}")
+
+    output_affine = inverted[IMAGE_DATA].affine.cpu().numpy()
+    return prediction_np, output_affine
+
+
+def postprocess_on_device(logits: torch.Tensor, val_inputs: MetaTensor) -> tuple[np.ndarray, np.ndarray]:
+    """Like postprocess, but thresholds before inverting the transforms and returns a uint8 mask.
+
+    Thresholding first is exact, as the inversion uses nearest interpolation. The binary channels are packed into
+    the bits of a single channel, so only one channel is resampled, and only the final uint8 mask leaves the device.
     """
-    if MODEL is None or IMAGE_TRANSFORMS is None:
+    LOGGER.info(f"Shape of prediction before inversion: {logits.shape}")
+    # sigmoid(x) > 0.5 <=> x > 0
+    masks = logits[0] > 0
+    num_channels = masks.shape[0]
+    if num_channels <= MAX_PACKED_CHANNELS:
+        bit_values = 2 ** torch.arange(num_channels, device=masks.device, dtype=torch.float32)
+        to_invert = (masks.float() * bit_values.view(-1, *[1] * (masks.dim() - 1))).sum(dim=0, keepdim=True)
+    else:
+        to_invert = masks.float()
+    invert_dict = {
+        IMAGE_DATA: MetaTensor(to_invert, meta=val_inputs.meta, applied_operations=val_inputs.applied_operations),
+    }
+    inverted = POST_TRANSFORMS_INVERTER(invert_dict)
+    inverted_masks = inverted[IMAGE_DATA].as_tensor()
+    if num_channels <= MAX_PACKED_CHANNELS:
+        codes = inverted_masks.round().to(torch.int32)
+        bits = torch.arange(num_channels, device=codes.device, dtype=torch.int32).view(-1, *[1] * (codes.dim() - 1))
+        inverted_masks = (codes >> bits) & 1
+    prediction_np = inverted_masks.to(torch.uint8).cpu().numpy().squeeze()
+    LOGGER.info(f"Final prediction shape: {prediction_np.shape}")
+
+    output_affine = inverted[IMAGE_DATA].affine.cpu().numpy()
+    return prediction_np, output_affine
+
+
+def encode_prediction(prediction_np: np.ndarray, affine: np.ndarray, output_format: str) -> bytes:
+    """Encodes a prediction in memory as a gzipped or uncompressed NIfTI file, or as a .npy file."""
+    if output_format == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, prediction_np)
+        return buffer.getvalue()
+    nifti_bytes = nib.Nifti1Image(prediction_np, affine).to_bytes()
+    if output_format == "nii.gz":
+        return gzip.compress(nifti_bytes, compresslevel=ARGS.output_compression_level)
+    return nifti_bytes
+
+
+async def predict_volume(file: UploadFile, output_format: str) -> tuple[bytes, dict[str, float]]:
+    """Predicts the segmentation mask of an uploaded volume, returns it encoded in the output format.
+
+    The upload is decoded and transformed in memory, in the transform thread pool, and the windows of the volume
+    are predicted by the sliding window batcher, together with the windows of concurrent requests.
+
+    Returns:
+        The encoded prediction and the duration of each stage in milliseconds.
+    """
+    loop = asyncio.get_running_loop()
+    timings = {}
+    start = time.perf_counter()
+
+    def record(stage):
+        nonlocal start
+        now = time.perf_counter()
+        timings[stage] = (now - start) * 1000
+        start = now
+
+    content = await file.read()
+    record("upload")
+    val_inputs = await loop.run_in_executor(TRANSFORM_POOL, preprocess, content, file.filename)
+    del content
+    record("preprocess")
+
+    LOGGER.info("Predicting...")
+    logits = await asyncio.wrap_future(BATCHER.submit(val_inputs.unsqueeze(0)))
+    record("inference")
+    postprocess_fn = postprocess_on_device if ARGS.gpu_transforms else postprocess
+    prediction_np, affine = await loop.run_in_executor(TRANSFORM_POOL, postprocess_fn, logits, val_inputs)
+    record("postprocess")
+    prediction = await loop.run_in_executor(TRANSFORM_POOL, encode_prediction, prediction_np, affine, output_format)
+    record("encode")
+    return prediction, timings
+
+
+def get_server_timing_header(timings: dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={duration:.1f}" for stage, duration in timings.items())
+
+
+def _check_request(filenames: List[str], output_format: str):
+    if MODEL is None or IMAGE_TRANSFORMS is None or BATCHER is None:
         raise HTTPException(
             status_code=503, detail="Model not loaded. Server might be starting or encountered an error."
         )
+    for filename in filenames:
+        get_file_suffix(filename)
+    if output_format not in OUTPUT_FORMATS:
+        raise HTTPException(
+            status_code=400, detail=f"Unsupported output format. Use one of {', '.join(OUTPUT_FORMATS)}"
+        )
+
+
+@app.post("/predict/")
+async def predict(
+    file: UploadFile = File(...),
+    output_format: str = Query("nii.gz", description="Format of the prediction: nii.gz, nii or npy"),
+):
+    """
+    Accepts an image file (NIfTI or .npy), performs inference,
+    and returns the segmentation mask as a NIfTI file (or .npy file, see output_format).
+    """
+    _check_request([file.filename], output_format)
 
     try:
-        original_filename = file.filename
-        file_suffix = ""
-        if original_filename.endswith(".nii.gz"):
-            file_suffix = ".nii.gz"
-        elif original_filename.endswith(".nii"):
-            file_suffix = ".nii"
-        elif original_filename.endswith(".npy"):
-            file_suffix = ".npy"
-        else:
-            raise HTTPException(status_code=400, detail="Unsupported file type. Use .nii, .nii.gz, or .npy")
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_suffix) as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
-
-        LOGGER.info(f"Temporary file saved at: {tmp_file_path} for original: {original_filename}")
-
-        original_affine = np.eye(4)  # Default for npy
-        original_shape_3d = None
-        img_data_np = None
-        if file_suffix in [".nii", ".nii.gz"]:
-            nib_image = nib.load(tmp_file_path)
-            img_data_np = np.asarray(nib_image.dataobj, dtype=np.float32)
-            original_affine = nib_image.affine.astype(np.float32)
-            original_shape_3d = img_data_np.shape
-        elif file_suffix == ".npy":
-            img_data_np = np.load(tmp_file_path).astype(np.float32)
-            original_shape_3d = img_data_np.shape
-            LOGGER.warning(
-                "Using identity affine for .npy input. Inverse transform might not perfectly restore original physical space if original .npy had specific spacing."
-            )
-
-        # Prepare data dictionary for MONAI transforms
-        data_dict = {IMAGE_DATA: tmp_file_path}
-        # Apply transforms
-        val_input_transformed_dict = IMAGE_TRANSFORMS(data_dict)
-
-        val_inputs = val_input_transformed_dict[IMAGE_DATA]
-        val_inputs = val_inputs.unsqueeze(0).to(DEVICE)
-        LOGGER.info(f"Shape transformed inputs: {val_inputs.shape}")
-
-        LOGGER.info("Predicting...")
-        with torch.inference_mode(), AUTOCAST_CONTEXT:
-            logits = MODEL.forward(
-                inputs=val_inputs,
-                roi_size=(ARGS.roi_x, ARGS.roi_y, ARGS.roi_z),
-                sw_batch_size=4,
-                overlap=ARGS.infer_overlap,
-                mode="gaussian",
-            )
-            LOGGER.info(f"Shape of prediction before inversion: {logits.shape}")
-
-        # Post-processing and transforms inversion
-        invert_dict = {
-            IMAGE_DATA: logits[0],
-        }
-        inverted = POST_TRANSFORMS_INVERTER(invert_dict)
-        inverted_logits = inverted[IMAGE_DATA]
-        LOGGER.info(f"Shape of prediction after inverse transforms: {inverted_logits.shape}")
-
-        probs = torch.sigmoid(inverted_logits)
-        LOGGER.info(f"Max/Min probs: {probs.max()} / {probs.min()}")
-        seg = (probs > 0.5).float()
-        prediction_np = seg.cpu().numpy().squeeze()
-        LOGGER.info(f"Final prediction shape: {prediction_np.shape}")
-
-        # Save prediction to a NIfTI file
-        output_affine = inverted[IMAGE_DATA].affine.cpu().numpy()
-        pred_nifti = nib.Nifti1Image(prediction_np, output_affine)
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix="_prediction.nii.gz") as pred_output_file:
-            nib.save(pred_nifti, pred_output_file.name)
-            response_file_path = pred_output_file.name
-
-        os.unlink(tmp_file_path)
-
-        return FileResponse(response_file_path, media_type="application/gzip", filename="prediction.nii.gz")
+        content, timings = await predict_volume(file, output_format)
+        media_type, file_suffix = OUTPUT_FORMATS[output_format]
+        return Response(
+            content=content,
+            media_type=media_type,
+            headers={
+                "Content-Disposition": f"attachment; filename=prediction{file_suffix}",
+                # per-stage durations in milliseconds
+                "Server-Timing": get_server_timing_header(timings),
+            },
+        )
 
     except HTTPException as http_exc:
         raise http_exc
     except Exception as e:
-        if "tmp_file_path" in locals() and os.path.exists(tmp_file_path):
-            os.unlink(tmp_file_path)
-        if "response_file_path" in locals() and os.path.exists(response_file_path):
-            os.unlink(response_file_path)
         LOGGER.error(f"Error during prediction: {e}")
         LOGGER.error(f"Traceback: \n{traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
-    finally:
-        if os.path.exists(tmp_file_path):
-            os.unlink(tmp_file_path)
-            LOGGER.info(f"Temporary input file {tmp_file_path} unlinked.")
+
+@app.post("/predict_batch/")
+async def predict_batch(
+    files: List[UploadFile] = File(...),
+    output_format: str = Query("nii.gz", description="Format of the predictions: nii.gz, nii or npy"),
+):
+    """
+    Accepts several image files (NIfTI or .npy), performs inference on them concurrently,
+    and returns a ZIP with a segmentation mask file per input, named after the input.
+    """
+    _check_request([file.filename for file in files], output_format)
+
+    try:
+        results = await asyncio.gather(*(predict_volume(file, output_format) for file in files))
+
+        _, output_suffix = OUTPUT_FORMATS[output_format]
+        zip_buffer = io.BytesIO()
+        with zipfile.ZipFile(zip_buffer, mode="w", compression=zipfile.ZIP_STORED) as zip_file:
+            for file, (prediction, _) in zip(files, results):
+                name = os.path.basename(file.filename).removesuffix(get_file_suffix(file.filename))
+                zip_file.writestr(f"{name}_prediction{output_suffix}", prediction)
+
+        # slowest volume per stage, the volumes are predicted concurrently
+        timings = {stage: max(volume_timings[stage] for _, volume_timings in results) for stage in results[0][1]}
+        return Response(
+            content=zip_buffer.getvalue(),
+            media_type="application/zip",
+            headers={
+                "Content-Disposition": "attachment; filename=predictions.zip",
+                "Server-Timing": get_server_timing_header(timings),
+            },
+        )
+
+    except HTTPException as http_exc:
+        raise http_exc
+    except Exception as e:
+        LOGGER.error(f"Error during prediction: {e}")
+        LOGGER.error(f"Traceback: \n{traceback.format_exc()}")
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
 if __name__ == "__main__":
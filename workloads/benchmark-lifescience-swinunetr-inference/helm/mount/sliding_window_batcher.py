@@ -0,0 +1,224 @@
+import logging
+import math
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, InvalidStateError
+from contextlib import nullcontext
+from itertools import product
+from typing import Callable, ContextManager, Sequence
+
+import torch
+import torch.nn.functional as F
+from monai.data.utils import compute_importance_map
+from monai.utils import BlendMode
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_window_starts(image_size: int, roi_size: int, overlap: float) -> list[int]:
+    """Returns the start positions of the sliding windows along one dimension, as in MONAI sliding_window_inference."""
+    if roi_size >= image_size:
+        return [0]
+    interval = max(int(roi_size * (1 - overlap)), 1)
+    num_windows = math.ceil((image_size - roi_size) / interval) + 1
+    return sorted({min(i * interval, image_size - roi_size) for i in range(num_windows)})
+
+
+class _Volume:
+    """A volume being predicted: its padded inputs, the windows still to predict and the blended outputs."""
+
+    def __init__(self, inputs: torch.Tensor, roi_size: Sequence[int], overlap: float):
+        self.future: Future = Future()
+        if hasattr(inputs, "as_tensor"):
+            # predict plain tensors, the caller keeps the metadata of MetaTensor inputs
+            inputs = inputs.as_tensor()
+        self.original_size = inputs.shape[2:]
+        # pad volumes smaller than the ROI symmetrically, like sliding_window_inference
+        self.pad_before = []
+        pad_size = []
+        for k in reversed(range(len(self.original_size))):
+            diff = max(roi_size[k] - self.original_size[k], 0)
+            pad_size.extend([diff // 2, diff - diff // 2])
+            self.pad_before.insert(0, diff // 2)
+        self.inputs = F.pad(inputs, pad_size) if any(pad_size) else inputs
+        padded_size = self.inputs.shape[2:]
+        starts = [get_window_starts(padded_size[k], roi_size[k], overlap) for k in range(len(padded_size))]
+        self.windows = [
+            tuple(slice(start, start + roi_size[k]) for k, start in enumerate(window_starts))
+            for window_starts in product(*starts)
+        ]
+        self.next_window = 0
+        self.predicted_windows = 0
+        self.output: torch.Tensor | None = None
+        self.count: torch.Tensor | None = None
+
+    def get_patch(self, window) -> torch.Tensor:
+        return self.inputs[(slice(None), slice(None), *window)]
+
+    def add_prediction(self, window, prediction: torch.Tensor, importance_map: torch.Tensor):
+        if self.output is None:
+            self.output = torch.zeros(
+                (1, prediction.shape[0], *self.inputs.shape[2:]), dtype=torch.float32, device=prediction.device
+            )
+            self.count = torch.zeros((1, 1, *self.inputs.shape[2:]), dtype=torch.float32, device=prediction.device)
+        self.output[(slice(None), slice(None), *window)] += prediction.float() * importance_map
+        self.count[(slice(None), slice(None), *window)] += importance_map
+        self.predicted_windows += 1
+
+    @property
+    def done(self) -> bool:
+        return self.predicted_windows == len(self.windows)
+
+    def get_result(self) -> torch.Tensor:
+        self.output /= self.count
+        crop = tuple(slice(before, before + size) for before, size in zip(self.pad_before, self.original_size))
+        return self.output[(slice(None), slice(None), *crop)]
+
+
+class SlidingWindowBatcher:
+    """Runs sliding window inference for concurrent requests, batching the windows of different volumes together.
+
+    Volumes are submitted from any thread and predicted by a single worker thread, which fills each batch of
+    `sw_batch_size` windows from the queued volumes in submission order. When there are fewer windows left than a
+    batch, it waits up to `max_wait` seconds for more volumes. The windows are blended like
+    monai.inferers.sliding_window_inference, so results match predicting each volume on its own.
+
+    Args:
+        predictor: The network, called on a batch of windows (N, C, *roi_size).
+        roi_size: The spatial window size.
+        sw_batch_size: Number of windows per forward pass.
+        overlap: Amount of overlap between windows.
+        mode: How to blend the outputs of overlapping windows, "constant" or "gaussian".
+        max_wait: Seconds to wait for more volumes to fill a batch.
+        pad_batches: Pad the last batch to `sw_batch_size` windows, so a compiled predictor sees a single shape.
+        autocast_context: Returns the context manager the predictor runs in, e.g. torch.autocast.
+    """
+
+    def __init__(
+        self,
+        predictor: Callable[[torch.Tensor], torch.Tensor],
+        roi_size: Sequence[int],
+        sw_batch_size: int,
+        overlap: float = 0.25,
+        mode: BlendMode | str = BlendMode.CONSTANT,
+        max_wait: float = 0.005,
+        pad_batches: bool = False,
+        autocast_context: Callable[[], ContextManager] = nullcontext,
+    ):
+        self.predictor = predictor
+        self.roi_size = tuple(roi_size)
+        self.sw_batch_size = sw_batch_size
+        self.overlap = overlap
+        self.mode = mode
+        self.max_wait = max_wait
+        self.pad_batches = pad_batches
+        self.autocast_context = autocast_context
+        self.importance_maps: dict[torch.device, torch.Tensor] = {}
+        self.queue: queue.Queue[_Volume | None] = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="sliding-window-batcher", daemon=True)
+        self.thread.start()
+
+    def submit(self, inputs: torch.Tensor) -> Future:
+        """Queues a volume (1, C, *spatial_size) for prediction. Returns a future of its logits (1, C', *spatial_size)."""
+        volume = _Volume(inputs, self.roi_size, self.overlap)
+        self.queue.put(volume)
+        return volume.future
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _get_importance_map(self, device: torch.device) -> torch.Tensor:
+        if device not in self.importance_maps:
+            importance_map = compute_importance_map(
+                self.roi_size, mode=self.mode, sigma_scale=0.125, device=device, dtype=torch.float32
+            )
+            # avoid division by zero at the window borders, as sliding_window_inference does
+            min_non_zero = max(torch.min(importance_map).item(), 1e-3)
+            self.importance_maps[device] = torch.clamp(importance_map, min=min_non_zero)
+        return self.importance_maps[device]
+
+    def _collect_volumes(self, pending: deque) -> bool:
+        """Moves queued volumes to `pending`, waiting for volumes if needed. Returns False when stopped."""
+        deadline = None
+        while True:
+            if not pending:
+                timeout = None
+            elif sum(len(volume.windows) - volume.next_window for volume in pending) < self.sw_batch_size:
+                deadline = deadline or time.monotonic() + self.max_wait
+                timeout = max(deadline - time.monotonic(), 0)
+            else:
+                timeout = 0
+            try:
+                volume = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                return True
+            if volume is None:
+                return False
+            # a running future can no longer be cancelled, skip volumes cancelled while queued
+            if volume.future.set_running_or_notify_cancel():
+                pending.append(volume)
+
+    def _next_batch(self, pending: deque) -> list[tuple[_Volume, tuple]]:
+        batch = []
+        for volume in pending:
+            while volume.next_window < len(volume.windows) and len(batch) < self.sw_batch_size:
+                batch.append((volume, volume.windows[volume.next_window]))
+                volume.next_window += 1
+            if len(batch) == self.sw_batch_size:
+                break
+        return batch
+
+    def _predict_batch(self, batch: list[tuple[_Volume, tuple]]):
+        patches = torch.cat([volume.get_patch(window) for volume, window in batch])
+        if self.pad_batches and len(batch) < self.sw_batch_size:
+            padding = patches.new_zeros((self.sw_batch_size - len(batch), *patches.shape[1:]))
+            patches = torch.cat([patches, padding])
+        with torch.inference_mode(), self.autocast_context():
+            predictions = self.predictor(patches)
+        importance_map = self._get_importance_map(predictions.device)
+        with torch.inference_mode():
+            for (volume, window), prediction in zip(batch, predictions):
+                volume.add_prediction(window, prediction, importance_map)
+
+    @staticmethod
+    def _set_result(volume: _Volume, result: torch.Tensor | None = None, exception: BaseException | None = None):
+        try:
+            if exception is None:
+                volume.future.set_result(result)
+            else:
+                volume.future.set_exception(exception)
+        except InvalidStateError:
+            LOGGER.warning("Could not deliver the result of a volume, its future is already done")
+
+    def _run(self):
+        pending: deque[_Volume] = deque()
+        running = True
+        while running:
+            running = self._collect_volumes(pending)
+            while batch := self._next_batch(pending):
+                try:
+                    self._predict_batch(batch)
+                except Exception as e:
+                    LOGGER.exception("Error while predicting a batch of windows")
+                    for volume in {id(volume): volume for volume, _ in batch}.values():
+                        self._set_result(volume, exception=e)
+                        pending.remove(volume)
+                    continue
+                for volume in [volume for volume in pending if volume.done]:
+                    pending.remove(volume)
+                    try:
+                        with torch.inference_mode():
+                            result = volume.get_result()
+                    except Exception as e:
+                        LOGGER.exception("Error while blending the windows of a volume")
+                        self._set_result(volume, exception=e)
+                    else:
+                        self._set_result(volume, result)
+                # let volumes arriving meanwhile join the next batches
+                if running and not self.queue.empty():
+                    break
+        for volume in pending:
+            self._set_result(volume, exception=RuntimeError("Sliding window batcher stopped."))
@@ -119,3 +119,24 @@ class SwinUnetrModelForInference(SwinUnetrPreTrainedModel):
         """
 
         return sliding_window_inference(inputs, roi_size, sw_batch_size, self.model, overlap, mode)
+
+
+class StubModelForInference(nn.Module):
+    """
+    Stand-in for SwinUnetrModelForInference with a single pointwise convolution and random weights, so the inference
+    service can be benchmarked end to end without a GPU or downloading the model.
+    """
+
+    def __init__(self, in_channels: int = 1, out_channels: int = 14):
+        super().__init__()
+        self.model = nn.Conv3d(in_channels, out_channels, kernel_size=1)
+
+    def forward(
+        self,
+        inputs: torch.Tensor,
+        roi_size: Union[Sequence[int], int],
+        sw_batch_size: int,
+        overlap: float = 0.25,
+        mode: Union[BlendMode, str] = BlendMode.CONSTANT,
+    ):
+        return sliding_window_inference(inputs, roi_size, sw_batch_size, self.model, overlap, mode)
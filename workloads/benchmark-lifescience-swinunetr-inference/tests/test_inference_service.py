@@ -0,0 +1,85 @@
+import gzip
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("monai")
+nib = pytest.importorskip("nibabel")
+pytest.importorskip("fastapi")
+
+# the service reads the device when it is imported, the tests run on the CPU
+os.environ["DEVICE"] = "cpu"
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "helm", "mount"))
+
+import inference_service  # noqa: E402
+from data_utils import get_post_transforms_inverter, get_transforms  # noqa: E402
+
+# anisotropic voxels, so the volume is resampled to a different shape by the spacing transform
+AFFINE = np.diag([0.8, 1.2, 2.5, 1.0])
+
+
+@pytest.fixture
+def service_transforms(monkeypatch):
+    image_transforms = get_transforms(args=inference_service.ARGS, load_image=False)
+    monkeypatch.setattr(inference_service, "IMAGE_TRANSFORMS", image_transforms)
+    monkeypatch.setattr(inference_service, "POST_TRANSFORMS_INVERTER", get_post_transforms_inverter(image_transforms))
+
+
+def get_volume_bytes(shape=(20, 16, 9), affine=AFFINE):
+    rng = np.random.default_rng(0)
+    volume = rng.uniform(-1000, 1000, size=shape).astype(np.float32)
+    return nib.Nifti1Image(volume, affine).to_bytes()
+
+
+@pytest.mark.parametrize("num_channels", [3, 30])
+def test_postprocess_on_device_matches_postprocess(service_transforms, num_channels):
+    val_inputs = inference_service.preprocess(get_volume_bytes(), "volume.nii")
+    torch.manual_seed(0)
+    logits = torch.randn(1, num_channels, *val_inputs.shape[1:])
+
+    expected_mask, expected_affine = inference_service.postprocess(logits, val_inputs)
+    mask, affine = inference_service.postprocess_on_device(logits, val_inputs)
+
+    assert mask.dtype == np.uint8
+    assert mask.shape == (num_channels, 20, 16, 9)
+    np.testing.assert_array_equal(mask, expected_mask.astype(np.uint8))
+    np.testing.assert_allclose(affine, expected_affine)
+
+
+def test_decode_volume_matches_load_image(tmp_path):
+    # flipped first axis and an origin offset, besides the anisotropic spacing
+    affine = np.array([[-0.8, 0, 0, 100.0], [0, 1.2, 0, -50.0], [0, 0, 2.5, 10.0], [0, 0, 0, 1]])
+    volume_bytes = get_volume_bytes(affine=affine)
+    volume_path = tmp_path / "volume.nii"
+    volume_path.write_bytes(volume_bytes)
+
+    load_transforms = get_transforms(args=inference_service.ARGS, load_image=True)
+    expected = load_transforms({"image": str(volume_path)})["image"]
+    decode_transforms = get_transforms(args=inference_service.ARGS, load_image=False)
+    transformed = decode_transforms({"image": inference_service.decode_volume(volume_bytes, "volume.nii")})["image"]
+
+    torch.testing.assert_close(transformed.as_tensor(), expected.as_tensor())
+    torch.testing.assert_close(transformed.affine, expected.affine)
+
+    # the same prediction, inverted to the input space and encoded
+    mask = (transformed.as_tensor() > 0.5).float()
+    outputs = []
+    for forward_transforms, inputs in [(load_transforms, expected), (decode_transforms, transformed)]:
+        inverted = get_post_transforms_inverter(forward_transforms)(
+            {
+                "image": inference_service.MetaTensor(
+                    mask, meta=inputs.meta, applied_operations=inputs.applied_operations
+                )
+            }
+        )["image"]
+        encoded = inference_service.encode_prediction(inverted.numpy().squeeze(), inverted.affine.numpy(), "nii.gz")
+        outputs.append(nib.Nifti1Image.from_bytes(gzip.decompress(encoded)))
+
+    expected_output, output = outputs
+    assert output.shape == expected_output.shape == (20, 16, 9)
+    np.testing.assert_array_equal(output.get_fdata(), expected_output.get_fdata())
+    np.testing.assert_allclose(output.affine, expected_output.affine)
+    np.testing.assert_allclose(output.affine, affine, atol=1e-5)
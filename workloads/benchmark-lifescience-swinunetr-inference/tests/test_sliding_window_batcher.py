@@ -0,0 +1,65 @@
+import os
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("monai")
+
+from monai.inferers import sliding_window_inference  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "helm", "mount"))
+
+from sliding_window_batcher import SlidingWindowBatcher  # noqa: E402
+
+ROI_SIZE = (8, 8, 8)
+
+
+@pytest.fixture
+def predictor():
+    torch.manual_seed(0)
+    return torch.nn.Conv3d(1, 3, kernel_size=3, padding=1).eval()
+
+
+def get_batcher(predictor, mode="constant", sw_batch_size=4, overlap=0.5):
+    return SlidingWindowBatcher(predictor, ROI_SIZE, sw_batch_size, overlap=overlap, mode=mode, max_wait=0.01)
+
+
+@pytest.mark.parametrize("mode", ["constant", "gaussian"])
+@pytest.mark.parametrize("spatial_size", [(20, 17, 9), (6, 12, 8)])
+def test_batcher_matches_sliding_window_inference(predictor, mode, spatial_size):
+    inputs = torch.rand(1, 1, *spatial_size)
+    batcher = get_batcher(predictor, mode=mode)
+    try:
+        result = batcher.submit(inputs).result(timeout=30)
+    finally:
+        batcher.stop()
+    with torch.inference_mode():
+        expected = sliding_window_inference(inputs, ROI_SIZE, 4, predictor, overlap=0.5, mode=mode)
+    assert result.shape == expected.shape
+    torch.testing.assert_close(result, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_batcher_concurrent_volumes(predictor):
+    volumes = [torch.rand(1, 1, 12 + i, 16, 10) for i in range(3)]
+    batcher = get_batcher(predictor, sw_batch_size=5)
+    try:
+        futures = [batcher.submit(volume) for volume in volumes]
+        results = [future.result(timeout=30) for future in futures]
+    finally:
+        batcher.stop()
+    for volume, result in zip(volumes, results):
+        with torch.inference_mode():
+            expected = sliding_window_inference(volume, ROI_SIZE, 5, predictor, overlap=0.5)
+        torch.testing.assert_close(result, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_batcher_survives_cancelled_futures(predictor):
+    batcher = get_batcher(predictor)
+    try:
+        for _ in range(3):
+            batcher.submit(torch.rand(1, 1, 16, 16, 16)).cancel()
+        result = batcher.submit(torch.rand(1, 1, 16, 16, 16)).result(timeout=30)
+    finally:
+        batcher.stop()
+    assert result.shape == (1, 3, 16, 16, 16)
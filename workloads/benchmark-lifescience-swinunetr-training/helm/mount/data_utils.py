@@ -12,9 +12,13 @@
 # Modified by Reference Models team (AMD) on 2025:
 # - Adaptation and transforms for training on the NSCLCL-Radiomics dataset
 # - Dataloader optimizations
+# - Persistent cache of the preprocessed volumes
 
+import hashlib
+import json
 import logging
 import math
+import os
 from typing import List, Union
 
 import numpy as np
@@ -33,6 +37,8 @@ SPACING_MODES = ("bilinear", "nearest")
 ORIENTATION = "RAS"
 COLLECTION = "NSCLC-Radiomics"
 SEG_TYPE = "SEG"
+# Bump when the deterministic transforms change in a way not captured by get_cache_key, to invalidate the caches
+CACHE_VERSION = 1
 
 
 class Sampler(torch.utils.data.Sampler):
@@ -231,6 +237,38 @@ def get_transforms(name: str, args):
         raise ValueError(f"Unknown transform with name {name}")
 
 
+def get_cache_key(name: str, args) -> str:
+    """Hash of the arguments of the deterministic transforms, so changing them starts a new cache."""
+    cache_args = {
+        "version": CACHE_VERSION,
+        "transforms": name,
+        "collection": COLLECTION,
+        "dataset_labels": args.dataset_labels,
+        "orientation": ORIENTATION,
+        "spacing": [args.space_x, args.space_y, args.space_z],
+        "intensity_range": [args.a_min, args.a_max, args.b_min, args.b_max],
+        "roi": [args.roi_x, args.roi_y, args.roi_z],
+    }
+    return hashlib.sha256(json.dumps(cache_args, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_persistent_dataset(dataset: TciaDataset, name: str, args):
+    """Caches the output of the deterministic transforms of `dataset` on disk, in `args.cache_dir`.
+
+    The transforms up to the first random one (loading the DICOMs, orientation, spacing, intensity scaling, cropping
+    and padding) run once per volume and are saved to a directory keyed by the transform arguments, so the cache is
+    reused by every rank, epoch and later run. Only the random augmentations run on every epoch.
+    Returns `dataset` unchanged if `args.cache_dir` is empty.
+    """
+    if not args.cache_dir:
+        return dataset
+    cache_dir = os.path.join(args.cache_dir, f"{name}_{get_cache_key(name, args)}")
+    os.makedirs(cache_dir, exist_ok=True)
+    logging.info(f"Caching the preprocessed {name} volumes in {cache_dir}")
+    # the items are written to a temporary file and moved in place, so concurrent ranks can share the directory
+    return data.PersistentDataset(data=dataset.data, transform=dataset.transform, cache_dir=cache_dir)
+
+
 def get_loader(args):
     if args.test_mode:
         test_transform = get_transforms(name="test", args=args)
@@ -246,6 +284,7 @@ def get_loader(args):
             transform=test_transform,
             runtime_cache=False,
         )
+        test_ds = get_persistent_dataset(test_ds, "test", args)
         test_sampler = Sampler(test_ds, shuffle=False) if args.distributed else None
         test_loader = data.DataLoader(
             test_ds,
@@ -267,13 +306,13 @@ def get_loader(args):
             download=args.download_data,
             seg_type=SEG_TYPE,
             progress=True,
-            cache_num=24,
-            cache_rate=1.0,
+            cache_rate=0.0,
             val_frac=0.2,
             num_workers=args.workers,
             transform=train_transform,
             runtime_cache=False,
         )
+        train_ds = get_persistent_dataset(train_ds, "training", args)
         train_sampler = Sampler(train_ds) if args.distributed else None
         train_loader = data.DataLoader(
             train_ds,
@@ -300,6 +339,7 @@ def get_loader(args):
             transform=val_transform,
             runtime_cache=False,
         )
+        val_ds = get_persistent_dataset(val_ds, "validation", args)
         val_sampler = Sampler(val_ds, shuffle=True) if args.distributed else None
         val_loader = data.DataLoader(
             val_ds,
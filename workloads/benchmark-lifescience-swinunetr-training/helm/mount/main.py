@@ -56,6 +56,12 @@ parser.add_argument(
 )
 parser.add_argument("--data_root_dir", default="/workload_outputs/data", type=str, help="dataset root directory")
 parser.add_argument("--download_data", action="store_true", help="Download the dataset")
+parser.add_argument(
+    "--cache_dir",
+    default="",
+    type=str,
+    help="Directory of the persistent cache of preprocessed volumes, shared by all ranks and runs. Empty to disable",
+)
 parser.add_argument(
     "--dataset_labels",
     default="GTV-1",
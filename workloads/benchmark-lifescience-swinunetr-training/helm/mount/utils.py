@@ -24,7 +24,7 @@ import botocore
 import numpy as np
 import scipy.ndimage as ndimage
 import torch
-from monai.transforms import LoadImaged
+from monai.transforms import LoadImaged, Transform
 
 
 class Tee(object):
@@ -50,10 +50,11 @@ class Tee(object):
                     pass
 
 
-class SafeLoadImaged:
+class SafeLoadImaged(Transform):
     """Simple wrapper for the LoadImaged that doesn't do anything else.
     It somehow fixes the error when ussing num_workers > 1 in the TciaDataset. No idea why, it might be changing
      how the transforms are constructed and pickled, altering the process/thread state.
+    It is a Transform, so PersistentDataset caches the loaded volumes (see data_utils.get_persistent_dataset).
     """
 
     def __init__(self, **kwargs):